@@ -0,0 +1,105 @@
+"""
+Benchmarks the json and columnar representations of /api/sync payloads.
+
+For each number of notes, reports the raw and gzip-encoded payload sizes,
+and the CPU time to encode a response as ``render_json`` streams it, and to
+decode a request as ``_read_request`` does, with notes as objects
+(``json``) and as rows of values (``columns``).
+
+Usage::
+
+    APPENGINE_SDK=/path/to/google_appengine python benchmarks/columns.py
+"""
+
+from __future__ import division, print_function, unicode_literals
+import io
+import time
+import timeit
+from datetime import datetime
+
+import environment
+environment.setup_paths()
+
+from google.appengine.ext.ndb.key import Key
+
+from payloads import make_notes
+from spidernotes.compression import gzip_compress
+from spidernotes.handlers.synchronization import (
+    _read_request, _to_tuple, default_config)
+from spidernotes.models import NOTE_COLUMNS, Note
+from spidernotes.timestamps import to_milliseconds, to_timestamp
+from spidernotes.utils import iter_json
+
+
+_NOTE_COUNTS = (100, 1000, 10000)
+
+
+def _time(func, number):
+    # ``time.clock`` measures CPU time on Unix.
+    return min(timeit.repeat(func, number=number, repeat=3,
+                             timer=time.clock)) / number
+
+
+def _make_entities(note_dicts):
+    user_key = Key('User', 1)
+    synchronized = datetime.utcnow()
+    entities = []
+    for note_dict in note_dicts:
+        entity = Note(parent=user_key, id=note_dict['id'])
+        entity.update_from_note(_to_tuple(note_dict), synchronized)
+        entities.append(entity)
+    return entities
+
+
+def _encode_json(entities, synchronized):
+    chunks = iter_json({'lastSynchronized': to_timestamp(synchronized),
+                        'notes': (o.to_dict() for o in entities)})
+    return ''.join(chunks).encode('UTF8')
+
+
+def _encode_columns(entities, synchronized):
+    chunks = iter_json({'lastSynchronized': to_milliseconds(synchronized),
+                        'notes': (o.to_row() for o in entities)})
+    return ''.join(chunks).encode('UTF8')
+
+
+def _make_request(notes):
+    # ``lastSynchronized`` precedes ``notes``, as clients send them.
+    return b''.join([b'{"lastSynchronized": 0, "notes": ',
+                     ''.join(iter_json(notes)).encode('UTF8'), b'}'])
+
+
+def _decode(payload, is_columnar):
+    _, notes = _read_request(io.BytesIO(payload), default_config, is_columnar)
+    return list(notes)
+
+
+def main():
+    environment.activate_testbed()
+    synchronized = datetime.utcnow()
+
+    print('{:>6} {:>8} {:>10} {:>9} {:>10} {:>10}'.format(
+        'notes', 'format', 'raw', 'gzip', 'encode ms', 'decode ms'))
+    for count in _NOTE_COUNTS:
+        note_dicts = make_notes(count)
+        entities = _make_entities(note_dicts)
+        formats = (
+            ('json', _encode_json, note_dicts, False),
+            ('columns', _encode_columns,
+             [[o[k] for k in NOTE_COLUMNS] for o in note_dicts], True))
+        number = max(1, 1000 // count)
+
+        for name, encode, notes, is_columnar in formats:
+            response = encode(entities, synchronized)
+            request = _make_request(notes)
+            encode_time = _time(lambda: encode(entities, synchronized),
+                                number)
+            decode_time = _time(lambda: _decode(request, is_columnar),
+                                number)
+            print('{:>6} {:>8} {:>10} {:>9} {:>10.2f} {:>10.2f}'.format(
+                count, name, len(response), len(gzip_compress(response)),
+                encode_time * 1000, decode_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Benchmarks gzip encoding of /api/sync payloads.
+
+For each payload size, reports the raw and gzip-encoded sizes, the time to
+compress and decompress, and the net latency that is saved on links of
+various speeds, after the compression and decompression time is subtracted.
+
+Usage::
+
+    APPENGINE_SDK=/path/to/google_appengine python benchmarks/compression.py
+"""
+
+from __future__ import division, print_function, unicode_literals
+import json
+import timeit
+
+import environment
+environment.setup_paths()
+
+from payloads import make_notes
+from spidernotes.compression import gzip_compress, gzip_decompress
+
+
+_NOTE_COUNTS = (10, 100, 1000, 10000)
+
+# Name and bandwidth, in bits per second, of each simulated link.
+_LINKS = (('3g', 384000), ('dsl', 1500000), ('wifi', 10000000))
+
+
+def _time(func, number):
+    return min(timeit.repeat(func, number=number, repeat=3)) / number
+
+
+def main():
+    print('{:>6} {:>10} {:>9} {:>6} {:>9} {:>9}  {}'.format(
+        'notes', 'raw', 'gzip', 'ratio', 'comp ms', 'decomp ms',
+        '  '.join('{:>9}'.format(name + ' ms') for name, _ in _LINKS)))
+
+    for count in _NOTE_COUNTS:
+        payload = json.dumps({'notes': make_notes(count),
+                              'lastSynchronized': 0},
+                             ensure_ascii=False).encode('UTF8')
+        compressed = gzip_compress(payload)
+        number = max(1, 1000 // count)
+        compress_time = _time(lambda: gzip_compress(payload), number)
+        decompress_time = _time(lambda: gzip_decompress(compressed), number)
+
+        saved = []
+        for _, bandwidth in _LINKS:
+            transfer_saved = (len(payload) - len(compressed)) * 8 / bandwidth
+            saved.append(transfer_saved - compress_time - decompress_time)
+
+        print('{:>6} {:>10} {:>9} {:>6.2f} {:>9.2f} {:>9.2f}  {}'.format(
+            count, len(payload), len(compressed),
+            len(payload) / len(compressed),
+            compress_time * 1000, decompress_time * 1000,
+            '  '.join('{:>9.1f}'.format(s * 1000) for s in saved)))
+
+
+if __name__ == '__main__':
+    main()
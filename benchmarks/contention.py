@@ -0,0 +1,208 @@
+"""
+Benchmarks concurrent synchronizations of the same user by several devices.
+
+Each device is a thread that repeatedly changes random notes from a
+small shared pool, synchronizes them with ``_merge_notes`` from its
+own ``lastSynchronized``, and merges the returned notes into its replica.
+The threads run concurrently, each with its own ndb context, as concurrent
+requests do, so their transactions interleave and conflict against the App
+Engine testbed. Every change has a
+unique modified timestamp, which is skewed as if by the clocks of the
+devices, so the winner of each note is known.
+
+For each number of devices, reports the number of synchronizations, the
+number of transactions that were retried because of a conflict, the p50 and
+p99 latency of a synchronization, and checks that:
+
+* ``lost``: no note was overwritten by an older change, and
+* ``missed``: after a final synchronization, every device has the winning
+  change of every note.
+
+Usage::
+
+    APPENGINE_SDK=/path/to/google_appengine python benchmarks/contention.py \\
+        [--devices 1,2,4,8] [--rounds N] [--pool N] [--changes N]
+"""
+
+from __future__ import division, print_function, unicode_literals
+import argparse
+import random
+import threading
+import time
+
+import environment
+environment.setup_paths()
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api.datastore_errors import TransactionFailedError
+from google.appengine.ext import ndb
+from google.appengine.ext.ndb.key import Key
+
+from spidernotes.handlers.synchronization import _NoteTuple, _merge_notes
+from spidernotes.models import Note
+from spidernotes.timestamps import EPOCH, from_milliseconds, to_milliseconds
+
+
+_DEFAULT_DEVICES = (1, 2, 4, 8)
+
+# Milliseconds since the epoch after which notes are modified.
+_BASE_TIMESTAMP = 1400000000000
+
+# Maximum skew of the modified timestamps of changes, in changes.
+_MAX_SKEW = 50
+
+# Maximum number of server notes that are returned per synchronization.
+_PAGE_SIZE = 1000
+
+
+class _Counter(object):
+    """Counts datastore transactions with an apiproxy hook."""
+
+    def __init__(self):
+        self.begun = 0
+        self._lock = threading.Lock()
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'benchmark_transaction_counter', self._hook)
+
+    def _hook(self, service, call, request, response):
+        if service == 'datastore_v3' and call == 'BeginTransaction':
+            with self._lock:
+                self.begun += 1
+
+
+class _Scenario(object):
+    """Shared state of the devices of one scenario."""
+
+    def __init__(self, user_key, pool_size, seed):
+        self.user_key = user_key
+        self.note_ids = ['note-{}'.format(i) for i in xrange(pool_size)]
+        self.rng = random.Random(seed)
+        self.clock = 0
+        self.merges = 0
+        self.failures = 0
+        self.latencies = []
+        self.lock = threading.Lock()
+        # Note id to the latest modified timestamp that was written.
+        self.latest = {}
+
+    def change(self, device, note_id):
+        with self.lock:
+            return self._change(device, note_id)
+
+    def _change(self, device, note_id):
+        # Devices' clocks differ, so a change that is synchronized later may
+        # be older. The last digits make every timestamp unique.
+        self.clock += 1
+        skew = self.rng.randint(0, _MAX_SKEW)
+        modified = (_BASE_TIMESTAMP + (self.clock + skew) * 10000 +
+                    self.clock)
+        self.latest[note_id] = max(self.latest.get(note_id, 0), modified)
+        return _NoteTuple(id=note_id,
+                          body='{}:{}'.format(device, self.clock),
+                          url='',
+                          is_deleted=False,
+                          created=from_milliseconds(_BASE_TIMESTAMP),
+                          modified=from_milliseconds(modified))
+
+
+def _sync(scenario, replica, last_synchronized, notes):
+    with scenario.lock:
+        scenario.merges += -(-len(notes) // 100)
+    start = time.time()
+    while True:
+        try:
+            from_server, _, _, last_synchronized = _merge_notes(
+                scenario.user_key, notes, last_synchronized,
+                page_size=_PAGE_SIZE)
+            break
+        except TransactionFailedError:
+            # The client retries a synchronization that failed.
+            with scenario.lock:
+                scenario.failures += 1
+    scenario.latencies.append(time.time() - start)
+    for note in notes + from_server:
+        modified = to_milliseconds(note.modified)
+        note_id = note.id if isinstance(note, _NoteTuple) else note.key.id()
+        replica[note_id] = max(replica.get(note_id, 0), modified)
+    return last_synchronized
+
+
+def _run_device(scenario, device, rounds, changes, results):
+    # Concurrent requests do not share the context's cache of entities.
+    ndb.get_context().set_cache_policy(False)
+    replica = {}
+    last_synchronized = EPOCH
+    for _ in xrange(rounds):
+        with scenario.lock:
+            note_ids = scenario.rng.sample(scenario.note_ids, changes)
+        notes = [scenario.change(device, o) for o in note_ids]
+        last_synchronized = _sync(scenario, replica, last_synchronized, notes)
+    results.append((replica, last_synchronized))
+
+
+def _run(device_count, args, counter):
+    user_key = Key('User', device_count)
+    scenario = _Scenario(user_key, args.pool, seed=device_count)
+    begun = counter.begun
+    start = time.time()
+    results = []
+    threads = [threading.Thread(target=_run_device,
+                                args=(scenario, i, args.rounds, args.changes,
+                                      results))
+               for i in xrange(device_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    retries = counter.begun - begun - scenario.merges
+
+    latencies = sorted(scenario.latencies)
+    stored = {o.key.id(): to_milliseconds(o.modified)
+              for o in Note.query(ancestor=user_key)}
+    lost = sum(1 for k, v in scenario.latest.iteritems() if stored.get(k) != v)
+    missed = 0
+    for replica, last_synchronized in results:
+        _sync(scenario, replica, last_synchronized, [])
+        missed += sum(1 for k, v in stored.iteritems()
+                      if replica.get(k) != v)
+
+    return {
+        'syncs': len(latencies),
+        'retries': retries,
+        'failures': scenario.failures,
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p99_ms': latencies[int(len(latencies) * 0.99)] * 1000,
+        'syncs_per_s': len(latencies) / elapsed,
+        'lost': lost,
+        'missed': missed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--devices', default=','.join(
+        str(o) for o in _DEFAULT_DEVICES), help='numbers of devices')
+    parser.add_argument('--rounds', type=int, default=20,
+                        help='synchronizations per device')
+    parser.add_argument('--pool', type=int, default=50,
+                        help='number of notes that devices change')
+    parser.add_argument('--changes', type=int, default=10,
+                        help='notes changed per synchronization')
+    args = parser.parse_args()
+
+    environment.activate_testbed()
+    counter = _Counter()
+    print('{:>7} {:>6} {:>8} {:>8} {:>8} {:>8} {:>8} {:>5} {:>7}'.format(
+        'devices', 'syncs', 'retries', 'failures', 'p50 ms', 'p99 ms',
+        'syncs/s', 'lost', 'missed'))
+    for device_count in (int(o) for o in args.devices.split(',')):
+        result = _run(device_count, args, counter)
+        print('{:>7} {syncs:>6} {retries:>8} {failures:>8} {p50_ms:>8.1f} '
+              '{p99_ms:>8.1f} '
+              '{syncs_per_s:>8.1f} {lost:>5} {missed:>7}'.format(
+                  device_count, **result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""
+Provides an in-process App Engine environment for benchmarks.
+
+The App Engine SDK is located with the ``APPENGINE_SDK`` environment variable,
+or else it must already be importable. ``src/spidernotes/secrets.py`` must
+exist; copy it from ``secrets.py.example`` if necessary.
+"""
+
+from __future__ import unicode_literals
+import os
+import resource
+import sys
+from collections import defaultdict
+
+
+# Working directory from which the benchmark was started.
+ORIGINAL_CWD = os.getcwd()
+
+# The application is found on ``sys.path`` as it is by the tests.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'tests'))
+from support import SRC_DIR, setup_paths
+
+
+def activate_testbed():
+    """
+    Activate and return a :class:`google.appengine.ext.testbed.Testbed` with
+    strongly consistent datastore, memcache and task queue stubs.
+
+    Tasks are executed in-process rather than by the task queue stub.
+    """
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import ndb, testbed
+    from spidernotes import tasks
+
+    bed = testbed.Testbed()
+    bed.activate()
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+    bed.init_datastore_v3_stub(consistency_policy=policy)
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=SRC_DIR)
+    bed.init_urlfetch_stub()
+    ndb.get_context().clear_cache()
+    tasks.set_executor(tasks.InProcessExecutor())
+    return bed
+
+
+def run_tasks():
+    """
+    Run the tasks that were enqueued with the in-process executor. This may
+    be called from several threads.
+
+    :return: Number of tasks that were executed.
+    :rtype: ``int``
+    """
+    from spidernotes import tasks
+    return tasks.run_pending()
+
+
+class RpcCounter(object):
+    """
+    Counts the API calls that are made, by service, while it is active.
+
+    Usage::
+
+        with RpcCounter() as counter:
+            ...
+        counter.counts['datastore_v3']
+    """
+
+    # Counters that are active, which are shared by one hook per stub map.
+    _active = []
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+
+    def __enter__(self):
+        from google.appengine.api import apiproxy_stub_map
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'benchmark_rpc_counter', RpcCounter._hook)
+        self.counts.clear()
+        RpcCounter._active.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        RpcCounter._active.remove(self)
+
+    @staticmethod
+    def _hook(service, call, request, response):
+        for counter in RpcCounter._active:
+            counter.counts[service] += 1
+
+
+def get_peak_memory_kb():
+    """
+    Return the peak resident memory of this process since the last call of
+    :func:`reset_peak_memory`, in kilobytes.
+
+    :rtype: ``int``
+    """
+    try:
+        with open('/proc/self/status') as file_:
+            for line in file_:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def get_memory_kb():
+    """
+    Return the current resident memory of this process, in kilobytes, or
+    ``None`` if it cannot be determined.
+
+    :rtype: ``int`` or ``None``
+    """
+    try:
+        with open('/proc/self/status') as file_:
+            for line in file_:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+
+
+def reset_peak_memory():
+    """
+    Reset the peak resident memory that is reported by
+    :func:`get_peak_memory_kb` to the current resident memory, if the
+    operating system supports it.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as file_:
+            file_.write('5')
+    except IOError:
+        pass
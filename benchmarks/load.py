@@ -0,0 +1,487 @@
+"""
+Generates load against ``/api/sync`` and ``/api/user`` from simulated
+extension clients.
+
+Each simulated user has several devices, which share the user's token. Every
+device polls ``/api/sync`` every 5 minutes, creates, edits and deletes notes
+at random, about every 15 minutes, and synchronizes 2 seconds after each
+change, and fetches ``/api/user`` every hour. The clocks of the devices are
+skewed by up to 5 seconds, so a change that is synchronized later may be
+older. Synchronizations send an ``Idempotency-Key``, and are retried with it
+when the server is unavailable.
+
+The schedules run on a simulated clock, which advances as fast as requests
+are handled, so an hour of traffic from thousands of devices takes minutes.
+The events are handled in order of their simulated times by a pool of worker
+threads, so the requests of a user's devices may be handled concurrently.
+
+By default, requests are sent to ``spidernotes.app`` in-process, with the
+App Engine testbed's datastore and memcache stubs, and the datastore calls
+of each request are counted. With ``--url``, they are sent over HTTP to a
+local development server instead, whose datastore calls are not counted.
+
+Reports the throughput, the latency percentiles and the datastore calls per
+request of each endpoint, the number of transactions that were retried
+because of conflicts (in-process only), the number of responses that were
+``503`` or ``409``, and checks, after a final synchronization of every
+device, that:
+
+* ``lost``: no note was overwritten by an older change, and
+* ``missed``: every device has the latest change of every note.
+
+Usage::
+
+    APPENGINE_SDK=/path/to/google_appengine python benchmarks/load.py \\
+        [--users N] [--devices N] [--duration SECONDS] [--workers N] \\
+        [--seed N] [--url http://localhost:8080] [--output results.json]
+"""
+
+from __future__ import division, print_function, unicode_literals
+import argparse
+import heapq
+import json
+import os
+import random
+import threading
+import time
+import urllib2
+from collections import Counter, OrderedDict, defaultdict
+
+import environment
+
+
+# Number of seconds between polls of ``/api/sync`` by a device.
+_POLL_INTERVAL = 300
+
+# Mean number of seconds between changes to notes by a device.
+_CHANGE_INTERVAL = 900
+
+# Number of seconds after a change at which a device synchronizes it.
+_SYNC_DELAY = 2
+
+# Number of seconds between requests to ``/api/user`` by a device.
+_USER_INTERVAL = 3600
+
+# Maximum skew of the clock of a device, in milliseconds.
+_MAX_SKEW_MS = 5000
+
+# Relative frequencies of the kinds of changes.
+_CHANGE_WEIGHTS = (('create', 50), ('edit', 35), ('delete', 15))
+
+# Maximum number of attempts of a synchronization whose response is 503.
+_MAX_ATTEMPTS = 5
+
+# Milliseconds since the epoch at which the simulated clock starts.
+_BASE_TIMESTAMP = 1400000000000
+
+_WORDS = ('note', 'todo', 'read', 'later', 'recipe', 'price', 'idea',
+          'bug', 'meeting', 'quote', 'review', 'reference')
+
+
+class _WsgiTransport(object):
+    """
+    Sends requests to ``spidernotes.app`` in-process, and counts the
+    datastore calls of each request.
+    """
+
+    def __init__(self):
+        environment.setup_paths()
+        import webtest
+        from google.appengine.api import apiproxy_stub_map
+        from google.appengine.ext import ndb
+        import spidernotes
+
+        environment.activate_testbed()
+        self._app = webtest.TestApp(spidernotes.app)
+        self._ndb = ndb
+        self._local = threading.local()
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'load_rpc_counter', self._hook)
+
+    def request(self, method, path, body=None, headers=None):
+        """
+        Send a request, and return a tuple of its status, its body, and a
+        ``dict`` of the numbers of datastore calls by name.
+        """
+        # Each request starts with an empty context cache, as on App Engine.
+        self._ndb.get_context().clear_cache()
+        counts = self._local.counts = defaultdict(int)
+        response = self._app.request(str(path),
+                                     method=str(method),
+                                     body=body or b'',
+                                     headers=headers or {},
+                                     expect_errors=True)
+        self._local.counts = None
+        # The executor runs the tasks of one worker thread at a time.
+        environment.run_tasks()
+        return response.status_int, response.body, counts
+
+    def _hook(self, service, call, request, response):
+        counts = getattr(self._local, 'counts', None)
+        if counts is not None and service == 'datastore_v3':
+            counts[call] += 1
+
+
+class _HttpTransport(object):
+    """Sends requests over HTTP to a running server."""
+
+    def __init__(self, url):
+        self._url = url.rstrip('/')
+
+    def request(self, method, path, body=None, headers=None):
+        """
+        Send a request, and return a tuple of its status, its body, and
+        ``None``, since the datastore calls of the server are not known.
+        """
+        request = urllib2.Request(self._url + path, data=body,
+                                  headers=headers or {})
+        request.get_method = lambda: str(method)
+        try:
+            response = urllib2.urlopen(request, timeout=60)
+        except urllib2.HTTPError as e:
+            return e.code, e.read(), None
+        return response.getcode(), response.read(), None
+
+
+class _Stats(object):
+    """Statistics of the requests of a run, by endpoint."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.datastore_calls = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def request(self, transport, endpoint, method, path, body=None,
+                headers=None):
+        """Send a request with ``transport``, and record it."""
+        start = time.time()
+        status, response_body, counts = transport.request(method, path, body,
+                                                          headers)
+        latency = time.time() - start
+        with self._lock:
+            self.latencies[endpoint].append(latency)
+            self.statuses[endpoint][status] += 1
+            if counts is not None:
+                self.datastore_calls[endpoint].append(sum(counts.values()))
+                # A transaction that is retried is begun again, but only
+                # committed once.
+                self.retries += max(0, counts['BeginTransaction'] -
+                                    counts['Commit'])
+        return status, response_body
+
+
+class _User(object):
+    """A simulated user, whose devices share its notes."""
+
+    def __init__(self, index, token):
+        self.index = index
+        self.headers = {str('X-Messaging-Token'): str(token),
+                        str('Content-Type'): str('application/json')}
+        self.devices = []
+        # Note id to the latest modified timestamp of any change to it.
+        self.latest = {}
+        self.note_count = 0
+        self.lock = threading.Lock()
+
+
+class _Device(object):
+    """A simulated device of a user, which keeps a replica of its notes."""
+
+    def __init__(self, user, index, rng, start):
+        self.user = user
+        self.index = index
+        self.rng = rng
+        self.skew = rng.randint(-_MAX_SKEW_MS, _MAX_SKEW_MS)
+        self.replica = {}
+        self.pending = {}
+        self.last_synchronized = 0
+        self.next_poll = start
+        self.next_user = start
+        self.next_change = start + rng.expovariate(1 / _CHANGE_INTERVAL)
+        self.sync_due = None
+
+    def get_next_time(self):
+        """Return the simulated time of the next event of this device."""
+        times = [self.next_poll, self.next_user, self.next_change]
+        if self.sync_due is not None:
+            times.append(self.sync_due)
+        return min(times)
+
+    def step(self, now, transport, stats):
+        """Handle the events of this device that are due at ``now``."""
+        if self.next_change <= now:
+            self.change(now)
+            self.next_change = now + self.rng.expovariate(
+                1 / _CHANGE_INTERVAL)
+            if self.sync_due is None:
+                self.sync_due = now + _SYNC_DELAY
+        if self.next_user <= now:
+            stats.request(transport, 'user', 'GET', '/api/user',
+                          headers=self.user.headers)
+            self.next_user = now + _USER_INTERVAL
+        if self.next_poll <= now or (self.sync_due is not None and
+                                     self.sync_due <= now):
+            self.sync(transport, stats)
+            self.next_poll = now + _POLL_INTERVAL
+
+    def change(self, now):
+        """Create, edit or delete a note at the simulated time ``now``."""
+        kind = _choose(self.rng, _CHANGE_WEIGHTS)
+        active = [k for k, v in self.replica.iteritems()
+                  if not v['isDeleted']]
+        user = self.user
+        with user.lock:
+            if kind == 'create' or not active:
+                user.note_count += 1
+                note_id = 'note-{}-{}'.format(user.index, user.note_count)
+                note = {'id': note_id, 'url': '', 'isDeleted': False,
+                        'created': None}
+            else:
+                note = dict(self.replica[self.rng.choice(sorted(active))])
+            # Every change to a note has a unique modified timestamp, so
+            # that the latest change is known.
+            modified = int(_BASE_TIMESTAMP + now * 1000 + self.skew)
+            while modified == user.latest.get(note['id']):
+                modified += 1
+            user.latest[note['id']] = max(modified,
+                                          user.latest.get(note['id'], 0))
+        note['modified'] = modified
+        if note['created'] is None:
+            note['created'] = modified
+            note['url'] = 'https://example.com/{}'.format(note['id'])
+        if kind == 'delete':
+            note.update(body='', url='', isDeleted=True)
+        else:
+            note['body'] = ' '.join(self.rng.choice(_WORDS)
+                                    for _ in xrange(self.rng.randint(1, 40)))
+        self.pending[note['id']] = note
+        self.merge(note)
+
+    def merge(self, note):
+        """Merge ``note`` into the replica by last-writer-wins."""
+        current = self.replica.get(note['id'])
+        if current is None or note['modified'] >= current['modified']:
+            self.replica[note['id']] = note
+
+    def sync(self, transport, stats):
+        """Upload the pending changes, and merge the returned notes."""
+        self.sync_due = None
+        body = json.dumps(OrderedDict([
+            ('lastSynchronized', self.last_synchronized),
+            ('notes', self.pending.values())]))
+        headers = dict(self.user.headers)
+        headers[str('Idempotency-Key')] = str('{:032x}'.format(
+            self.rng.getrandbits(128)))
+        for _ in xrange(_MAX_ATTEMPTS):
+            status, response_body = stats.request(
+                transport, 'sync', 'POST', '/api/sync', body, headers)
+            if status != 503:
+                break
+        if status == 409:
+            # Synchronize all of the notes again, as the server requested.
+            self.last_synchronized = 0
+            self.sync_due = 0
+            return
+        if status != 200:
+            return
+        result = json.loads(response_body)
+        self.pending.clear()
+        for note in result['notes']:
+            self.merge(note)
+        self.last_synchronized = result['lastSynchronized']
+
+
+class _Scheduler(object):
+    """Handles the events of devices in order of their simulated times."""
+
+    def __init__(self, devices, duration, transport, stats):
+        self._heap = [(o.get_next_time(), i, o)
+                      for i, o in enumerate(devices)]
+        heapq.heapify(self._heap)
+        self._duration = duration
+        self._transport = transport
+        self._stats = stats
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    def run(self, worker_count):
+        """Handle all of the events with ``worker_count`` threads."""
+        threads = [threading.Thread(target=self._work)
+                   for _ in xrange(worker_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _work(self):
+        condition = self._condition
+        while True:
+            with condition:
+                while not self._heap and self._in_flight:
+                    condition.wait()
+                if not self._heap:
+                    return
+                now, seq, device = heapq.heappop(self._heap)
+                self._in_flight += 1
+            try:
+                device.step(now, self._transport, self._stats)
+            finally:
+                with condition:
+                    self._in_flight -= 1
+                    next_time = device.get_next_time()
+                    if next_time < self._duration:
+                        heapq.heappush(self._heap, (next_time, seq, device))
+                    condition.notify_all()
+
+
+def _choose(rng, weights):
+    value = rng.uniform(0, sum(o[1] for o in weights))
+    for name, weight in weights:
+        value -= weight
+        if value <= 0:
+            return name
+    return weights[-1][0]
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    index = int(round(percent / 100 * len(values) + 0.5)) - 1
+    return values[max(0, min(index, len(values) - 1))]
+
+
+def _create_users(transport, args):
+    rng = random.Random(args.seed)
+    users = []
+    for i in xrange(args.users):
+        status, body = transport.request('GET', '/api/user')[:2]
+        if status != 200:
+            raise RuntimeError('Could not create a user: {}'.format(status))
+        user = _User(i, json.loads(body)['token'])
+        for j in xrange(args.devices):
+            device_rng = random.Random(rng.getrandbits(64))
+            start = device_rng.uniform(0, _POLL_INTERVAL)
+            user.devices.append(_Device(user, j, device_rng, start))
+        users.append(user)
+    return users
+
+
+def _check(users, transport, stats):
+    """
+    Synchronize every device twice, so that each has the others' changes,
+    and return the numbers of lost and missed changes.
+    """
+    for _ in xrange(2):
+        for user in users:
+            for device in user.devices:
+                device.sync(transport, stats)
+
+    lost = missed = 0
+    for user in users:
+        status, body = transport.request('GET', '/api/export',
+                                         headers=user.headers)[:2]
+        server = {o['id']: o['modified']
+                  for o in (json.loads(line) for line in body.splitlines())}
+        lost += sum(1 for k, v in user.latest.iteritems()
+                    if server.get(k) != v)
+        for device in user.devices:
+            missed += sum(
+                1 for k, v in server.iteritems()
+                if device.replica.get(k, {}).get('modified') != v)
+    return lost, missed
+
+
+def _summarize(stats, elapsed, args):
+    endpoints = OrderedDict()
+    for endpoint in sorted(stats.latencies):
+        latencies = [o * 1000 for o in stats.latencies[endpoint]]
+        calls = stats.datastore_calls[endpoint]
+        statuses = stats.statuses[endpoint]
+        endpoints[endpoint] = OrderedDict([
+            ('requests', len(latencies)),
+            ('errors', sum(v for k, v in statuses.iteritems() if k >= 400)),
+            ('statuses', {str(k): v for k, v in statuses.iteritems()}),
+            ('per_s', round(len(latencies) / elapsed, 1)),
+            ('p50_ms', round(_percentile(latencies, 50), 2)),
+            ('p90_ms', round(_percentile(latencies, 90), 2)),
+            ('p99_ms', round(_percentile(latencies, 99), 2)),
+            ('ds_calls_mean',
+             round(sum(calls) / len(calls), 2) if calls else None),
+            ('ds_calls_p99', _percentile(calls, 99) if calls else None),
+        ])
+    requests = sum(o['requests'] for o in endpoints.itervalues())
+    return OrderedDict([
+        ('users', args.users),
+        ('devices', args.users * args.devices),
+        ('simulated_s', args.duration),
+        ('workers', args.workers),
+        ('elapsed_s', round(elapsed, 2)),
+        ('requests', requests),
+        ('requests_per_s', round(requests / elapsed, 1)),
+        ('retried_transactions',
+         stats.retries if stats.datastore_calls else None),
+        ('unavailable', sum(o[503] for o in stats.statuses.itervalues())),
+        ('resyncs', stats.statuses['sync'][409]),
+        ('endpoints', endpoints),
+    ])
+
+
+def _print_summary(summary):
+    print('{users} users, {devices} devices, {simulated_s} simulated s in '
+          '{elapsed_s} s with {workers} workers: {requests} requests, '
+          '{requests_per_s} requests/s'.format(**summary))
+    print()
+    print('{:<8} {:>8} {:>7} {:>8} {:>8} {:>8} {:>8} {:>9} {:>8}'.format(
+        'endpoint', 'requests', 'errors', 'per s', 'p50 ms', 'p90 ms',
+        'p99 ms', 'ds calls', 'ds p99'))
+    for name, endpoint in summary['endpoints'].iteritems():
+        print('{:<8} {requests:>8} {errors:>7} {per_s:>8} {p50_ms:>8} '
+              '{p90_ms:>8} {p99_ms:>8} {:>9} {:>8}'.format(
+                  name, endpoint['ds_calls_mean'], endpoint['ds_calls_p99'],
+                  **endpoint))
+    print()
+    print('retried transactions {retried_transactions}, unavailable '
+          '{unavailable}, resyncs {resyncs}, lost {lost}, missed '
+          '{missed}'.format(**summary))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=100,
+                        help='number of users')
+    parser.add_argument('--devices', type=int, default=3,
+                        help='devices per user')
+    parser.add_argument('--duration', type=int, default=3600,
+                        help='simulated seconds')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='number of concurrent requests')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the random number generator')
+    parser.add_argument('--url', help='url of a server, rather than '
+                        'sending requests in-process')
+    parser.add_argument('--output', help='path of a json results file')
+    args = parser.parse_args()
+
+    transport = _HttpTransport(args.url) if args.url else _WsgiTransport()
+    users = _create_users(transport, args)
+    stats = _Stats()
+    scheduler = _Scheduler([o for u in users for o in u.devices],
+                           args.duration, transport, stats)
+    start = time.time()
+    scheduler.run(args.workers)
+    elapsed = time.time() - start
+
+    summary = _summarize(stats, elapsed, args)
+    summary['lost'], summary['missed'] = _check(users, transport, _Stats())
+    _print_summary(summary)
+
+    if args.output:
+        with open(os.path.join(environment.ORIGINAL_CWD, args.output),
+                  'w') as file_:
+            json.dump(summary, file_, indent=2)
+        print('\nWrote {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Provides generators of realistic note payloads for benchmarks.
+"""
+
+from __future__ import unicode_literals
+import random
+
+
+_WORDS = (
+    'the of and to in is you that it he was for on are as with his they at '
+    'be this have from or one had by word but not what all were we when your '
+    'can said there use an each which she do how their if will up other about '
+    'out many then them these so some her would make like him into time has '
+    'look two more write go see number no way could people my than first '
+    'water been call who oil its now find long down day did get come made may '
+    'part recipe article review todo remember read later price compare bug '
+    'meeting deadline reference quote important idea follow-up'
+).split()
+
+_HOSTS = (
+    'en.wikipedia.org', 'news.ycombinator.com', 'github.com',
+    'stackoverflow.com', 'www.nytimes.com', 'docs.python.org',
+    'www.reddit.com', 'medium.com', 'www.amazon.com', 'www.youtube.com',
+)
+
+# Milliseconds since the epoch around which timestamps are generated.
+_BASE_TIMESTAMP = 1400000000000
+
+
+def make_note(rng, index):
+    """
+    Return a ``dict`` representation of a note, in the format that is sent by
+    the client.
+
+    :param random.Random rng: Random number generator.
+    :param int index: Index of the note, which is used to derive its id.
+    :rtype: ``dict``
+    """
+    created = _BASE_TIMESTAMP + rng.randint(0, 10 ** 10)
+    body = ' '.join(rng.choice(_WORDS)
+                    for _ in xrange(int(rng.expovariate(1 / 40.0)) + 1))
+    path = '/'.join(rng.choice(_WORDS) for _ in xrange(rng.randint(1, 4)))
+    return {'id': '{:064x}'.format(rng.getrandbits(256) ^ index),
+            'body': body,
+            'url': 'https://{}/{}'.format(rng.choice(_HOSTS), path),
+            'isDeleted': False,
+            'created': created,
+            'modified': created + rng.randint(0, 10 ** 8)}
+
+
+def make_notes(count, seed=0):
+    """
+    Return a ``list`` of ``count`` note ``dict`` objects.
+
+    :param int count: Number of notes to generate.
+    :param int seed: Seed of the random number generator, so that runs are
+        reproducible.
+    :rtype: ``list``
+    """
+    rng = random.Random(seed)
+    return [make_note(rng, i) for i in xrange(count)]
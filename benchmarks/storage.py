@@ -0,0 +1,146 @@
+"""
+Benchmarks the synchronization engine with each storage of notes.
+
+Runs :func:`spidernotes.handlers.synchronization._merge_notes` in-process
+against:
+
+* ``ndb``: :class:`spidernotes.storage.NdbStorage`, with the datastore and
+  memcache stubs of the App Engine testbed.
+* ``memory``: :class:`spidernotes.storage.MemoryStorage`.
+* ``sqlite``: :class:`spidernotes.storage.SqliteStorage`, in a temporary
+  file.
+
+and reports the wall time of each scenario:
+
+* ``upload``: a new device uploads all of the notes, in batches of 1000.
+* ``incremental``: a device uploads 10 changes and downloads 10 changes that
+  were made by another device, repeated 10 times.
+* ``download``: a new device downloads all of the notes in pages of 500.
+
+Usage::
+
+    APPENGINE_SDK=/path/to/google_appengine python benchmarks/storage.py \\
+        [--notes N] [--backends ndb,memory,sqlite]
+"""
+
+from __future__ import division, print_function, unicode_literals
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+
+import environment
+environment.setup_paths()
+
+from google.appengine.ext.ndb.key import Key
+
+from payloads import make_notes
+from spidernotes.handlers.synchronization import _merge_notes, _to_tuple
+from spidernotes.storage import (
+    MemoryStorage, NdbStorage, SqliteStorage, set_storage)
+from spidernotes.timestamps import EPOCH
+from spidernotes.utils import iter_batches
+
+
+_DEFAULT_NOTE_COUNT = 10000
+
+_BACKENDS = ('ndb', 'memory', 'sqlite')
+
+# Maximum number of notes that a client uploads per request.
+_UPLOAD_BATCH_SIZE = 1000
+
+# Number of server notes that are downloaded per page.
+_PAGE_SIZE = 500
+
+# Number of notes that are changed per device by ``incremental``.
+_CHANGE_COUNT = 10
+
+# Number of synchronizations that are timed by ``incremental``.
+_INCREMENTAL_ITERATIONS = 10
+
+
+def _create_storage(name, directory):
+    if name == 'ndb':
+        return NdbStorage()
+    if name == 'memory':
+        return MemoryStorage()
+    return SqliteStorage(os.path.join(directory, 'notes.db'))
+
+
+def _sync(user_key, last_synchronized, notes=()):
+    from_server, _, _, synchronized = _merge_notes(
+        user_key, iter(notes), last_synchronized)
+    return list(from_server), synchronized
+
+
+def _upload(user_key, notes):
+    for batch in iter_batches(notes, _UPLOAD_BATCH_SIZE):
+        _sync(user_key, EPOCH, batch)
+
+
+def _incremental(user_key, notes, last_synchronized):
+    other_last_synchronized = last_synchronized
+    for i in xrange(_INCREMENTAL_ITERATIONS):
+        start = 2 * i * _CHANGE_COUNT
+        changed = [_edit(notes[(start + j) % len(notes)], i + 1)
+                   for j in xrange(2 * _CHANGE_COUNT)]
+        _, other_last_synchronized = _sync(
+            user_key, other_last_synchronized, changed[_CHANGE_COUNT:])
+        _, last_synchronized = _sync(user_key, last_synchronized,
+                                     changed[:_CHANGE_COUNT])
+
+
+def _download(user_key):
+    count = 0
+    until, cursor, has_more = None, None, True
+    while has_more:
+        from_server, cursor, has_more, until = _merge_notes(
+            user_key, iter(()), EPOCH, until, _PAGE_SIZE, cursor)
+        count += len(from_server)
+    return count
+
+
+def _edit(note, delta_ms):
+    modified = note.modified + timedelta(milliseconds=delta_ms)
+    return note._replace(body=note.body + ' (edited)', modified=modified)
+
+
+def _time(func, *args):
+    started = time.time()
+    func(*args)
+    return (time.time() - started) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--notes', type=int, default=_DEFAULT_NOTE_COUNT,
+                        help='number of notes')
+    parser.add_argument('--backends', default=','.join(_BACKENDS),
+                        help='comma-separated storages of notes')
+    args = parser.parse_args()
+
+    environment.activate_testbed()
+    notes = [_to_tuple(o) for o in make_notes(args.notes)]
+    directory = tempfile.mkdtemp()
+    print('Synchronization of {} notes'.format(args.notes))
+    print('{:>8} {:>11} {:>14} {:>13}'.format(
+        'storage', 'upload ms', 'incremental ms', 'download ms'))
+    try:
+        for i, name in enumerate(args.backends.split(',')):
+            set_storage(_create_storage(name, directory))
+            user_key = Key('User', i + 1)
+            upload_ms = _time(_upload, user_key, notes)
+            _, last_synchronized = _sync(user_key, EPOCH)
+            incremental_ms = _time(_incremental, user_key, notes,
+                                   last_synchronized)
+            download_ms = _time(_download, user_key)
+            print('{:>8} {:>11.1f} {:>14.1f} {:>13.1f}'.format(
+                name, upload_ms, incremental_ms, download_ms))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
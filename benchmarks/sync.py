@@ -0,0 +1,334 @@
+"""
+Benchmarks the synchronization engine against the App Engine testbed.
+
+Drives ``spidernotes.app`` in-process with WebTest, using the datastore and
+memcache stubs, for users with each of the given numbers of notes. Each
+scenario runs in a forked process with a fresh datastore, and reports the p50
+and p99 latency, the median number of datastore and memcache calls, and the
+peak memory growth per iteration. Results are written to a json file, and can
+be compared with the results of a previous run.
+
+Scenarios:
+
+* ``first_sync``: a new device downloads all of the notes.
+* ``incremental_sync``: a device uploads 10 changes and downloads 10 changes
+  that were made by another device.
+* ``bulk_upload``: a new user uploads all of the notes.
+* ``account_merge``: a user with the notes connects to an existing Social
+  Login user with as many notes, half of which conflict.
+
+Usage::
+
+    APPENGINE_SDK=/path/to/google_appengine python benchmarks/sync.py \\
+        [--sizes 10,1000,10000,100000] [--iterations N] \\
+        [--output results.json] [--compare baseline.json]
+"""
+
+from __future__ import division, print_function, unicode_literals
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import traceback
+from collections import OrderedDict
+from datetime import datetime
+from multiprocessing import Pipe, Process
+
+import environment
+environment.setup_paths()
+
+import webtest
+from google.appengine.ext import ndb
+from webapp2_extras.appengine.auth.models import User
+
+import spidernotes
+from payloads import make_notes
+from spidernotes.handlers.synchronization import _to_tuple
+from spidernotes.models import Note
+from spidernotes.users import connect_user, create_token, create_user
+from spidernotes.utils import iter_batches
+
+
+_DEFAULT_SIZES = (10, 1000, 10000, 100000)
+
+_RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'results')
+
+# Maximum number of notes that a client uploads per request.
+_UPLOAD_BATCH_SIZE = 1000
+
+# Number of notes that are changed per device by ``incremental_sync``.
+_CHANGE_COUNT = 10
+
+
+class _Client(object):
+    """Simulates a device that synchronizes the notes of a user."""
+
+    def __init__(self, app, user):
+        self._app = app
+        self._headers = {str('X-Messaging-Token'): str(create_token(user))}
+        self.last_synchronized = 0
+
+    def sync(self, notes=()):
+        """
+        Upload ``notes``, download the notes that changed since the last
+        synchronization, and return them.
+        """
+        body = json.dumps(OrderedDict([
+            ('lastSynchronized', self.last_synchronized),
+            ('notes', list(notes))]))
+        response = self._app.post(str('/api/sync'), body,
+                                  headers=self._headers)
+        result = json.loads(response.body)
+        self.last_synchronized = result['lastSynchronized']
+        return result['notes']
+
+
+def _create_user(auth_id=None):
+    user = create_user(User)
+    if auth_id:
+        user.add_auth_id(auth_id)
+        user.put()
+    return user
+
+
+def _seed_notes(user_key, notes):
+    synchronized = datetime.utcnow()
+    for batch in iter_batches(notes, 500):
+        entities = []
+        for note_dict in batch:
+            entity = Note(parent=user_key, id=note_dict['id'])
+            entity.update_from_note(_to_tuple(note_dict), synchronized)
+            entities.append(entity)
+        ndb.put_multi(entities)
+
+
+def _edit(note_dict, delta_ms):
+    note_dict = dict(note_dict)
+    note_dict['body'] += ' (edited)'
+    note_dict['modified'] += delta_ms
+    return note_dict
+
+
+def _first_sync(app, size, iterations, measure):
+    user = _create_user()
+    _seed_notes(user.key, make_notes(size))
+    for _ in xrange(iterations):
+        measure(lambda: _Client(app, user).sync())
+
+
+def _incremental_sync(app, size, iterations, measure):
+    notes = make_notes(size)
+    user = _create_user()
+    _seed_notes(user.key, notes)
+    client, other_client = _Client(app, user), _Client(app, user)
+    client.sync()
+    other_client.sync()
+
+    for i in xrange(iterations):
+        start = 2 * i * _CHANGE_COUNT
+        changed = [_edit(notes[(start + j) % size], i + 1)
+                   for j in xrange(2 * _CHANGE_COUNT)]
+        other_client.sync(changed[_CHANGE_COUNT:])
+        measure(lambda: client.sync(changed[:_CHANGE_COUNT]))
+
+
+def _bulk_upload(app, size, iterations, measure):
+    notes = make_notes(size)
+
+    def upload(client):
+        for batch in iter_batches(notes, _UPLOAD_BATCH_SIZE):
+            client.sync(batch)
+
+    for _ in xrange(iterations):
+        client = _Client(app, _create_user())
+        measure(lambda: upload(client))
+
+
+def _account_merge(app, size, iterations, measure):
+    target_notes = make_notes(size)
+    target = _create_user('bench:target')
+    _seed_notes(target.key, target_notes)
+    data = {'provider': 'bench', 'id': 'target'}
+
+    for i in xrange(iterations):
+        # Half of the notes conflict with the target's notes.
+        notes = ([_edit(o, 1) for o in target_notes[:size // 2]] +
+                 make_notes(size - size // 2, seed=i + 1))
+        source = _create_user()
+        _seed_notes(source.key, notes)
+
+        def merge():
+            connect_user(source, data).put()
+            environment.run_tasks()
+
+        measure(merge)
+
+
+_SCENARIOS = OrderedDict([
+    ('first_sync', _first_sync),
+    ('incremental_sync', _incremental_sync),
+    ('bulk_upload', _bulk_upload),
+    ('account_merge', _account_merge),
+])
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    index = int(round(percent / 100 * len(values) + 0.5)) - 1
+    return values[max(0, min(index, len(values) - 1))]
+
+
+def _run_scenario(name, size, iterations, connection):
+    """
+    Run a scenario in a forked process and send its result, or a ``dict``
+    with an ``error`` traceback if it fails.
+    """
+    try:
+        connection.send(_measure_scenario(name, size, iterations))
+    except Exception:
+        connection.send({'error': traceback.format_exc()})
+    finally:
+        connection.close()
+
+
+def _measure_scenario(name, size, iterations):
+    environment.activate_testbed()
+    app = webtest.TestApp(spidernotes.app)
+    samples = []
+
+    def measure(func):
+        ndb.get_context().clear_cache()
+        baseline_kb = environment.get_memory_kb()
+        environment.reset_peak_memory()
+        with environment.RpcCounter() as counter:
+            start = time.time()
+            func()
+            latency = time.time() - start
+        samples.append({
+            'latency': latency,
+            'datastore_rpcs': counter.counts['datastore_v3'],
+            'memcache_rpcs': counter.counts['memcache'],
+            'peak_memory_kb': environment.get_peak_memory_kb() - baseline_kb})
+
+    _SCENARIOS[name](app, size, iterations, measure)
+
+    latencies = [o['latency'] * 1000 for o in samples]
+    return OrderedDict([
+        ('scenario', name),
+        ('notes', size),
+        ('iterations', len(samples)),
+        ('p50_ms', round(_percentile(latencies, 50), 2)),
+        ('p99_ms', round(_percentile(latencies, 99), 2)),
+        ('datastore_rpcs', _percentile(
+            [o['datastore_rpcs'] for o in samples], 50)),
+        ('memcache_rpcs', _percentile(
+            [o['memcache_rpcs'] for o in samples], 50)),
+        ('peak_memory_kb', max(o['peak_memory_kb'] for o in samples)),
+    ])
+
+
+def _get_iterations(size):
+    return max(3, min(20, 20000 // size))
+
+
+def _get_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _compare(results, baseline_path):
+    with open(baseline_path) as file_:
+        baseline = {(o['scenario'], o['notes']): o
+                    for o in json.load(file_)['results']}
+
+    print('\nChange from {}:'.format(baseline_path))
+    for result in results:
+        previous = baseline.get((result['scenario'], result['notes']))
+        if not previous:
+            continue
+        changes = []
+        for key in ('p50_ms', 'p99_ms', 'datastore_rpcs', 'peak_memory_kb'):
+            if previous[key]:
+                changes.append('{} {:+.1f}%'.format(
+                    key, (result[key] - previous[key]) / previous[key] * 100))
+        print('{:<18} {:>7}  {}'.format(result['scenario'], result['notes'],
+                                        '  '.join(changes)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes',
+                        default=','.join(str(o) for o in _DEFAULT_SIZES),
+                        help='Comma-separated numbers of notes per user.')
+    parser.add_argument('--scenarios', default=','.join(_SCENARIOS),
+                        help='Comma-separated names of scenarios to run.')
+    parser.add_argument('--iterations', type=int,
+                        help='Number of iterations of each scenario.')
+    parser.add_argument('--output', help='Path of the json results file.')
+    parser.add_argument('--compare', help='Path of a previous results file.')
+    args = parser.parse_args()
+
+    results = []
+    failures = 0
+    print('{:<18} {:>7} {:>5} {:>10} {:>10} {:>9} {:>9} {:>10}'.format(
+        'scenario', 'notes', 'iter', 'p50 ms', 'p99 ms', 'ds rpcs',
+        'mc rpcs', 'peak kb'))
+    for size in (int(o) for o in args.sizes.split(',')):
+        for name in args.scenarios.split(','):
+            receiver, sender = Pipe(duplex=False)
+            process = Process(
+                target=_run_scenario,
+                args=(name, size, args.iterations or _get_iterations(size),
+                      sender))
+            process.start()
+            # Close the parent's copy of the sending end, so that ``recv``
+            # raises ``EOFError`` if the child exits without sending.
+            sender.close()
+            try:
+                result = receiver.recv()
+            except EOFError:
+                result = {'error': 'Exited without a result'}
+            process.join()
+            if process.exitcode or 'error' in result:
+                failures += 1
+                print('{:<18} {:>7} failed with exit code {}:\n{}'.format(
+                    name, size, process.exitcode, result.get('error')),
+                    file=sys.stderr)
+                continue
+            results.append(result)
+            print('{scenario:<18} {notes:>7} {iterations:>5} {p50_ms:>10} '
+                  '{p99_ms:>10} {datastore_rpcs:>9} {memcache_rpcs:>9} '
+                  '{peak_memory_kb:>10}'.format(**result))
+
+    if args.output:
+        output = os.path.join(environment.ORIGINAL_CWD, args.output)
+    else:
+        output = os.path.join(_RESULTS_DIR, 'sync-{}.json'.format(
+            datetime.utcnow().strftime('%Y%m%d-%H%M%S')))
+    if not os.path.isdir(os.path.dirname(os.path.abspath(output))):
+        os.makedirs(os.path.dirname(os.path.abspath(output)))
+    with open(output, 'w') as file_:
+        json.dump(OrderedDict([
+            ('timestamp', datetime.utcnow().isoformat()),
+            ('revision', _get_revision()),
+            ('python', platform.python_version()),
+            ('results', results),
+        ]), file_, indent=2)
+    print('\nWrote {}'.format(output))
+
+    if args.compare:
+        _compare(results, os.path.join(environment.ORIGINAL_CWD,
+                                       args.compare))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
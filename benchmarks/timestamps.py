@@ -0,0 +1,129 @@
+"""
+Benchmarks the conversions between datetimes and JavaScript timestamps.
+
+Reports the CPU time to serialize the ``created`` and ``modified``
+timestamps of 100,000 notes, and their complete ``Note.to_dict``
+representations, with:
+
+* ``legacy``: the ``time.mktime`` conversion that was used before
+  :mod:`spidernotes.timestamps`.
+* ``converted``: :func:`spidernotes.timestamps.to_milliseconds`, as is done
+  for notes that have not been put since ``created_ms`` and ``modified_ms``
+  were introduced.
+* ``stored``: the stored ``created_ms`` and ``modified_ms`` properties.
+
+and the CPU time to parse the timestamps of 100,000 client notes with the
+legacy ``datetime.utcfromtimestamp`` conversion, and with
+:func:`spidernotes.timestamps.from_milliseconds`.
+
+Usage::
+
+    APPENGINE_SDK=/path/to/google_appengine python benchmarks/timestamps.py \\
+        [--notes N]
+"""
+
+from __future__ import division, print_function, unicode_literals
+import argparse
+import time
+import timeit
+from datetime import datetime
+
+import environment
+environment.setup_paths()
+
+from google.appengine.ext.ndb.key import Key
+
+from payloads import make_notes
+from spidernotes.handlers.synchronization import _to_tuple
+from spidernotes.models import Note
+from spidernotes.timestamps import from_milliseconds, to_milliseconds
+
+
+_DEFAULT_NOTE_COUNT = 100000
+
+
+def _legacy_from_timestamp(timestamp):
+    timestamp = float(timestamp) / 1000.0
+    return datetime.utcfromtimestamp(timestamp)
+
+
+def _legacy_to_timestamp(dt):
+    ms = time.mktime(dt.timetuple()) * 1000
+    mc = dt.microsecond / 1000.0
+    return ms + mc
+
+
+def _legacy_to_dict(note):
+    is_deleted = note.is_deleted
+    return {'id': note.key.id(),
+            'body': note.body if not is_deleted else '',
+            'url': note.url if not is_deleted else '',
+            'isDeleted': is_deleted,
+            'created': _legacy_to_timestamp(note.created),
+            'modified': _legacy_to_timestamp(note.modified)}
+
+
+def _make_entities(note_dicts, is_stored):
+    user_key = Key('User', 1)
+    synchronized = datetime.utcnow()
+    entities = []
+    for note_dict in note_dicts:
+        entity = Note(parent=user_key, id=note_dict['id'])
+        entity.update_from_note(_to_tuple(note_dict), synchronized)
+        if is_stored:
+            # Set the stored timestamps, as a put would.
+            entity._pre_put_hook()
+        entities.append(entity)
+    return entities
+
+
+def _time(func):
+    # ``time.clock`` measures CPU time on Unix.
+    return min(timeit.repeat(func, number=1, repeat=3, timer=time.clock))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--notes', type=int, default=_DEFAULT_NOTE_COUNT,
+                        help='number of notes')
+    args = parser.parse_args()
+
+    note_dicts = make_notes(args.notes)
+    converted = _make_entities(note_dicts, is_stored=False)
+    stored = _make_entities(note_dicts, is_stored=True)
+
+    serializers = [
+        ('legacy',
+         lambda: [(_legacy_to_timestamp(o.created),
+                   _legacy_to_timestamp(o.modified)) for o in converted],
+         lambda: [_legacy_to_dict(o) for o in converted]),
+        ('converted',
+         lambda: [(to_milliseconds(o.created), to_milliseconds(o.modified))
+                  for o in converted],
+         lambda: [o.to_dict() for o in converted]),
+        ('stored',
+         lambda: [(o.get_created_ms(), o.get_modified_ms()) for o in stored],
+         lambda: [o.to_dict() for o in stored]),
+    ]
+    print('Serialization of {} notes'.format(args.notes))
+    print('{:>10} {:>14} {:>12}'.format('method', 'timestamps ms',
+                                        'to_dict ms'))
+    for name, timestamps, to_dict in serializers:
+        print('{:>10} {:>14.1f} {:>12.1f}'.format(
+            name, _time(timestamps) * 1000, _time(to_dict) * 1000))
+
+    timestamps = [o['modified'] for o in note_dicts]
+    parsers = [
+        ('legacy', _legacy_from_timestamp),
+        ('integer', from_milliseconds),
+    ]
+    print()
+    print('Parsing of {} timestamps'.format(len(timestamps)))
+    print('{:>10} {:>14}'.format('method', 'parse ms'))
+    for name, parse in parsers:
+        print('{:>10} {:>14.1f}'.format(
+            name, _time(lambda: [parse(o) for o in timestamps]) * 1000))
+
+
+if __name__ == '__main__':
+    main()
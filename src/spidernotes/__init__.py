@@ -3,15 +3,31 @@ from __future__ import unicode_literals
 from webapp2 import Route, WSGIApplication
 
 from secrets import SESSION_KEY
-from spidernotes.handlers import DefaultHandler, handle_404, handle_500
-from spidernotes.handlers.authentication import AuthHandler
-from spidernotes.handlers.synchronization import SynchronizationHandler
+from spidernotes.handlers import (
+    DefaultHandler, WarmupHandler, handle_404, handle_500)
+from spidernotes.handlers.admin import (
+    IndexNotesHandler, MetricsHandler, PurgeDeletedNotesHandler)
+from spidernotes.handlers.notes import NotesHandler, UrlFilterHandler
+from spidernotes.handlers.synchronization import (
+    ExportHandler, ImportHandler, ReconciliationHandler,
+    SynchronizationHandler)
 from spidernotes.handlers.users import DisconnectHandler, UserHandler
 
 
+# The ``/auth`` routes reference their handlers by string, so that the
+# Social Login libraries are only imported when one of them is dispatched.
 routes = [
+    ('/_ah/warmup', WarmupHandler),
+    ('/admin/index-notes', IndexNotesHandler),
+    ('/admin/metrics', MetricsHandler),
+    ('/admin/purge-deleted-notes', PurgeDeletedNotesHandler),
     ('/api/disconnect', DisconnectHandler),
+    ('/api/export', ExportHandler),
+    ('/api/import', ImportHandler),
+    ('/api/notes', NotesHandler),
+    ('/api/reconcile', ReconciliationHandler),
     ('/api/sync', SynchronizationHandler),
+    ('/api/url-filter', UrlFilterHandler),
     ('/api/user', UserHandler),
     Route(
         '/auth/<provider>',
@@ -0,0 +1,73 @@
+"""
+Provides a Bloom filter of note url keys, which clients can query without
+the server.
+
+A url key is the hexadecimal SHA-1 digest of a normalized url, as computed
+by :meth:`spidernotes.models.Note.compute_url_keys`. The ``i``-th of the
+``hash_count`` bit positions of a url key is ``(h1 + i * h2) % bit_count``,
+where ``h1`` is the integer value of the first 8 hexadecimal digits of the
+url key, and ``h2`` is that of the next 8 digits with its lowest bit set.
+Bit ``n`` is the bit with value ``1 << (n % 8)`` of byte ``n // 8``.
+"""
+
+from __future__ import division, unicode_literals
+import math
+
+
+# Rate of false positives of a filter that holds its capacity of url keys.
+_FALSE_POSITIVE_RATE = 0.01
+
+
+class BloomFilter(object):
+    """Bloom filter of url keys."""
+
+    def __init__(self, bit_count, hash_count, bits=None):
+        """
+        :param int bit_count: Number of bits, which is a multiple of 8.
+        :param int hash_count: Number of bit positions per url key.
+        :param str bits: Bytes of an existing filter, or ``None`` for an empty
+            filter.
+        """
+        self.bit_count = bit_count
+        self.hash_count = hash_count
+        self._bits = bytearray(bits or bit_count // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity):
+        """
+        Return an empty filter whose size is optimal for ``capacity`` url
+        keys.
+
+        :param int capacity: Number of url keys that the filter is to hold.
+        :rtype: :class:`BloomFilter`
+        """
+        bit_count = int(math.ceil(
+            -capacity * math.log(_FALSE_POSITIVE_RATE) / math.log(2) ** 2))
+        bit_count += -bit_count % 8
+        hash_count = max(1, int(round(bit_count / capacity * math.log(2))))
+        return cls(bit_count, hash_count)
+
+    def __contains__(self, url_key):
+        bits = self._bits
+        return all(bits[o // 8] & (1 << (o % 8))
+                   for o in self._positions(url_key))
+
+    def add(self, url_key):
+        """
+        Add ``url_key`` to this filter.
+
+        :param unicode url_key: Url key to add.
+        """
+        bits = self._bits
+        for position in self._positions(url_key):
+            bits[position // 8] |= 1 << (position % 8)
+
+    def to_bytes(self):
+        """Return the bits of this filter as a byte string."""
+        return str(self._bits)
+
+    def _positions(self, url_key):
+        h1 = int(url_key[:8], 16)
+        h2 = int(url_key[8:16], 16) | 1
+        bit_count = self.bit_count
+        return ((h1 + i * h2) % bit_count for i in xrange(self.hash_count))
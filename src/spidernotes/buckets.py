@@ -0,0 +1,107 @@
+"""
+Provides the bucket hashes by which clients reconcile their notes with the
+server without relying on synchronization timestamps.
+
+Notes, including deleted notes, are partitioned into :data:`BUCKET_COUNT`
+buckets by the first two hexadecimal digits of the SHA-1 digest of their
+UTF-8 encoded id. The digest of a note is the SHA-1 digest of its id, its
+modified timestamp in integer milliseconds, ``1`` if it is deleted or else
+``0``, its url and its body, which are UTF-8 encoded and joined by NUL
+characters, where the url and body of a deleted note are empty. The hash of
+a bucket is the bitwise XOR of the digests of its notes, as 40 hexadecimal
+digits, so the hash of an empty bucket is :data:`EMPTY_HASH`.
+
+Because XOR is its own inverse, a bucket hash is updated when a note changes
+by XORing it with the note's old and new digests.
+"""
+
+from __future__ import unicode_literals
+import binascii
+import hashlib
+
+from spidernotes.timestamps import to_milliseconds
+
+
+BUCKET_COUNT = 256
+
+EMPTY_HASH = '0' * 40
+
+# Size of a digest, in bytes.
+_DIGEST_SIZE = 20
+
+
+def get_bucket(note_id):
+    """
+    Return the index of the bucket of the note with the supplied ``note_id``.
+
+    :param unicode note_id: Unique note identifier.
+    :rtype: ``int``
+    """
+    return ord(hashlib.sha1(note_id.encode('UTF8')).digest()[0])
+
+
+def get_bucket_name(bucket):
+    """
+    Return the name of the bucket with the supplied index, which is its two
+    hexadecimal digit prefix.
+
+    :param int bucket: Index of the bucket.
+    :rtype: ``unicode``
+    """
+    return '{:02x}'.format(bucket)
+
+
+def get_digest(note_id, note):
+    """
+    Return the digest of the supplied ``note`` as an integer.
+
+    :param unicode note_id: Unique note identifier.
+    :param note: Note-like object.
+    :rtype: ``long``
+    """
+    is_deleted = note.is_deleted
+    if is_deleted:
+        url = body = ''
+    else:
+        url, body = note.url or '', note.body or ''
+    data = '\x00'.join([note_id,
+                        unicode(to_milliseconds(note.modified)),
+                        '1' if is_deleted else '0',
+                        url,
+                        body])
+    return long(hashlib.sha1(data.encode('UTF8')).hexdigest(), 16)
+
+
+def format_hash(value):
+    """
+    Return the 40 hexadecimal digit representation of a bucket hash.
+
+    :param long value: Bucket hash.
+    :rtype: ``unicode``
+    """
+    return '{:040x}'.format(value)
+
+
+def pack_hashes(hashes):
+    """
+    Return the supplied list of :data:`BUCKET_COUNT` bucket hashes as a
+    byte string.
+
+    :param list hashes: Bucket hashes.
+    :rtype: ``str``
+    """
+    return binascii.unhexlify(''.join(format_hash(o) for o in hashes))
+
+
+def unpack_hashes(data):
+    """
+    Return the list of bucket hashes that is packed in the byte string
+    ``data``, or a list of empty hashes if ``data`` is ``None``.
+
+    :param str data: Bucket hashes that were packed by :func:`pack_hashes`.
+    :rtype: ``list``
+    """
+    if data is None:
+        return [0] * BUCKET_COUNT
+    return [long(binascii.hexlify(data[i:i + _DIGEST_SIZE]), 16)
+            for i in xrange(0, len(data), _DIGEST_SIZE)]
@@ -0,0 +1,85 @@
+"""
+Provides gzip encoding and decoding of HTTP message bodies.
+"""
+
+from __future__ import unicode_literals
+import zlib
+
+
+# ``wbits`` value that selects the gzip container format.
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+_CHUNK_SIZE = 64 * 1024
+
+
+class GzipReader(object):
+    """
+    File-like object that incrementally decompresses the gzip-encoded data
+    that is read from another file-like object.
+    """
+
+    def __init__(self, file_):
+        """
+        :param file_: File-like object from which to read gzip-encoded data.
+        """
+        self._file = file_
+        self._decompressor = zlib.decompressobj(_GZIP_WBITS)
+        self._is_eof = False
+
+    def read(self, size=-1):
+        """
+        Read and return at most ``size`` bytes of decompressed data, or all of
+        the remaining data if ``size`` is negative.
+
+        :param int size: Maximum number of bytes to return.
+        :raises ValueError: If the data is not valid gzip.
+        :rtype: ``str``
+        """
+        if size < 0:
+            return b''.join(iter(lambda: self.read(_CHUNK_SIZE), b''))
+        if size == 0:
+            return b''
+
+        decompressor = self._decompressor
+        while not self._is_eof:
+            data = decompressor.unconsumed_tail
+            if not data:
+                data = self._file.read(_CHUNK_SIZE)
+                if not data:
+                    self._is_eof = True
+                    return decompressor.flush()
+            try:
+                # Bound the output so that a small, highly compressed input
+                # cannot expand into a large amount of memory.
+                result = decompressor.decompress(data, size)
+            except zlib.error as e:
+                raise ValueError('Invalid gzip data: {}'.format(e))
+            if result:
+                return result
+        return b''
+
+
+def gzip_compress(data, level=6):
+    """
+    Return the supplied ``data`` compressed in the gzip format.
+
+    :param str data: Data to compress.
+    :param int level: Compression level from 1 (fastest) to 9 (smallest).
+    :rtype: ``str``
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, _GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def gzip_decompress(data):
+    """
+    Return the supplied gzip-encoded ``data`` decompressed.
+
+    :param str data: Data to decompress.
+    :raises ValueError: If the data is not valid gzip.
+    :rtype: ``str``
+    """
+    try:
+        return zlib.decompress(data, _GZIP_WBITS)
+    except zlib.error as e:
+        raise ValueError('Invalid gzip data: {}'.format(e))
@@ -6,14 +6,42 @@ from google.appengine.ext.db import BadRequestError
 from webapp2 import cached_property, RequestHandler
 from webapp2_extras import auth, sessions, sessions_memcache
 from webapp2_extras.appengine.auth.models import User
+from webob.exc import HTTPException
 
-from spidernotes.utils import read_utf8_file, get_param
+from spidernotes import instrumentation
+from spidernotes.compression import GzipReader, gzip_compress
+from spidernotes.templates import get_static_template
+from spidernotes.users import get_by_token, is_token
+from spidernotes.utils import get_param, iter_json
 
 
 _log = logging.getLogger(__name__)
 
+# Session key of the Social Login data that is saved by
+# :class:`spidernotes.handlers.authentication.AuthHandler`.
+AUTH_SESSION_KEY = 'auth_data'
+
 _AUTH_ID_HEADER_KEY = 'X-Messaging-Token'
 
+# Content type of json.
+JSON_CONTENT_TYPE = 'application/json'
+
+# Content type of the columnar json representation of notes, in which each
+# note is a row of values, as is returned by
+# :meth:`spidernotes.models.Note.to_row`.
+COLUMNS_CONTENT_TYPE = 'application/vnd.spidernotes.columns+json'
+
+# Content type of newline-delimited json, which has one json value per line.
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+
+# Minimum size of a response body, in bytes, for it to be gzip-encoded.
+_GZIP_MIN_SIZE = 1024
+
+# Number of seconds for which clients may cache static templates.
+_STATIC_MAX_AGE = 3600
+
+_HOME_TEMPLATE = 'home.html'
+
 
 class BaseHandler(RequestHandler):
     """
@@ -25,14 +53,42 @@ class BaseHandler(RequestHandler):
         """Return an instance of :class:`webapp2_extras.auth.Auth`."""
         return auth.get_auth()
 
+    @cached_property
+    def body_file(self):
+        """
+        Return a file-like object from which to read the request body, which
+        is transparently decompressed if it is gzip-encoded.
+        """
+        body_file = self.request.body_file
+        if self.request.headers.get('Content-Encoding') == 'gzip':
+            body_file = GzipReader(body_file)
+        return body_file
+
     def dispatch(self):
-        """Dispatch the request."""
-        self.session_store = sessions.get_store(request=self.request)
+        """Dispatch the request, and record its metrics."""
+        route = self.request.route
+        instrumentation.start_request(getattr(route, 'template', None) or
+                                      self.request.path)
+        status = 500
         try:
-            super(BaseHandler, self).dispatch()
+            self.session_store = sessions.get_store(request=self.request)
+            try:
+                super(BaseHandler, self).dispatch()
+                with instrumentation.phase('compress'):
+                    self._compress_response()
+                status = self.response.status_int
+            except HTTPException as e:
+                status = e.code
+                raise
+            finally:
+                # Save all sessions.
+                with instrumentation.phase('save_sessions'):
+                    self.session_store.save_sessions(self.response)
         finally:
-            # Save all sessions.
-            self.session_store.save_sessions(self.response)
+            instrumentation.finish_request(
+                status,
+                self.request.content_length or 0,
+                self.response.content_length or 0)
 
     def get_user(self):
         """
@@ -43,7 +99,12 @@ class BaseHandler(RequestHandler):
         auth_id = get_param(self.request.headers, _AUTH_ID_HEADER_KEY)
         if auth_id:
             try:
-                user = User.get_by_auth_id(auth_id)
+                with instrumentation.phase('get_user'):
+                    if is_token(auth_id):
+                        user = get_by_token(User, auth_id)
+                    else:
+                        # Legacy clients send an auth_id rather than a token.
+                        user = User.get_by_auth_id(auth_id)
             except BadRequestError:
                 _log.exception('Error getting user by auth_id: {}'.format(
                     auth_id))
@@ -56,6 +117,10 @@ class BaseHandler(RequestHandler):
         """
         return self.get_user() or self.raise_forbidden()
 
+    def raise_bad_request(self, *args, **kwargs):
+        """Raise a bad request error."""
+        self.abort(400, *args, **kwargs)
+
     def raise_error(self, *args, **kwargs):
         """Raise a general error."""
         self.abort(500, *args, **kwargs)
@@ -64,22 +129,86 @@ class BaseHandler(RequestHandler):
         """Raise a forbidden error."""
         self.abort(403, *args, **kwargs)
 
-    def render_json(self, obj):
+    def raise_request_too_large(self, *args, **kwargs):
+        """Raise a request entity too large error."""
+        self.abort(413, *args, **kwargs)
+
+    def raise_service_unavailable(self, *args, **kwargs):
+        """Raise a service unavailable error, after which to retry."""
+        self.abort(503, *args, **kwargs)
+
+    def render_json(self, obj, stream=False,
+                    content_type=JSON_CONTENT_TYPE):
         """
         Convert the supplied ``obj`` to a json string and write the result to
         the HTTP response.
 
         :param obj: Object to convert to a json string.
+        :param bool stream: If ``True``, then write the json string in chunks
+            as it is produced. Iterables in ``obj``, such as generators of
+            note ``dict`` objects, are then consumed one item at a time, so
+            the ``render_json`` phase includes the time spent producing them,
+            other than in the phases that are nested in it, such as that of
+            a query that is timed with
+            :func:`spidernotes.instrumentation.phase_iter`.
+        :param unicode content_type: Content type of the response, which is
+            json or a representation that is encoded as json.
         """
         # Headers must be strings.
-        self.response.headers.add_header(str('Content-Type'),
-                                         str('application/json'))
-        response = json.dumps(obj, ensure_ascii=False)
+        self.response.headers[str('Content-Type')] = str(content_type)
+        with instrumentation.phase('render_json'):
+            if stream:
+                write = self.response.out.write
+                for chunk in iter_json(obj):
+                    write(chunk)
+                return
+
+            response = json.dumps(obj, ensure_ascii=False)
 
-        # ``json.dumps()`` may or may not return ``unicode`` (see the
-        # documentation of the ``ensure_ascii`` parameter).
-        response = unicode(response)
-        self.response.out.write(response)
+            # ``json.dumps()`` may or may not return ``unicode`` (see the
+            # documentation of the ``ensure_ascii`` parameter).
+            response = unicode(response)
+            self.response.out.write(response)
+
+    def render_ndjson(self, objs):
+        """
+        Convert each of the supplied ``objs`` to a line of json and write the
+        lines to the HTTP response as they are produced.
+
+        :param objs: Iterable of objects to convert, such as a generator of
+            note ``dict`` objects, which is consumed one item at a time.
+        """
+        # Headers must be strings.
+        self.response.headers[str('Content-Type')] = str(NDJSON_CONTENT_TYPE)
+        with instrumentation.phase('render_ndjson'):
+            write = self.response.out.write
+            for obj in objs:
+                write(unicode(json.dumps(obj, ensure_ascii=False)))
+                write('\n')
+
+    def render_static_template(self, name):
+        """
+        Write the static template with the supplied ``name`` to the HTTP
+        response, or respond with "not modified" if the client's cached copy
+        is current.
+
+        :param unicode name: File name of the template, relative to the
+            templates directory.
+        """
+        template = get_static_template(name)
+        response = self.response
+        # Headers must be strings.
+        response.headers[str('Cache-Control')] = str(
+            'public, max-age={}'.format(_STATIC_MAX_AGE))
+        response.etag = str(template.etag)
+
+        if template.etag in self.request.if_none_match:
+            response.set_status(304)
+            del response.headers[str('Content-Type')]
+            return
+
+        response.headers[str('Content-Type')] = str(template.content_type)
+        response.body = template.body
 
     @cached_property
     def session(self):
@@ -87,11 +216,59 @@ class BaseHandler(RequestHandler):
         factory = sessions_memcache.MemcacheSessionFactory
         return self.session_store.get_session(factory=factory)
 
+    def _compress_response(self):
+        """
+        Gzip-encode the response body if the client accepts it and the body
+        is large enough for compression to be worthwhile.
+        """
+        request, response = self.request, self.response
+        # A missing header means that any encoding is acceptable, but
+        # clients that omit it may not decompress responses.
+        if ('Accept-Encoding' not in request.headers or
+                request.accept_encoding.best_match(['gzip']) != 'gzip' or
+                'Content-Encoding' in response.headers):
+            return
+
+        body = response.body
+        if len(body) < _GZIP_MIN_SIZE:
+            return
+
+        response.body = gzip_compress(body)
+        # Headers must be strings.
+        response.headers[str('Content-Encoding')] = str('gzip')
+        response.headers.add_header(str('Vary'), str('Accept-Encoding'))
+
 
 class DefaultHandler(BaseHandler):
     def get(self):
         """Display a simple default page."""
-        self.response.write(read_utf8_file('templates/home.html'))
+        self.render_static_template(_HOME_TEMPLATE)
+
+
+class WarmupHandler(BaseHandler):
+    def get(self):
+        """
+        Prime the caches that are used by API requests, so that App Engine
+        can do so before it routes a user's request to a new instance.
+        """
+        # Imported here, because the synchronization handlers import this
+        # module.
+        from spidernotes.handlers import synchronization
+
+        # Import and cache the user model and the session factory.
+        user_model = self.auth.store.user_model
+        session = self.session
+
+        self.app.config.load_config(
+            synchronization.__name__,
+            default_values=synchronization.default_config)
+
+        # Initialize the json encoder and the gzip compressor.
+        gzip_compress(json.dumps({'warmup': True}))
+
+        get_static_template(_HOME_TEMPLATE)
+        _log.info('Warmed up with user model {} and session {}'.format(
+            user_model.__name__, type(session).__name__))
 
 
 def handle_404(request, response, exception):
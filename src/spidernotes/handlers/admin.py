@@ -0,0 +1,65 @@
+from __future__ import unicode_literals
+from datetime import timedelta
+
+from google.appengine.api import users
+
+from spidernotes.handlers import BaseHandler, synchronization
+from spidernotes.instrumentation import get_summary
+from spidernotes.models import Note
+from spidernotes.timestamps import utcnow
+
+
+class IndexNotesHandler(BaseHandler):
+    """Starts the background indexing of existing notes."""
+
+    def post(self):
+        """
+        Enqueue a task that sets the url keys, bucket and timestamps of the
+        notes that were saved before they were introduced, so that they can be
+        looked up by url, reconciled and serialized without conversion.
+        """
+        if not users.is_current_user_admin():
+            self.raise_forbidden()
+        Note.index_all()
+        self.response.set_status(202)
+        return self.render_json({'status': 'pending'})
+
+
+class MetricsHandler(BaseHandler):
+    """Reports the request metrics of this instance to administrators."""
+
+    def get(self):
+        """
+        Return the rolling percentiles of the metrics of each route, such as
+        latency, phase times and API calls, as json.
+
+        ``app.yaml`` restricts this handler to administrators, and it checks
+        so itself as well.
+        """
+        if not users.is_current_user_admin():
+            self.raise_forbidden()
+        return self.render_json(get_summary())
+
+
+class PurgeDeletedNotesHandler(BaseHandler):
+    """Purges old deleted notes, which is scheduled by ``cron.yaml``."""
+
+    def get(self):
+        """
+        Enqueue a task that purges the deleted notes that were synchronized
+        more than ``tombstone_horizon_days`` ago.
+
+        ``app.yaml`` restricts this handler to administrators and cron, and
+        it checks so itself as well. App Engine removes the
+        ``X-AppEngine-Cron`` header from external requests.
+        """
+        if not (users.is_current_user_admin() or
+                self.request.headers.get('X-AppEngine-Cron') == 'true'):
+            self.raise_forbidden()
+        config = self.app.config.load_config(
+            synchronization.__name__,
+            default_values=synchronization.default_config)
+        Note.purge_deleted(
+            utcnow() - timedelta(days=config['tombstone_horizon_days']))
+        self.response.set_status(202)
+        return self.render_json({'status': 'pending'})
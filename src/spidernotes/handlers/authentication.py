@@ -3,10 +3,7 @@ from __future__ import unicode_literals
 from simpleauth import SimpleAuthHandler
 
 from spidernotes import secrets
-from spidernotes.handlers import BaseHandler
-
-
-AUTH_SESSION_KEY = 'auth_data'
+from spidernotes.handlers import AUTH_SESSION_KEY, BaseHandler
 
 
 class AuthHandler(BaseHandler, SimpleAuthHandler):
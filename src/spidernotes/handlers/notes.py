@@ -0,0 +1,83 @@
+from __future__ import unicode_literals
+import base64
+
+from spidernotes.handlers import BaseHandler
+from spidernotes.models import Note, UrlFilter
+from spidernotes.timestamps import to_timestamp
+from spidernotes.utils import get_param
+
+
+# Maximum number of notes that are returned by a lookup.
+_MAX_RESULTS = 100
+
+
+class NotesHandler(BaseHandler):
+    """Looks up the notes of the current user by url."""
+
+    def get(self):
+        """
+        Return the active notes whose url is the same page as the ``url``
+        query parameter, or whose url has the ``host`` query parameter as its
+        host, most recently modified first.
+
+        Clients can use this to show the notes of the current page without
+        synchronizing all of the notes. Respond with a bad request status if
+        neither parameter is supplied, or ``url`` cannot be normalized.
+
+        :return: json string that contains a ``list`` of at most
+            :data:`_MAX_RESULTS` :class:`spidernotes.models.Note` instances.
+        """
+        user_key = self.get_valid_user().key
+        url = get_param(self.request.GET, 'url')
+        host = get_param(self.request.GET, 'host')
+        if url:
+            query = Note.get_by_url(user_key, url)
+        elif host:
+            query = Note.get_by_host(user_key, host)
+        else:
+            query = None
+        if query is None:
+            self.raise_bad_request()
+
+        notes = query.fetch(_MAX_RESULTS)
+        return self.render_json({'notes': [o.to_dict() for o in notes]})
+
+
+class UrlFilterHandler(BaseHandler):
+    """Returns the url filter of the current user."""
+
+    def get(self):
+        """
+        Return the Bloom filter of the url keys of the current user's active
+        notes, which is described in :mod:`spidernotes.bloom`.
+
+        The response has an ETag of the filter's version, so clients can
+        download it again only when it has changed. If the filter has not
+        been built yet, then respond with an accepted status, and build it in
+        the background.
+
+        :return: json string that contains the ``version`` of the filter, its
+            ``bitCount``, ``hashCount`` and ``itemCount``, and its base64
+            encoded ``bits``.
+        """
+        user_key = self.get_valid_user().key
+        url_filter = UrlFilter.get_or_build(user_key)
+        if url_filter is None:
+            self.response.set_status(202)
+            return self.render_json({'status': 'pending'})
+
+        version = to_timestamp(url_filter.version) if url_filter.version else 0
+        etag = '{}-{}'.format(int(version), url_filter.bit_count)
+        # Headers must be strings.
+        self.response.etag = str(etag)
+        if etag in self.request.if_none_match:
+            self.response.set_status(304)
+            del self.response.headers[str('Content-Type')]
+            return
+
+        return self.render_json({
+            'version': version,
+            'bitCount': url_filter.bit_count,
+            'hashCount': url_filter.hash_count,
+            'itemCount': url_filter.item_count,
+            'bits': base64.b64encode(url_filter.bits)})
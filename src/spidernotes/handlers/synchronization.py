@@ -1,14 +1,70 @@
 from __future__ import unicode_literals
-import json
+import logging
+import time
 from collections import namedtuple
-from datetime import datetime
-from itertools import imap
+from itertools import chain, imap, izip
 
 from google.appengine.ext import ndb
+from google.appengine.ext.ndb.key import Key
+from google.appengine.ext.db import BadValueError, TransactionFailedError
+from webapp2 import cached_property
 
-from spidernotes.handlers import BaseHandler
-from spidernotes.models import Note
-from spidernotes.utils import from_timestamp, get_param, to_timestamp
+from spidernotes import instrumentation
+from spidernotes.buckets import (
+    BUCKET_COUNT, EMPTY_HASH, format_hash, get_bucket, get_bucket_name)
+from spidernotes.handlers import (
+    COLUMNS_CONTENT_TYPE, JSON_CONTENT_TYPE, BaseHandler)
+from spidernotes.jsonstream import (
+    RequestTooLargeError, iter_object, iter_values)
+from spidernotes.models import NOTE_COLUMNS, BucketHashes, Note
+from spidernotes.storage import MERGE_BATCH_SIZE, get_storage
+from spidernotes.timestamps import (
+    EPOCH, from_microseconds, from_milliseconds, to_microseconds,
+    to_milliseconds, to_timestamp)
+from spidernotes.utils import get_param, iter_batches
+
+
+_log = logging.getLogger(__name__)
+
+#: Default configuration values, which can be overridden by the application
+#: config under the ``spidernotes.handlers.synchronization`` key.
+default_config = {
+    # Maximum size of a request body, in bytes.
+    'max_body_size': 16 * 1024 * 1024,
+    # Maximum size of a single note in a request body, in characters.
+    'max_note_size': 256 * 1024,
+    # Number of days after which deleted notes are purged. Clients that have
+    # not synchronized for longer must synchronize all of their notes again.
+    'tombstone_horizon_days': 90,
+    # Maximum size of an import request body, in bytes, which is App Engine's
+    # limit.
+    'max_import_size': 32 * 1024 * 1024,
+}
+
+# Maximum number of server notes that are returned in a single page.
+_MAX_PAGE_SIZE = 500
+
+# Number of notes that are fetched per page of an export.
+_EXPORT_PAGE_SIZE = 500
+
+# Maximum number of differing buckets whose notes are fetched with a query
+# per bucket, rather than by scanning all of the user's notes.
+_MAX_BUCKET_QUERIES = 32
+
+# Header in which clients may send a key that identifies a synchronization
+# request, so that retries of it are not merged again.
+_IDEMPOTENCY_KEY_HEADER = 'Idempotency-Key'
+
+# Number of seconds for which the summaries of merges are cached.
+_MERGE_SUMMARY_TTL = 3600
+
+# Maximum total length of the ids of the notes in a cached merge summary,
+# which keeps it below the memcache value size limit.
+_MAX_MERGE_SUMMARY_SIZE = 512 * 1024
+
+# Memcache key prefix of the summaries of merges, which is followed by the
+# user's id and the request's idempotency key.
+_MERGE_SUMMARY_KEY_PREFIX = 'sync_merge_summary:'
 
 
 class SynchronizationHandler(BaseHandler):
@@ -20,83 +76,756 @@ class SynchronizationHandler(BaseHandler):
         Merge notes from the client and return notes to the client for it to
         merge.
 
+        Clients that include a ``cursor`` key in the request (``null`` for the
+        first page) receive the server notes in pages of at most ``pageSize``
+        notes, along with a ``cursor`` and a ``hasMore`` flag. The client
+        should request the next page with the returned ``cursor`` until
+        ``hasMore`` is ``false``, and only then persist ``lastSynchronized``,
+        which is the same for every page.
+
+        Clients may send an ``Idempotency-Key`` header that is unique to
+        each synchronization, and send the same header when they retry it,
+        such as after a timeout. If the original request's notes were merged,
+        then the retry is answered from a cached summary of the merge,
+        without merging the notes again. The key applies to requests
+        without a ``cursor`` or with a ``null`` one, which are the ones that
+        merge notes.
+
+        If deleted notes that were synchronized after the client's
+        ``lastSynchronized`` have been purged, then respond with a conflict
+        status and a ``resync`` status, without merging the client's notes.
+        The client should then synchronize with a ``lastSynchronized`` of
+        ``0``, and replace its synchronized notes with the returned notes, so
+        that it neither keeps nor restores the notes whose deletions it
+        missed.
+
+        Clients may send their notes as rows of values in the order of
+        :data:`spidernotes.models.NOTE_COLUMNS`, rather than as objects, with
+        a ``Content-Type`` of ``application/vnd.spidernotes.columns+json``,
+        and receive them in the same way by accepting that content type. The
+        keys of the notes are then not repeated for each note, and every
+        timestamp of the response is an integer number of milliseconds. Json
+        objects remain the default.
+
         :return: json string that contains a ``list`` of
             :class:`spidernotes.models.Note` instances that have changed
             since the last time the notes were synchronized, as well as a
             timestamp of when this request was processed.
         """
         user_key = self.get_valid_user().key
+        config = self.app.config.load_config(__name__,
+                                             default_values=default_config)
+        if self.request.content_length > config['max_body_size']:
+            self.raise_request_too_large()
+        idempotency_key = self.request.headers.get(_IDEMPOTENCY_KEY_HEADER)
+
         try:
-            ctx = json.loads(self.request.body)
-        except ValueError:
-            self.raise_error()
+            with instrumentation.phase('read_request'):
+                ctx, notes_from_client = _read_request(
+                    self.body_file, config,
+                    self.request.content_type == COLUMNS_CONTENT_TYPE)
+                old_last_synchronized = from_milliseconds(
+                    ctx.get('lastSynchronized'))
+        except RequestTooLargeError:
+            self.raise_request_too_large()
+        except (TypeError, ValueError):
+            self.raise_bad_request()
+
+        # The page is validated before any notes are merged, so that an
+        # invalid ``cursor`` or ``pageSize`` is rejected without side effects.
+        if 'cursor' in ctx:
+            try:
+                until, start_cursor = _decode_cursor(ctx['cursor'])
+                page_size = _get_page_size(ctx.get('pageSize'))
+            except (BadValueError, TypeError, ValueError):
+                self.raise_bad_request()
 
-        old_last_synchronized = from_timestamp(ctx.get('lastSynchronized'))
-        new_last_synchronized = datetime.utcnow()
+        if get_storage().has_purged_after(user_key, old_last_synchronized):
+            return self._render_resync()
 
-        notes_from_client = imap(_to_tuple, ctx.get('notes'))
-        notes_from_server = _merge_notes(user_key,
+        # Most requests are polls by idle clients, which can be answered
+        # without querying the notes if no note has been synchronized since
+        # the client last synchronized.
+        if (not notes_from_client and not ctx.get('cursor') and
+                _is_up_to_date(user_key, old_last_synchronized)):
+            return self._render_up_to_date(ctx)
+
+        if 'cursor' not in ctx:
+            notes_from_server, _, _, new_last_synchronized = (
+                self._merge_client_notes(user_key,
                                          notes_from_client,
                                          old_last_synchronized,
-                                         new_last_synchronized)
+                                         idempotency_key=idempotency_key))
+            return self._render_notes(
+                {'lastSynchronized': new_last_synchronized},
+                notes_from_server,
+                stream=True)
+
+        notes_from_server, cursor, has_more, new_last_synchronized = (
+            self._merge_client_notes(user_key,
+                                     notes_from_client,
+                                     old_last_synchronized,
+                                     until=until,
+                                     page_size=page_size,
+                                     start_cursor=start_cursor,
+                                     idempotency_key=idempotency_key))
+
+        return self._render_notes(
+            {'lastSynchronized': new_last_synchronized,
+             'cursor': _encode_cursor(new_last_synchronized, cursor)
+             if has_more else None,
+             'hasMore': has_more},
+            notes_from_server)
+
+    @cached_property
+    def _content_type(self):
+        """
+        Return the content type of the response, which is
+        ``COLUMNS_CONTENT_TYPE`` if the client prefers it to json.
+        """
+        return self.request.accept.best_match(
+            [JSON_CONTENT_TYPE, COLUMNS_CONTENT_TYPE]) or JSON_CONTENT_TYPE
+
+    def _render_notes(self, response, notes, stream=False):
+        """
+        Write ``response`` and ``notes`` to the HTTP response as json, in the
+        representation that the client accepts.
+
+        :param dict response: Members of the response other than ``notes``,
+            whose ``lastSynchronized`` is a datetime.
+        :param notes: Iterable of :class:`spidernotes.models.Note` instances.
+        :param bool stream: If ``True``, then write the response in chunks as
+            ``notes`` are consumed.
+        """
+        notes = instrumentation.count_iter('notes_sent', notes)
+        last_synchronized = response['lastSynchronized']
+        if self._content_type == COLUMNS_CONTENT_TYPE:
+            response['lastSynchronized'] = to_milliseconds(last_synchronized)
+            response['notes'] = (o.to_row() for o in notes)
+        else:
+            response['lastSynchronized'] = to_timestamp(last_synchronized)
+            response['notes'] = (o.to_dict() for o in notes)
+        if not stream:
+            with instrumentation.phase('render_json'):
+                response['notes'] = list(response['notes'])
+        return self.render_json(response, stream=stream,
+                                content_type=self._content_type)
+
+    def _render_resync(self):
+        """
+        Render a response that tells the client to synchronize all of its
+        notes again.
+        """
+        self.response.set_status(409)
+        return self.render_json({'status': 'resync'},
+                                content_type=self._content_type)
+
+    def _render_up_to_date(self, ctx):
+        """
+        Render a response without any notes to a client that is up to date.
+
+        The client's own ``lastSynchronized`` is returned, rather than the
+        current datetime, because notes that are being merged concurrently may
+        be synchronized before the current datetime.
+
+        :param dict ctx: Request members.
+        """
+        response = {'notes': [],
+                    'lastSynchronized': ctx.get('lastSynchronized')}
+        if 'cursor' in ctx:
+            response.update({'cursor': None, 'hasMore': False})
+        return self.render_json(response, content_type=self._content_type)
+
+    def _merge_client_notes(self, *args, **kwargs):
+        """
+        Call :func:`_merge_notes`, and raise an appropriate error if the notes
+        from the client, which are parsed as they are merged, are invalid, or
+        if the merge conflicted with concurrent merges too many times, in
+        which case the client should retry.
+
+        The batches of notes that were merged before an invalid note remain
+        merged. Each batch is merged atomically, and merging the same notes
+        again does not change them, so the client can correct and retry the
+        request.
+        """
+        try:
+            with instrumentation.phase('merge'):
+                return _merge_notes(*args, **kwargs)
+        except RequestTooLargeError:
+            self.raise_request_too_large()
+        except (BadValueError, TypeError, ValueError):
+            self.raise_bad_request()
+        except TransactionFailedError:
+            self.raise_service_unavailable()
+
+
+class ReconciliationHandler(BaseHandler):
+    """
+    Reconciles the notes of a client with the server by comparing bucket
+    hashes, which are described in :mod:`spidernotes.buckets`, so that a
+    client whose ``lastSynchronized`` is wrong can recover without
+    downloading all of the notes.
+    """
+
+    def post(self):
+        """
+        Return the notes, including deleted notes, in each bucket whose hash
+        differs from the client's hash of it.
+
+        The request contains a ``buckets`` object of bucket names to the
+        client's hashes, where a missing bucket is empty. The client should
+        merge the returned notes, send its own notes in the differing buckets
+        that are newer than the server's with ``/api/sync``, and then use the
+        returned ``lastSynchronized``. A deleted note that the client has in a
+        differing bucket, but that is not returned, has been purged, and the
+        client should remove it. If the server's hashes have not been
+        built yet, then respond with an accepted status, and build them in
+        the background.
+
+        :return: json string that contains a ``list`` of notes, a ``buckets``
+            object of the names of the differing buckets to the server's
+            hashes of them, and a ``lastSynchronized`` timestamp.
+        """
+        user_key = self.get_valid_user().key
+        config = self.app.config.load_config(__name__,
+                                             default_values=default_config)
+        if self.request.content_length > config['max_body_size']:
+            self.raise_request_too_large()
+
+        try:
+            ctx = dict(iter_object(self.body_file,
+                                   max_size=config['max_body_size']))
+            client_hashes = ctx.get('buckets') or {}
+            if not isinstance(client_hashes, dict):
+                raise ValueError('Invalid buckets: {}'.format(client_hashes))
+        except RequestTooLargeError:
+            self.raise_request_too_large()
+        except ValueError:
+            self.raise_error()
+
+        # The watermark is read first, so that the notes that are merged
+        # while the buckets are read are returned by the next synchronization.
+        synchronized = get_storage().get_synchronized(user_key)
+        bucket_hashes = BucketHashes.get_or_build(user_key)
+        if bucket_hashes is None:
+            self.response.set_status(202)
+            return self.render_json({'status': 'pending'})
+
+        differing = {}
+        for bucket, value in enumerate(bucket_hashes.get_hashes()):
+            name = get_bucket_name(bucket)
+            server_hash = format_hash(value)
+            client_hash = unicode(client_hashes.get(name) or EMPTY_HASH)
+            if client_hash.lower() != server_hash:
+                differing[bucket] = server_hash
+        notes = instrumentation.phase_iter(
+            'query', _get_notes_in_buckets(user_key, differing))
 
         return self.render_json(
-            {'notes': [o.to_dict() for o in notes_from_server],
-             'lastSynchronized': to_timestamp(new_last_synchronized)})
+            {'buckets': {get_bucket_name(k): v
+                         for k, v in differing.iteritems()},
+             'lastSynchronized': to_timestamp(synchronized or EPOCH),
+             'notes': (o.to_dict() for o in instrumentation.count_iter(
+                 'notes_sent', notes))},
+            stream=True)
+
+
+class ExportHandler(BaseHandler):
+    """Exports all of the notes of the current user."""
+
+    def get(self):
+        """
+        Return all of the current user's notes, including deleted notes, as
+        newline-delimited json, with one note per line, which can be imported
+        with ``/api/import``.
+
+        The notes are fetched in pages and written as they are fetched, so
+        only one page is held in memory at a time.
+
+        :return: Newline-delimited json string of
+            :class:`spidernotes.models.Note` instances.
+        """
+        user_key = self.get_valid_user().key
+        start = time.time()
+        notes = instrumentation.count_iter('notes_sent',
+                                           _iter_all_notes(user_key))
+        self.render_ndjson(o.to_dict() for o in notes)
+        _log_throughput('Exported',
+                        instrumentation.get_count('notes_sent'),
+                        time.time() - start)
+
+
+class ImportHandler(BaseHandler):
+    """Imports notes into the current user's notes."""
+
+    @ndb.toplevel
+    def post(self):
+        """
+        Merge the notes in a newline-delimited json request body, with one
+        note per line, as is returned by ``/api/export``, into the current
+        user's notes.
+
+        The notes are parsed as they are read, and merged with the same
+        last-writer-wins rule as ``/api/sync``, in batches that are each
+        written in a transaction. If the request fails, then the batches that
+        were written remain imported, and the import can be retried.
+
+        :return: json string that contains the number of notes that were
+            ``imported``, the number that were ``written``, and the throughput
+            of the import in ``notesPerSecond``.
+        """
+        user_key = self.get_valid_user().key
+        config = self.app.config.load_config(__name__,
+                                             default_values=default_config)
+        max_size = config['max_import_size']
+        if self.request.content_length > max_size:
+            self.raise_request_too_large()
+
+        start = time.time()
+        imported_count = written_count = 0
+        try:
+            notes = imap(_to_tuple,
+                         iter_values(self.body_file,
+                                     max_size=max_size,
+                                     max_item_size=config['max_note_size']))
+            for batch in iter_batches(notes, MERGE_BATCH_SIZE):
+                _, written, _ = get_storage().merge_multi(
+                    user_key, [o.id for o in batch], batch)
+                imported_count += len(batch)
+                written_count += written
+        except RequestTooLargeError:
+            self.raise_request_too_large()
+        except TransactionFailedError:
+            self.raise_service_unavailable()
+        except (BadValueError, TypeError, ValueError):
+            self.raise_bad_request()
+        finally:
+            instrumentation.count('notes_received', imported_count)
+            instrumentation.count('notes_written', written_count)
+
+        elapsed = time.time() - start
+        _log_throughput('Imported', imported_count, elapsed)
+        return self.render_json(
+            {'imported': imported_count,
+             'written': written_count,
+             'notesPerSecond': _get_rate(imported_count, elapsed)})
 
 
 _NoteTuple = namedtuple(
     'NoteTuple', ['id', 'body', 'url', 'is_deleted', 'created', 'modified'])
 
 
+def _decode_cursor(token):
+    """
+    Return a tuple of the synchronization datetime and the cursor of the
+    storage of notes that are encoded in ``token``.
+
+    If ``token`` is empty, then this is the first page, whose synchronization
+    datetime is not known until the client's notes are merged, so return
+    ``None`` and ``None``.
+
+    :param unicode token: Cursor token that was returned to the client.
+    :raises ValueError: If ``token`` is not a valid cursor token.
+    :rtype: ``tuple``
+    """
+    if not token:
+        return None, None
+    if not isinstance(token, basestring):
+        raise ValueError('Invalid cursor: {}'.format(token))
+    microseconds, _, cursor = token.partition(':')
+    return (from_microseconds(int(microseconds)),
+            get_storage().parse_cursor(cursor))
+
+
+def _encode_cursor(last_synchronized, cursor):
+    """
+    Return a cursor token that encodes both ``last_synchronized`` and
+    ``cursor``, so that every page of a synchronization shares the same
+    watermark.
+
+    :param datetime.datetime last_synchronized: Datetime of the current
+        synchronization.
+    :param cursor: Position of the next page, which was returned by the
+        storage of notes.
+    :rtype: ``unicode``
+    """
+    return '{}:{}'.format(to_microseconds(last_synchronized),
+                          get_storage().format_cursor(cursor))
+
+
+def _get_notes_in_buckets(user_key, buckets):
+    """
+    Return an iterable of the notes, including deleted notes, that are
+    associated with ``user_key`` and are in one of the supplied ``buckets``.
+
+    Notes that are scanned are matched by the bucket of their id, because
+    notes that predate buckets do not store one until the user's hashes are
+    built.
+
+    :param user_key: Key of the :class:`google.appengine.api.users.User`
+        with which the notes are associated.
+    :param buckets: Collection of bucket indexes.
+    :type user_key: :class:`google.appengine.ext.db.Key`
+    """
+    if not buckets:
+        return ()
+    if len(buckets) <= _MAX_BUCKET_QUERIES:
+        return chain.from_iterable(
+            Note.get_by_bucket(user_key, o).iter(batch_size=_MAX_PAGE_SIZE)
+            for o in sorted(buckets))
+    if len(buckets) == BUCKET_COUNT:
+        return Note.query(ancestor=user_key).iter(batch_size=_MAX_PAGE_SIZE)
+    return (o for o in Note.query(ancestor=user_key).iter(
+        batch_size=_MAX_PAGE_SIZE) if get_bucket(o.key.id()) in buckets)
+
+
+def _get_rate(count, elapsed):
+    """
+    Return the number of items per second, rounded to one decimal place.
+
+    :param int count: Number of items.
+    :param float elapsed: Number of seconds in which they were processed.
+    :rtype: ``float``
+    """
+    return round(count / elapsed, 1) if elapsed > 0 else 0.0
+
+
+def _iter_all_notes(user_key):
+    """
+    Yield all of the notes, including deleted notes, that are associated
+    with ``user_key``, which are fetched in pages of
+    :data:`_EXPORT_PAGE_SIZE` notes.
+
+    :param user_key: Key of the :class:`google.appengine.api.users.User`
+        with which the notes are associated.
+    :type user_key: :class:`google.appengine.ext.db.Key`
+    :return: Generator of :class:`spidernotes.models.Note` instances.
+    """
+    storage = get_storage()
+    cursor = None
+    has_more = True
+    while has_more:
+        with instrumentation.phase('query'):
+            notes, cursor, has_more = storage.fetch_all(
+                user_key, _EXPORT_PAGE_SIZE, cursor)
+        for note in notes:
+            yield note
+
+
+def _log_throughput(action, count, elapsed):
+    """
+    Log the number of notes that were exported or imported, and the
+    throughput in notes per second.
+
+    :param unicode action: Past tense of the action, such as ``Exported``.
+    :param int count: Number of notes.
+    :param float elapsed: Number of seconds that the action took.
+    """
+    _log.info('{} {} notes in {:.3f} s: {} notes/s'.format(
+        action, count, elapsed, _get_rate(count, elapsed)))
+
+
+def _get_page_size(page_size):
+    """
+    Return the requested ``page_size`` capped to :data:`_MAX_PAGE_SIZE`.
+
+    :param page_size: Requested page size or ``None``.
+    :rtype: ``int``
+    """
+    if page_size is None:
+        return _MAX_PAGE_SIZE
+    page_size = int(page_size)
+    if page_size < 1:
+        raise ValueError('Invalid page size: {}'.format(page_size))
+    return min(page_size, _MAX_PAGE_SIZE)
+
+
+def _read_request(body_file, config, is_columnar=False):
+    """
+    Incrementally parse a synchronization request body, and return a tuple
+    of a ``dict`` of its members other than ``notes``, and an iterable of
+    ``_NoteTuple`` instances that are parsed from ``notes``, which is empty
+    if there are no notes.
+
+    If ``lastSynchronized`` precedes ``notes``, as in
+    ``{"lastSynchronized": ..., "notes": [...]}``, then the notes are parsed
+    one at a time as the iterable is consumed, so the request body is never
+    held in memory in full, and any members that follow ``notes`` are
+    ignored. Clients should therefore send ``notes`` last. Otherwise, the
+    notes are parsed up front.
+
+    :param body_file: File-like object from which to read the request body.
+    :param dict config: Handler configuration.
+    :param bool is_columnar: If ``True``, then the notes are rows of values
+        in the order of :data:`spidernotes.models.NOTE_COLUMNS`, rather than
+        objects.
+    :raises RequestTooLargeError: If a size limit in ``config`` is exceeded.
+    :raises ValueError: If the request body is malformed.
+    :rtype: ``tuple``
+    """
+    to_tuple = _row_to_tuple if is_columnar else _to_tuple
+    ctx = {}
+    notes = ()
+    for key, value in iter_object(body_file,
+                                  stream_keys=('notes',),
+                                  max_size=config['max_body_size'],
+                                  max_item_size=config['max_note_size']):
+        if key == 'notes':
+            notes = imap(to_tuple, value)
+            if 'lastSynchronized' in ctx:
+                # The first note is parsed, so that an empty iterable is
+                # returned if there are no notes.
+                first = next(notes, None)
+                if first is None:
+                    return ctx, ()
+                return ctx, chain((first,), instrumentation.phase_iter(
+                    'read_request', notes))
+            notes = list(notes)
+        else:
+            ctx[key] = value
+    return ctx, notes
+
+
+def _row_to_tuple(note_row):
+    """
+    Return a ``namedtuple`` representation of the supplied ``note_row``.
+
+    :param list note_row: Values of a :class:`spidernotes.models.Note` in
+        the order of :data:`spidernotes.models.NOTE_COLUMNS`.
+    :raises ValueError: If ``note_row`` is not a ``list`` of as many values.
+    """
+    if not isinstance(note_row, list) or len(note_row) != len(NOTE_COLUMNS):
+        raise ValueError('Invalid note: {}'.format(note_row))
+    return _to_tuple(dict(izip(NOTE_COLUMNS, note_row)))
+
+
 def _to_tuple(note_dict):
     """
     Return a ``namedtuple`` representation of the supplied ``note_dict``.
 
     :param dict note_dict: ``dict`` representation of a
         :class:`spidernotes.models.Note`
+    :raises ValueError: If ``note_dict`` is not a ``dict``.
     """
+    if not isinstance(note_dict, dict):
+        raise ValueError('Invalid note: {}'.format(note_dict))
     is_deleted = bool(note_dict.get('isDeleted'))
     return _NoteTuple(
         id=get_param(note_dict, 'id'),
         body=get_param(note_dict, 'body') if not is_deleted else '',
         url=get_param(note_dict, 'url') if not is_deleted else '',
         is_deleted=is_deleted,
-        created=from_timestamp(get_param(note_dict, 'created')),
-        modified=from_timestamp(get_param(note_dict, 'modified')))
+        created=from_milliseconds(get_param(note_dict, 'created')),
+        modified=from_milliseconds(get_param(note_dict, 'modified')))
+
+
+def _is_up_to_date(user_key, last_synchronized):
+    """
+    Return ``True`` if no note that is associated with ``user_key`` has been
+    synchronized after ``last_synchronized``.
+
+    :param user_key: Key of the :class:`google.appengine.api.users.User`
+        with which the notes are associated.
+    :param datetime.datetime last_synchronized: Datetime at which the client
+        last synchronized.
+    :type user_key: :class:`google.appengine.ext.db.Key`
+    :rtype: ``bool``
+    """
+    synchronized = get_storage().get_synchronized(user_key)
+    return synchronized is None or last_synchronized >= synchronized
 
 
 def _merge_notes(user_key, notes_from_client, old_last_synchronized,
-                 new_last_synchronized):
+                 until=None, page_size=None, start_cursor=None,
+                 idempotency_key=None):
     """
     Merge notes from client with notes from the server.
 
+    The client notes are merged in batches, each atomically with
+    :meth:`spidernotes.storage.NdbStorage.merge_multi` of the storage of
+    notes. Then the user's ``synchronized`` datetime is read, before the
+    server notes are queried. Every note that was stamped at or before it
+    has been committed, and so is returned by the query, and every note that
+    is committed later is stamped after it, so it is safe to return to the
+    client. If ``page_size`` is ``None``, then the server notes are returned
+    as an iterable that is fetched in batches as it is consumed, so that
+    they are never all held in memory at once.
+
+    If the summary of a merge of the first page is cached under
+    ``idempotency_key``, then the client notes are not merged again. The
+    server notes are queried with the cached synchronization datetime, and
+    without the notes that the merge superseded, so the client receives
+    the same notes as from the original request, except for notes that
+    have changed since, which it receives as they are now, or when it next
+    synchronizes.
+
     :param user_key: Key of the :class:`google.appengine.api.users.User`
         with which the notes are associated.
     :param notes_from_client: Iterable of Note-like objects.
     :param datetime.datetime old_last_synchronized: Datetime after which to
         fetch server notes.
-    :param datetime.datetime new_last_synchronized: Datetime of the current
-        merge operation.
+    :param datetime.datetime until: Datetime at or before which to fetch
+        server notes, which is the synchronization datetime of the first
+        page, or ``None`` for the first page.
+    :param int page_size: Maximum number of server notes to return, or
+        ``None`` to return all of them.
+    :param start_cursor: Position from which to fetch server notes, which
+        was returned by the storage of notes, or ``None``.
+    :param idempotency_key: Key that identifies the request, under which
+        the summary of the merge of the first page is cached, or ``None``.
     :type user_key: :class:`google.appengine.ext.db.Key`
-    :return: Notes to be merged back into the client.
-    :rtype: list
-    """
-    from_server_map = {o.key: o for o in Note.get_synchronized_after(
-        user_key, old_last_synchronized)}
-    to_persist = []
-
-    for client_note in notes_from_client:
-        server_note, is_created = Note.get_or_create(user_key,
-                                                     client_note.id)
-        if is_created or client_note.modified >= server_note.modified:
-            server_note.update_from_note(client_note, new_last_synchronized)
-            to_persist.append(server_note)
-
-            # The ``client_note`` supersedes the ``server_note``, so don't
-            # return the ``server_note`` to the client.
-            from_server_map.pop(server_note.key, None)
-
-    if to_persist:
-        ndb.put_multi_async(to_persist)
-    return from_server_map.values()
\ No newline at end of file
+    :type until: :class:`datetime.datetime` or ``None``
+    :type idempotency_key: ``unicode`` or ``None``
+    :return: Tuple of an iterable of the notes to be merged back into the
+        client, the cursor of the next page, whether there are more pages,
+        and the synchronization datetime to return to the client.
+    :rtype: ``tuple``
+    """
+    storage = get_storage()
+    if until is not None:
+        idempotency_key = None
+    summary = None
+    if idempotency_key is not None:
+        summary = _get_merge_summary(user_key, idempotency_key,
+                                     old_last_synchronized)
+    if summary is not None:
+        until, superseded_keys = summary
+        instrumentation.count('merges_replayed')
+    else:
+        superseded_keys = _merge_batches(storage, user_key, notes_from_client)
+        if until is None:
+            until = storage.get_synchronized(user_key) or EPOCH
+        if idempotency_key is not None:
+            _set_merge_summary(user_key, idempotency_key,
+                               old_last_synchronized, until, superseded_keys)
+
+    if page_size is None:
+        notes = instrumentation.phase_iter(
+            'query',
+            storage.iter_synchronized_after(user_key, old_last_synchronized))
+        return ((o for o in notes if o.key not in superseded_keys),
+                None,
+                False,
+                until)
+    with instrumentation.phase('query'):
+        from_server, cursor, has_more = storage.fetch_synchronized_after(
+            user_key, old_last_synchronized, until, page_size, start_cursor)
+    return ([o for o in from_server if o.key not in superseded_keys],
+            cursor,
+            has_more,
+            until)
+
+
+def _merge_batches(storage, user_key, notes_from_client):
+    """
+    Merge ``notes_from_client`` into ``storage`` in batches, each
+    atomically, and return the keys of the server notes that they
+    superseded.
+
+    :param storage: Storage of notes.
+    :param user_key: Key of the :class:`google.appengine.api.users.User`
+        with which the notes are associated.
+    :param notes_from_client: Iterable of Note-like objects.
+    :type user_key: :class:`google.appengine.ext.db.Key`
+    :rtype: ``set``
+    """
+    superseded_keys = set()
+    written_count = unchanged_count = 0
+    for batch in iter_batches(notes_from_client, MERGE_BATCH_SIZE):
+        instrumentation.count('notes_received', len(batch))
+        keys, written, unchanged = storage.merge_multi(
+            user_key, [o.id for o in batch], batch)
+        superseded_keys.update(keys)
+        written_count += written
+        unchanged_count += unchanged
+    _record_merge_counts(storage, written_count, unchanged_count)
+    instrumentation.count('notes_written', written_count)
+    return superseded_keys
+
+
+def _get_merge_summary_key(user_key, idempotency_key):
+    """
+    Return the memcache key of the summary of the merge of the request that
+    is identified by ``idempotency_key``.
+
+    :param user_key: Key of the :class:`google.appengine.api.users.User`
+        that sent the request.
+    :param unicode idempotency_key: Key that identifies the request.
+    :type user_key: :class:`google.appengine.ext.db.Key`
+    :rtype: ``unicode``
+    """
+    return '{}{}:{}'.format(_MERGE_SUMMARY_KEY_PREFIX, user_key.id(),
+                            idempotency_key)
+
+
+def _get_merge_summary(user_key, idempotency_key, old_last_synchronized):
+    """
+    Return the cached summary of the merge of the request that is identified
+    by ``idempotency_key``, if it merged notes from the same
+    ``old_last_synchronized``.
+
+    :param user_key: Key of the :class:`google.appengine.api.users.User`
+        that sent the request.
+    :param unicode idempotency_key: Key that identifies the request.
+    :param datetime.datetime old_last_synchronized: Datetime at which the
+        client last synchronized.
+    :type user_key: :class:`google.appengine.ext.db.Key`
+    :return: Tuple of the synchronization datetime and a ``set`` of the keys
+        of the superseded notes, or ``None``.
+    :rtype: ``tuple`` or ``None``
+    """
+    value = ndb.get_context().memcache_get(
+        _get_merge_summary_key(user_key, idempotency_key)).get_result()
+    if value is None:
+        return None
+    last_synchronized, synchronized, note_ids = value
+    if last_synchronized != old_last_synchronized:
+        _log.warning('Idempotency key reused with a different '
+                     'lastSynchronized: {}'.format(idempotency_key))
+        return None
+    return synchronized, {Key(Note, o, parent=user_key) for o in note_ids}
+
+
+def _set_merge_summary(user_key, idempotency_key, old_last_synchronized,
+                       synchronized, superseded_keys):
+    """
+    Cache the summary of a committed merge of the request that is identified
+    by ``idempotency_key``, unless it is too large.
+
+    :param user_key: Key of the :class:`google.appengine.api.users.User`
+        that sent the request.
+    :param unicode idempotency_key: Key that identifies the request.
+    :param datetime.datetime old_last_synchronized: Datetime at which the
+        client last synchronized.
+    :param datetime.datetime synchronized: Synchronization datetime that is
+        returned to the client.
+    :param superseded_keys: Keys of the server notes that the merge
+        superseded.
+    :type user_key: :class:`google.appengine.ext.db.Key`
+    """
+    note_ids = [o.id() for o in superseded_keys]
+    if sum(len(o) for o in note_ids) > _MAX_MERGE_SUMMARY_SIZE:
+        _log.info('Merge summary too large to cache: {}'.format(
+            idempotency_key))
+        return
+    ndb.get_context().memcache_set(
+        _get_merge_summary_key(user_key, idempotency_key),
+        (old_last_synchronized, synchronized, note_ids),
+        time=_MERGE_SUMMARY_TTL).get_result()
+
+
+def _record_merge_counts(storage, written_count, unchanged_count):
+    """
+    Log the number of client notes that were written and the number whose
+    writes were avoided because they were unchanged, and add them to the
+    running totals of ``storage``.
+
+    :param storage: Storage of notes into which the notes were merged.
+    :param int written_count: Number of notes that were written.
+    :param int unchanged_count: Number of notes that were unchanged.
+    """
+    if not written_count and not unchanged_count:
+        return
+    _log.info('Merged client notes: {} written, {} unchanged'.format(
+        written_count, unchanged_count))
+    storage.add_merge_counts(written_count, unchanged_count)
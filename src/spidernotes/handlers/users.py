@@ -3,12 +3,11 @@ import logging
 
 from google.appengine.ext import ndb
 
-from spidernotes.handlers import BaseHandler
-from spidernotes.handlers.authentication import AUTH_SESSION_KEY
-from spidernotes.models import Note
+from spidernotes.handlers import AUTH_SESSION_KEY, BaseHandler
+from spidernotes.storage import get_storage
 from spidernotes.users import (
-    connect_user, create_auth_id, create_user, disconnect_user,
-    get_unauthenticated_auth_id, is_connected)
+    connect_user, create_auth_id, create_token, create_user, delete_user,
+    disconnect_user, is_connected)
 
 
 _log = logging.getLogger(__name__)
@@ -25,8 +24,8 @@ class _BaseUserHandler(BaseHandler):
         :param user: Current user.
         :type user: :class:`webapp2_extras.appengine.auth.models.User`
         """
-        auth_id = get_unauthenticated_auth_id(user)
-        if not auth_id:
+        token = create_token(user)
+        if not token:
             _log.error('auth_id not found for user: {}'.format(user))
             self.raise_error()
 
@@ -34,7 +33,7 @@ class _BaseUserHandler(BaseHandler):
                                  'name': getattr(user, 'name', None),
                                  'provider': getattr(user, 'provider', None),
                                  'isConnected': is_connected(user),
-                                 'token': auth_id})
+                                 'token': token})
 
 
 class UserHandler(_BaseUserHandler):
@@ -64,16 +63,19 @@ class UserHandler(_BaseUserHandler):
     def delete(self):
         """
         Delete the current :class:`google.appengine.api.users.User`.
+
+        The user is deleted immediately, but its notes are deleted by a
+        background task, so respond with a pending status.
         """
         user = self.get_user()
         if user:
             if is_connected(user):
                 disconnect_user(user)
 
-            user_key = user.key
-            Note.delete_all(user_key)
-            user_key.delete()
-        return self.render_json('')
+            delete_user(user.key)
+            get_storage().delete_all(user.key)
+        self.response.set_status(202)
+        return self.render_json({'status': 'pending'})
 
 
 class DisconnectHandler(_BaseUserHandler):
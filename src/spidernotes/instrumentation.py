@@ -0,0 +1,270 @@
+"""
+Provides per-request instrumentation of request handlers.
+
+A :class:`RequestMetrics` is started for every request by
+:meth:`spidernotes.handlers.BaseHandler.dispatch`. While it is active, the
+wall time of named phases is recorded with :func:`phase` and
+:func:`phase_iter`, excluding the time of any phases that are nested in
+them, so that the phases of a request do not overlap. Named quantities,
+such as numbers of notes, are recorded with :func:`count`, and the API calls
+that are made by ndb and the other App Engine APIs are counted by service
+with an apiproxy hook. When the request is finished, the metrics are logged as
+a json line and added to a rolling window of the most recent requests per
+route, which is summarized by :func:`get_summary`.
+
+The rolling windows are held in instance memory, so each instance summarizes
+only the requests that it has handled.
+"""
+
+from __future__ import division, unicode_literals
+import json
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+from google.appengine.api import apiproxy_stub_map
+
+
+_log = logging.getLogger(__name__)
+
+# Name of the apiproxy hook that counts API calls.
+_HOOK_NAME = 'spidernotes_instrumentation'
+
+# Prefix of the log lines of request metrics, by which they can be filtered.
+_LOG_PREFIX = 'request_metrics '
+
+# Number of the most recent requests per route from which percentiles are
+# computed.
+_WINDOW_SIZE = 1000
+
+_PERCENTILES = (50, 90, 99)
+
+_local = threading.local()
+
+_lock = threading.Lock()
+
+_windows = defaultdict(lambda: deque(maxlen=_WINDOW_SIZE))
+
+
+class RequestMetrics(object):
+    """Metrics of a single request."""
+
+    def __init__(self, route):
+        """
+        :param unicode route: Template of the route that matched the request.
+        """
+        self.route = route
+        self.counts = defaultdict(int)
+        self.phases = defaultdict(float)
+        self.rpcs = defaultdict(int)
+        self._start = time.time()
+        # Wall time of the nested phases of each active phase.
+        self._nested = []
+
+    def to_dict(self, status, request_size, response_size):
+        """
+        Return a ``dict`` representation of these metrics, in which times are
+        in milliseconds.
+
+        :param int status: HTTP status code of the response.
+        :param int request_size: Size of the request body, in bytes.
+        :param int response_size: Size of the response body, in bytes.
+        """
+        return {
+            'route': self.route,
+            'status': status,
+            'latency_ms': _to_ms(time.time() - self._start),
+            'phases_ms': {k: _to_ms(v) for k, v in self.phases.iteritems()},
+            'rpcs': dict(self.rpcs),
+            'counts': dict(self.counts),
+            'request_bytes': request_size,
+            'response_bytes': response_size,
+        }
+
+
+def count(name, value=1):
+    """
+    Add ``value`` to the quantity with the supplied ``name`` of the current
+    request, if any.
+
+    :param unicode name: Name of the quantity, such as ``notes_received``.
+    :param int value: Amount to add.
+    """
+    metrics = getattr(_local, 'metrics', None)
+    if metrics is not None:
+        metrics.counts[name] += value
+
+
+def count_iter(name, iterable):
+    """
+    Return a generator of the items of ``iterable`` that counts them as they
+    are consumed, with :func:`count`.
+
+    :param unicode name: Name of the quantity.
+    :param iterable: Iterable to count.
+    """
+    for item in iterable:
+        count(name)
+        yield item
+
+
+def get_count(name):
+    """
+    Return the quantity with the supplied ``name`` of the current request,
+    or ``0`` if there is no current request.
+
+    :param unicode name: Name of the quantity.
+    :rtype: ``int``
+    """
+    metrics = getattr(_local, 'metrics', None)
+    if metrics is None:
+        return 0
+    return metrics.counts.get(name, 0)
+
+
+def finish_request(status, request_size, response_size):
+    """
+    Log the metrics of the current request and add them to the rolling window
+    of its route.
+
+    :param int status: HTTP status code of the response.
+    :param int request_size: Size of the request body, in bytes.
+    :param int response_size: Size of the response body, in bytes.
+    """
+    metrics = getattr(_local, 'metrics', None)
+    if metrics is None:
+        return
+    _local.metrics = None
+
+    record = metrics.to_dict(status, request_size, response_size)
+    _log.info(_LOG_PREFIX + json.dumps(record, sort_keys=True))
+    with _lock:
+        _windows[metrics.route].append(record)
+
+
+def get_summary():
+    """
+    Return a ``dict`` of the percentiles of the latency, phase times, API
+    calls and sizes of the most recent requests to each route that was
+    handled by this instance.
+
+    :rtype: ``dict``
+    """
+    with _lock:
+        windows = {k: list(v) for k, v in _windows.iteritems()}
+
+    summary = {}
+    for route, records in windows.iteritems():
+        values = defaultdict(list)
+        for record in records:
+            values['latency_ms'].append(record['latency_ms'])
+            values['request_bytes'].append(record['request_bytes'])
+            values['response_bytes'].append(record['response_bytes'])
+            for key in ('phases_ms', 'rpcs', 'counts'):
+                for name, value in record[key].iteritems():
+                    values['{}.{}'.format(key, name)].append(value)
+
+        summary[route] = {
+            'requests': len(records),
+            'errors': sum(1 for o in records if o['status'] >= 500),
+            'percentiles': {
+                name: {'p{}'.format(p): _percentile(v, p, len(records))
+                       for p in _PERCENTILES}
+                for name, v in values.iteritems()},
+        }
+    return summary
+
+
+@contextmanager
+def phase(name):
+    """
+    Return a context manager that adds the wall time of its block, excluding
+    that of the phases that are nested in it, to the phase with the supplied
+    ``name`` of the current request, if any.
+
+    :param unicode name: Name of the phase, such as ``get_user``.
+    """
+    metrics = getattr(_local, 'metrics', None)
+    if metrics is None:
+        yield
+        return
+
+    nested = [0.0]
+    metrics._nested.append(nested)
+    start = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        metrics.phases[name] += elapsed - nested[0]
+        # Phases that are entered by interleaved tasklets may not exit in
+        # the order that they were entered.
+        index = next(i for i in reversed(xrange(len(metrics._nested)))
+                     if metrics._nested[i] is nested)
+        del metrics._nested[index]
+        if index:
+            metrics._nested[index - 1][0] += elapsed
+
+
+def phase_iter(name, iterable):
+    """
+    Return a generator of the items of ``iterable`` that adds the time that
+    is spent producing each item to the phase with the supplied ``name``,
+    with :func:`phase`, such as the time that a streamed query spends
+    fetching its batches while a response is rendered.
+
+    :param unicode name: Name of the phase.
+    :param iterable: Iterable to time.
+    """
+    iterator = iter(iterable)
+    while True:
+        with phase(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def start_request(route):
+    """
+    Start recording the metrics of a request in the current thread.
+
+    :param unicode route: Template of the route that matched the request.
+    :rtype: :class:`RequestMetrics`
+    """
+    # The hook is appended on every request, rather than once, in case the
+    # stub map has been replaced, as it is by the testbed. Appending a hook
+    # whose name is already registered does nothing.
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(_HOOK_NAME,
+                                                         _count_rpc)
+    _local.metrics = RequestMetrics(route)
+    return _local.metrics
+
+
+def _count_rpc(service, call, request, response):
+    """Count an API call by the current request, if any."""
+    metrics = getattr(_local, 'metrics', None)
+    if metrics is not None:
+        metrics.rpcs[service] += 1
+
+
+def _percentile(values, percent, total):
+    """
+    Return the nearest-rank ``percent`` percentile of ``values``, where a
+    missing value, of a phase that did not occur, counts as zero.
+
+    :param list values: Recorded values.
+    :param int percent: Percentile to return.
+    :param int total: Number of requests, including those without a value.
+    """
+    values = sorted(values)
+    values[:0] = [0] * (total - len(values))
+    index = max(0, int(-(-percent * len(values) // 100)) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def _to_ms(seconds):
+    return round(seconds * 1000, 2)
@@ -0,0 +1,204 @@
+"""
+Provides incremental parsing of json request bodies.
+"""
+
+from __future__ import unicode_literals
+import codecs
+import json
+
+
+_CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = ' \t\n\r'
+
+
+class RequestTooLargeError(ValueError):
+    """Raised when a request body or an item within it is too large."""
+
+
+def iter_object(file_, stream_keys=(), max_size=None, max_item_size=None):
+    """
+    Incrementally parse the json object that is read from ``file_`` and yield
+    its members as (key, value) tuples.
+
+    The value of a member whose key is in ``stream_keys`` and which is an
+    array is yielded as a generator of the array's items, which are parsed
+    as they are consumed. Unconsumed items are skipped when the next member is
+    read.
+
+    :param file_: File-like object from which to read UTF-8 encoded json.
+    :param stream_keys: Keys of the members whose arrays to parse lazily.
+    :param int max_size: Maximum number of bytes to read from ``file_``, or
+        ``None`` for no limit.
+    :param int max_item_size: Maximum number of characters of a streamed
+        array item, or ``None`` for no limit.
+    :raises RequestTooLargeError: If a size limit is exceeded.
+    :raises ValueError: If the json is malformed.
+    :return: Generator of (key, value) tuples.
+    """
+    reader = _Reader(file_, max_size)
+    reader.expect('{')
+    if reader.peek() == '}':
+        reader.expect('}')
+        return
+
+    while True:
+        key = reader.value()
+        if not isinstance(key, basestring):
+            raise ValueError('Invalid object key: {}'.format(key))
+        reader.expect(':')
+
+        if key in stream_keys and reader.peek() == '[':
+            items = reader.iter_array(max_item_size)
+            yield key, items
+            for _ in items:
+                pass
+        else:
+            yield key, reader.value()
+
+        if reader.peek() == '}':
+            reader.expect('}')
+            return
+        reader.expect(',')
+
+
+def iter_values(file_, max_size=None, max_item_size=None):
+    """
+    Incrementally parse a sequence of json values that are separated by
+    whitespace, such as newline-delimited json, from ``file_``, and yield
+    them one at a time.
+
+    :param file_: File-like object from which to read UTF-8 encoded json.
+    :param int max_size: Maximum number of bytes to read from ``file_``, or
+        ``None`` for no limit.
+    :param int max_item_size: Maximum number of characters of a value, or
+        ``None`` for no limit.
+    :raises RequestTooLargeError: If a size limit is exceeded.
+    :raises ValueError: If the json is malformed.
+    :return: Generator of values.
+    """
+    reader = _Reader(file_, max_size)
+    while reader.peek():
+        yield reader.value(max_item_size)
+
+
+class _Reader(object):
+    """Reads json values from a buffered file-like object."""
+
+    def __init__(self, file_, max_size):
+        self._file = file_
+        self._max_size = max_size
+        self._decoder = codecs.getincrementaldecoder('UTF8')()
+        self._json_decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._size = 0
+        self._is_eof = False
+
+    def expect(self, char):
+        """Consume the next non-whitespace character if it is ``char``."""
+        actual = self.peek()
+        if actual != char:
+            raise ValueError('Expected "{}" but found "{}"'.format(char,
+                                                                  actual))
+        self._pos += 1
+
+    def iter_array(self, max_item_size=None):
+        """
+        Return a generator of the items of the array at the current position.
+
+        :param int max_item_size: Maximum number of characters of an item, or
+            ``None`` for no limit.
+        """
+        self.expect('[')
+        if self.peek() == ']':
+            self.expect(']')
+            return
+
+        while True:
+            yield self.value(max_item_size)
+            if self.peek() == ']':
+                self.expect(']')
+                return
+            self.expect(',')
+
+    def peek(self):
+        """
+        Return the next non-whitespace character without consuming it, or an
+        empty string at the end of the input.
+        """
+        while True:
+            buffer_ = self._buffer
+            length = len(buffer_)
+            pos = self._pos
+            while pos < length and buffer_[pos] in _WHITESPACE:
+                pos += 1
+            self._pos = pos
+            if pos < length:
+                return buffer_[pos]
+            if not self._fill():
+                return ''
+
+    def value(self, max_size=None):
+        """
+        Consume and return the json value at the current position.
+
+        :param int max_size: Maximum number of characters of the value, or
+            ``None`` for no limit.
+        """
+        self.peek()
+        while True:
+            try:
+                obj, end = self._json_decoder.raw_decode(self._buffer,
+                                                         self._pos)
+            except ValueError:
+                pass
+            else:
+                # A number at the end of the buffer may be incomplete.
+                if end < len(self._buffer) or self._is_eof:
+                    self._check_size(end - self._pos, max_size)
+                    self._pos = end
+                    return obj
+
+            # The value is longer than the buffered input, which may include
+            # the values that follow it, so it is at least as long as that.
+            length = len(self._buffer) - self._pos
+            self._check_size(length, max_size)
+            if not self._fill():
+                raise ValueError('Unexpected end of input')
+
+            # Double the buffered input before retrying, so that a large value
+            # is not re-parsed once per chunk, but read no more than is needed
+            # to tell whether the value exceeds ``max_size``.
+            target = 2 * length
+            if max_size:
+                target = min(target, max_size + 1)
+            while (not self._is_eof and
+                   len(self._buffer) - self._pos < target):
+                self._fill()
+
+    def _check_size(self, length, max_size):
+        """Raise an error if ``length`` characters exceed ``max_size``."""
+        if max_size and length > max_size:
+            raise RequestTooLargeError(
+                'Item exceeds {} characters'.format(max_size))
+
+    def _fill(self):
+        """
+        Read the next chunk of input into the buffer, and return ``False`` if
+        there is no more input.
+        """
+        if self._is_eof:
+            return False
+
+        data = self._file.read(_CHUNK_SIZE)
+        self._size += len(data)
+        if self._max_size and self._size > self._max_size:
+            raise RequestTooLargeError(
+                'Request exceeds {} bytes'.format(self._max_size))
+
+        self._is_eof = not data
+        text = self._decoder.decode(data, final=self._is_eof)
+        self._buffer = self._buffer[self._pos:] + text
+        self._pos = 0
+        return True
@@ -1,30 +1,112 @@
 from __future__ import unicode_literals
+import hashlib
+from collections import defaultdict
+from datetime import timedelta
 
 from google.appengine.ext import ndb
 from google.appengine.ext.ndb.key import Key
 
-from spidernotes.utils import to_timestamp
+from spidernotes import instrumentation
+from spidernotes.bloom import BloomFilter
+from spidernotes.buckets import (
+    BUCKET_COUNT, get_bucket, get_digest, pack_hashes, unpack_hashes)
+from spidernotes.tasks import enqueue
+from spidernotes.timestamps import EPOCH, get_next, to_milliseconds, utcnow
+from spidernotes.utils import iter_batches, normalize_url
+
+
+# Keys of the values of a note in the columnar representation that is
+# returned by :meth:`Note.to_row`, in order.
+NOTE_COLUMNS = ('id', 'body', 'url', 'isDeleted', 'created', 'modified')
+
+# Number of notes that are deleted per batch by background tasks.
+_DELETE_BATCH_SIZE = 500
+
+# Number of notes whose index keys are set per batch by background tasks.
+_INDEX_BATCH_SIZE = 500
+
+# Number of deleted notes that are purged per batch by background tasks.
+_PURGE_BATCH_SIZE = 500
+
+# Number of times that a merge is retried when it conflicts with a
+# concurrent merge into the same user's notes.
+_MERGE_RETRIES = 5
+
+# Minimum number of url keys for which a url filter is sized.
+_MIN_URL_FILTER_CAPACITY = 1024
+
+# Time after which a build of a url filter or bucket hashes that has not
+# been saved is assumed to have failed, so that another build is enqueued.
+_BUILD_TIMEOUT = timedelta(minutes=15)
 
 
 class Note(ndb.Model):
     body = ndb.TextProperty()
-    url = ndb.StringProperty()
+    url = ndb.StringProperty(indexed=False)
+    # Hash of the normalized url, and the url's host, by which active notes
+    # are looked up. Both are ``None`` for deleted notes.
+    url_key = ndb.StringProperty()
+    host_key = ndb.StringProperty()
+    # Index of the bucket of the note, by which notes are reconciled. It is
+    # set when the note is put.
+    bucket = ndb.IntegerProperty()
     is_deleted = ndb.BooleanProperty(required=True, default=False)
     created = ndb.DateTimeProperty(required=True, indexed=False)
     modified = ndb.DateTimeProperty(required=True)
+    # ``created`` and ``modified`` as JavaScript timestamps, so that they are
+    # serialized without conversion. They are set when the note is put, and
+    # are ``None`` for notes that have not been put since they were
+    # introduced.
+    created_ms = ndb.IntegerProperty(indexed=False)
+    modified_ms = ndb.IntegerProperty(indexed=False)
     synchronized = ndb.DateTimeProperty(required=True)
+    fingerprint = ndb.StringProperty(indexed=False)
+
+    @staticmethod
+    def compute_fingerprint(note):
+        """
+        Return a fingerprint of the content of the supplied ``note``, which
+        covers its body, url, deleted flag and modified datetime.
+
+        :param note: Note-like object of which to compute the fingerprint.
+        :return: Hexadecimal digest.
+        :rtype: ``unicode``
+        """
+        data = '\x00'.join([note.body or '',
+                            note.url or '',
+                            '1' if note.is_deleted else '0',
+                            note.modified.isoformat()])
+        return unicode(hashlib.sha1(data.encode('UTF8')).hexdigest())
+
+    @staticmethod
+    def compute_url_keys(url):
+        """
+        Return a tuple of the url key and the host key of the supplied
+        ``url``, which are ``None`` if it cannot be normalized.
+
+        The url key is a hash of the normalized url, so that it is short
+        enough to be indexed however long the url is.
+
+        :param unicode url: URL of which to compute the keys.
+        :rtype: ``tuple``
+        """
+        normalized_url, host = normalize_url(url)
+        if normalized_url is None:
+            return None, None
+        url_key = hashlib.sha1(normalized_url.encode('UTF8')).hexdigest()
+        return unicode(url_key), host
 
     @classmethod
     def delete_all(cls, user_key):
         """
-        Delete all of the notes that are associated with ``user_key``.
+        Enqueue a background task that deletes all of the notes that are
+        associated with ``user_key``, in batches.
 
         :param user_key:  Key of the :class:`google.appengine.api.users.User`
             for which to delete the notes.
         :type user_key: :class:`google.appengine.ext.db.Key`
         """
-        keys = cls._get(user_key).iter(keys_only=True)
-        ndb.delete_multi_async(keys)
+        enqueue(_delete_notes, user_key)
 
     @classmethod
     def get_active(cls, user_key):
@@ -41,6 +123,44 @@ class Note(ndb.Model):
         """
         return cls._get(user_key).filter(cls.is_deleted == False)
 
+    @classmethod
+    def get_by_host(cls, user_key, host):
+        """
+        Return a :class:`google.appengine.ext.ndb.query.Query` of the active
+        :class:`spidernotes.models.Note` instances that are associated with
+        the supplied ``user_key``, and whose url has the supplied ``host``,
+        most recently modified first.
+
+        :param user_key: Key of the :class:`google.appengine.api.users.User`
+            with which the notes are associated.
+        :param unicode host: Host name, which is case-insensitive.
+        :type user_key: :class:`google.appengine.ext.db.Key`
+        :rtype: :class:`google.appengine.ext.ndb.query.Query`
+        """
+        return cls.query(cls.host_key == host.lower().rstrip('.'),
+                         ancestor=user_key).order(-cls.modified)
+
+    @classmethod
+    def get_by_url(cls, user_key, url):
+        """
+        Return a :class:`google.appengine.ext.ndb.query.Query` of the active
+        :class:`spidernotes.models.Note` instances that are associated with
+        the supplied ``user_key``, and whose url normalizes to the same url
+        as the supplied ``url``, most recently modified first, or ``None`` if
+        ``url`` cannot be normalized.
+
+        :param user_key: Key of the :class:`google.appengine.api.users.User`
+            with which the notes are associated.
+        :param unicode url: URL of the notes.
+        :type user_key: :class:`google.appengine.ext.db.Key`
+        :rtype: :class:`google.appengine.ext.ndb.query.Query` or ``None``
+        """
+        url_key, _ = cls.compute_url_keys(url)
+        if url_key is None:
+            return None
+        return cls.query(cls.url_key == url_key,
+                         ancestor=user_key).order(-cls.modified)
+
     @classmethod
     def get_or_create(cls, user_key, note_id):
         """
@@ -66,23 +186,196 @@ class Note(ndb.Model):
         return note, is_created
 
     @classmethod
-    def get_synchronized_after(cls, user_key, last_synchronized):
+    def get_or_create_multi(cls, user_key, note_ids):
+        """
+        Bulk counterpart of :meth:`get_or_create`. Fetch every note that has
+        one of the supplied ``note_ids`` with a single batched datastore get,
+        and create a new note for each id that does not exist.
+
+        :param user_key: Key of the :class:`google.appengine.api.users.User`
+            that is associated with the notes.
+        :param note_ids: Iterable of unique note identifiers.
+        :type user_key: :class:`google.appengine.ext.db.Key`
+        :return: List of (Note, created boolean) tuples, in the same order as
+            ``note_ids``.
+        :rtype: ``list``
+        """
+        return cls.get_or_create_multi_async(user_key, note_ids).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_or_create_multi_async(cls, user_key, note_ids):
+        """
+        Asynchronous version of :meth:`get_or_create_multi`.
+
+        :return: Future whose result is a list of (Note, created boolean)
+            tuples.
+        :rtype: :class:`google.appengine.ext.ndb.tasklets.Future`
+        """
+        keys = [Key(cls, note_id, parent=user_key) for note_id in note_ids]
+        notes = yield ndb.get_multi_async(keys)
+        results = []
+        for key, note in zip(keys, notes):
+            if note:
+                results.append((note, False))
+            else:
+                results.append((cls(key=key), True))
+        raise ndb.Return(results)
+
+    @classmethod
+    def merge_multi(cls, user_key, note_ids, from_notes):
+        """
+        Transactionally merge ``from_notes`` into the notes that are
+        associated with ``user_key``, creating those that do not exist.
+
+        The updated notes are stamped with the user's next synchronization
+        datetime, which is later than that of every earlier merge, and the
+        user's :class:`SyncState`, :class:`UrlFilter` and
+        :class:`BucketHashes` are updated in the same transaction. Concurrent
+        merges into the same user's notes are therefore ordered: a merge
+        that conflicts with another is retried, and then reads the notes that
+        the other wrote. Callers should merge notes in short batches, so that
+        transactions are small and rarely conflict.
+
+        :param user_key: Key of the :class:`google.appengine.api.users.User`
+            into whose notes to merge.
+        :param list note_ids: Unique identifiers of ``from_notes``.
+        :param list from_notes: Note-like objects to merge.
+        :type user_key: :class:`google.appengine.ext.db.Key`
+        :return: Tuple of the keys of the notes that ``from_notes``
+            supersede, the number of notes that were written and the number
+            of superseded notes that were unchanged.
+        :rtype: ``tuple``
+        """
+        return cls.merge_multi_async(user_key, note_ids,
+                                     from_notes).get_result()
+
+    @classmethod
+    @ndb.transactional_tasklet(retries=_MERGE_RETRIES)
+    def merge_multi_async(cls, user_key, note_ids, from_notes):
+        """
+        Asynchronous version of :meth:`merge_multi`.
+
+        :return: Future whose result is a tuple of the superseded keys, the
+            written count and the unchanged count.
+        :rtype: :class:`google.appengine.ext.ndb.tasklets.Future`
+        """
+        with instrumentation.phase('get_notes'):
+            state, notes = yield (
+                SyncState.get_for_user_async(user_key),
+                cls.get_or_create_multi_async(user_key, note_ids))
+        synchronized = state.get_next_synchronized()
+        changes = NoteChanges()
+        superseded_keys, to_persist, unchanged_count = cls.merge_all(
+            notes, from_notes, synchronized, changes)
+
+        if to_persist:
+            state.synchronized = synchronized
+            yield ndb.put_multi_async(to_persist + [state])
+            yield changes.apply_async(user_key, synchronized)
+        raise ndb.Return((superseded_keys, len(to_persist), unchanged_count))
+
+    @staticmethod
+    def merge_all(notes, from_notes, last_synchronized, changes=None):
+        """
+        Merge each of ``from_notes`` into the corresponding note of
+        ``notes`` with :meth:`merge_from_note`.
+
+        :param list notes: (Note, created boolean) tuples, as returned by
+            :meth:`get_or_create_multi`.
+        :param list from_notes: Note-like objects to merge.
+        :param datetime.datetime last_synchronized: Datetime to set on the
+            notes that are updated.
+        :param changes: Changes in which to record the updated notes, or
+            ``None``.
+        :type changes: :class:`NoteChanges` or ``None``
+        :return: Tuple of the keys of the notes that ``from_notes``
+            supersede, a list of the notes that were updated and must be
+            persisted, and the number of superseded notes that were
+            unchanged.
+        :rtype: ``tuple``
+        """
+        superseded_keys = []
+        to_persist = []
+        unchanged_count = 0
+        for from_note, (note, is_created) in zip(from_notes, notes):
+            if changes is not None:
+                old_state = changes.get_state(note, is_created)
+            is_superseded, is_updated = note.merge_from_note(
+                from_note, is_created, last_synchronized)
+            if is_updated:
+                to_persist.append(note)
+                if changes is not None:
+                    changes.record(old_state, note)
+            elif is_superseded:
+                # Rewriting an unchanged note would only stamp it as
+                # synchronized again, and echo it to the other devices.
+                unchanged_count += 1
+            if is_superseded:
+                superseded_keys.append(note.key)
+        return superseded_keys, to_persist, unchanged_count
+
+    @classmethod
+    def get_synchronized_after(cls, user_key, last_synchronized, until=None):
         """
         Return a :class:`google.appengine.ext.ndb.query.Query` of
         :class:`spidernotes.models.Note` instances that are associated with the
         supplied ``user_key``, and were synchronized after the
-        ``last_synchronized`` datetime.
+        ``last_synchronized`` datetime and, if ``until`` is supplied, at or
+        before the ``until`` datetime.
 
         :param user_key: Key of the :class:`google.appengine.api.users.User`
             with which the notes are associated.
         :param datetime.datetime last_synchronized: Datetime after which to
             filter the notes.
+        :param datetime.datetime until: Datetime at or before which to filter
+            the notes.
         :type user_key: :class:`google.appengine.ext.db.Key`
         :type last_synchronized: :class:`datetime.datetime` or ``None``.
+        :type until: :class:`datetime.datetime` or ``None``.
         :return: Query of note keys.
         :rtype: `:class:`google.appengine.ext.ndb.query.Query`
         """
-        return cls._get(user_key).filter(cls.synchronized > last_synchronized)
+        query = cls._get(user_key).filter(cls.synchronized > last_synchronized)
+        if until is not None:
+            query = query.filter(cls.synchronized <= until)
+        return query
+
+    @classmethod
+    def get_by_bucket(cls, user_key, bucket):
+        """
+        Return a :class:`google.appengine.ext.ndb.query.Query` of the
+        :class:`spidernotes.models.Note` instances, including deleted notes,
+        that are associated with the supplied ``user_key`` and are in the
+        supplied ``bucket``.
+
+        :param user_key: Key of the :class:`google.appengine.api.users.User`
+            with which the notes are associated.
+        :param int bucket: Index of the bucket.
+        :type user_key: :class:`google.appengine.ext.db.Key`
+        :rtype: :class:`google.appengine.ext.ndb.query.Query`
+        """
+        return cls.query(cls.bucket == bucket, ancestor=user_key)
+
+    @classmethod
+    def index_all(cls):
+        """
+        Enqueue a background task that sets the url keys, bucket and
+        timestamps of every note that was saved before they were introduced,
+        in batches.
+        """
+        enqueue(_index_notes)
+
+    @classmethod
+    def purge_deleted(cls, horizon):
+        """
+        Enqueue a background task that purges the deleted notes of every user
+        that were synchronized before ``horizon``, in batches.
+
+        :param datetime.datetime horizon: Datetime before which deleted notes
+            are purged.
+        """
+        enqueue(_purge_deleted_notes, horizon)
 
     @classmethod
     def _get(cls, user_key):
@@ -99,25 +392,82 @@ class Note(ndb.Model):
         """
         return cls.query(ancestor=user_key).order(-cls.synchronized)
 
-    def copy_to_user(self, to_user_key):
+    def get_created_ms(self):
+        """
+        Return the ``created`` datetime of this instance as a JavaScript
+        timestamp, which is converted if it was not stored.
+
+        :rtype: ``int``
+        """
+        ms = self.created_ms
+        if ms is None:
+            return to_milliseconds(self.created)
+        return ms
+
+    def get_fingerprint(self):
+        """
+        Return the fingerprint of this instance, which is computed if it was
+        not stored.
+
+        :rtype: ``unicode``
+        """
+        return self.fingerprint or self.compute_fingerprint(self)
+
+    def get_modified_ms(self):
+        """
+        Return the ``modified`` datetime of this instance as a JavaScript
+        timestamp, which is converted if it was not stored.
+
+        :rtype: ``int``
+        """
+        ms = self.modified_ms
+        if ms is None:
+            return to_milliseconds(self.modified)
+        return ms
+
+    def index_url(self):
+        """
+        Set the url key and the host key of this instance from its url, or
+        clear them if this instance is deleted.
+        """
+        if self.is_deleted:
+            self.url_key = self.host_key = None
+        else:
+            self.url_key, self.host_key = self.compute_url_keys(self.url)
+
+    def _pre_put_hook(self):
+        if self.bucket is None:
+            self.bucket = get_bucket(self.key.id())
+        self.created_ms = to_milliseconds(self.created)
+        self.modified_ms = to_milliseconds(self.modified)
+
+    def merge_from_note(self, from_note, is_created, last_synchronized):
         """
-        Return a new Note that is associated with the supplied ``to_user_key``,
-        and whose data is copied from this instance.
+        Merge ``from_note`` into this instance using a last-writer-wins rule.
 
-        :param to_user_key: Key of the :class:`google.appengine.api.users.User`
-            with which to associate the new note.
-        :type to_user_key: :class:`google.appengine.ext.db.Key`
-        :return: Newly created note.
-        :rtype: :class:`spidernotes.models.Note`
+        ``from_note`` supersedes this instance if this instance was newly
+        created, or if ``from_note`` was modified at the same time or later.
+        This instance is then updated from ``from_note``, unless its content
+        is already the same.
+
+        :param from_note: Note to merge.
+        :param bool is_created: Whether this instance was newly created.
+        :param datetime.datetime last_synchronized: Datetime to set on this
+            instance if it is updated.
+        :type from_note: ``NoteTuple`` or :class:`spidernotes.models.Note`
+        :return: Tuple of whether ``from_note`` supersedes this instance, and
+            whether this instance was updated and so must be persisted.
+        :rtype: ``tuple``
         """
-        from_id = self.key.id()
-        return Note(id=from_id,
-                    parent=to_user_key,
-                    body=self.body,
-                    url=self.url,
-                    created=self.created,
-                    modified=self.modified,
-                    synchronized=self.synchronized)
+        if is_created:
+            self.update_from_note(from_note, last_synchronized)
+            return True, True
+        if from_note.modified < self.modified:
+            return False, False
+        if self.get_fingerprint() == self.compute_fingerprint(from_note):
+            return True, False
+        self.update_from_note(from_note, last_synchronized)
+        return True, True
 
     def to_dict(self):
         """Return a ``dict`` representation of this instance."""
@@ -126,8 +476,21 @@ class Note(ndb.Model):
                 'body': self.body if not is_deleted else '',
                 'url': self.url if not is_deleted else '',
                 'isDeleted': is_deleted,
-                'created': to_timestamp(self.created),
-                'modified': to_timestamp(self.modified)}
+                'created': self.get_created_ms(),
+                'modified': self.get_modified_ms()}
+
+    def to_row(self):
+        """
+        Return a ``list`` representation of this instance, whose values are
+        those of :meth:`to_dict` in the order of :data:`NOTE_COLUMNS`.
+        """
+        is_deleted = self.is_deleted
+        return [self.key.id(),
+                self.body if not is_deleted else '',
+                self.url if not is_deleted else '',
+                is_deleted,
+                self.get_created_ms(),
+                self.get_modified_ms()]
 
     def update_from_note(self, from_note, last_synchronized):
         """
@@ -144,4 +507,668 @@ class Note(ndb.Model):
         self.is_deleted = from_note.is_deleted
         self.created = from_note.created
         self.modified = from_note.modified
-        self.synchronized = last_synchronized
\ No newline at end of file
+        self.synchronized = last_synchronized
+        self.fingerprint = self.compute_fingerprint(from_note)
+        self.index_url()
+
+
+class SyncState(ndb.Model):
+    """
+    Synchronization state of a user.
+
+    Each user has at most one instance, which is a child of the user's key so
+    that it is in the same entity group as the user's notes. Instances are
+    cached in memcache by ndb, so that they can be read without accessing the
+    datastore.
+
+    ``synchronized`` is the latest datetime with which the user's notes have
+    been stamped. It is advanced by every merge that writes notes, in the
+    same transaction as its notes, so every note that was stamped at or
+    before ``synchronized`` has been committed.
+
+    ``purged`` is the latest ``synchronized`` datetime of the user's deleted
+    notes that have been purged, so clients that last synchronized before it
+    may have missed deletions.
+    """
+    synchronized = ndb.DateTimeProperty(indexed=False)
+    purged = ndb.DateTimeProperty(indexed=False)
+
+    _use_memcache = True
+
+    @classmethod
+    @ndb.transactional_tasklet
+    def advance_async(cls, user_key, synchronized):
+        """
+        Transactionally set the ``synchronized`` datetime of the state of the
+        user with the supplied ``user_key``, unless it is already later, and
+        create the state if it does not exist.
+
+        :param user_key: Key of the :class:`google.appengine.api.users.User`
+            whose state to update.
+        :param datetime.datetime synchronized: Latest datetime at which a note
+            was synchronized, or ``None`` if the user has no notes.
+        :type user_key: :class:`google.appengine.ext.db.Key`
+        :return: Future whose result is the updated state.
+        :rtype: :class:`google.appengine.ext.ndb.tasklets.Future`
+        """
+        key = cls.key_for_user(user_key)
+        state = yield key.get_async()
+        if state is None:
+            state = cls(key=key, synchronized=synchronized)
+        elif (synchronized is not None and
+              (state.synchronized is None or
+               state.synchronized < synchronized)):
+            state.synchronized = synchronized
+        else:
+            raise ndb.Return(state)
+        yield state.put_async()
+        raise ndb.Return(state)
+
+    @classmethod
+    def get_for_user(cls, user_key):
+        """
+        Return the state of the user with the supplied ``user_key``.
+
+        :param user_key: Key of the :class:`google.appengine.api.users.User`
+            whose state to return.
+        :type user_key: :class:`google.appengine.ext.db.Key`
+        :rtype: :class:`spidernotes.models.SyncState`
+        """
+        return cls.get_for_user_async(user_key).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_for_user_async(cls, user_key):
+        """
+        Asynchronous version of :meth:`get_for_user`.
+
+        If the state does not exist, then it is created from the user's most
+        recently synchronized note.
+
+        :return: Future whose result is the state.
+        :rtype: :class:`google.appengine.ext.ndb.tasklets.Future`
+        """
+        state = yield cls.key_for_user(user_key).get_async()
+        if state is None:
+            note = yield Note._get(user_key).get_async()
+            synchronized = note.synchronized if note else None
+            state = yield cls.advance_async(user_key, synchronized)
+        raise ndb.Return(state)
+
+    @classmethod
+    def key_for_user(cls, user_key):
+        """
+        Return the key of the state of the user with the supplied
+        ``user_key``.
+
+        :param user_key: Key of the :class:`google.appengine.api.users.User`.
+        :type user_key: :class:`google.appengine.ext.db.Key`
+        :rtype: :class:`google.appengine.ext.ndb.key.Key`
+        """
+        return Key(cls, 'sync', parent=user_key)
+
+    def get_next_synchronized(self):
+        """
+        Return the datetime with which to stamp the notes of the next merge,
+        which is the current datetime, unless it is not later than
+        ``synchronized``, as it may be if the clocks of instances differ.
+
+        :rtype: :class:`datetime.datetime`
+        """
+        return get_next(self.synchronized)
+
+    def has_purged_after(self, last_synchronized):
+        """
+        Return ``True`` if deleted notes that were synchronized after
+        ``last_synchronized`` may have been purged, in which case a client
+        that last synchronized then must synchronize all of its notes again.
+        A client that has never synchronized does not need to.
+
+        :param datetime.datetime last_synchronized: Datetime at which the
+            client last synchronized.
+        :rtype: ``bool``
+        """
+        return (self.purged is not None and
+                EPOCH < last_synchronized < self.purged)
+
+
+class BucketHashes(ndb.Model):
+    """
+    Hashes of the buckets of a user's notes, by which clients reconcile their
+    notes, as described in :mod:`spidernotes.buckets`.
+
+    Each user has at most one instance, which is a child of the user's key.
+    The hashes are updated as notes are merged, after they are first built
+    from the notes by a background task. ``build_started`` is the datetime
+    at which the pending build was enqueued, if any.
+    """
+    hashes = ndb.BlobProperty()
+    build_started = ndb.DateTimeProperty(indexed=False)
+
+    _use_memcache = True
+
+    @classmethod
+    def get_or_build(cls, user_key):
+        """
+        Return the bucket hashes of the user with the supplied ``user_key``,
+        or if they have not been built, then enqueue a task that builds them,
+        unless a build is in progress, and return ``None``.
+
+        The hashes are read without a transaction, which is only used to
+        enqueue a build.
+
+        :param user_key: Key of the :class:`google.appengine.api.users.User`
+            whose hashes to return.
+        :type user_key: :class:`google.appengine.ext.db.Key`
+        :rtype: :class:`spidernotes.models.BucketHashes` or ``None``
+        """
+        bucket_hashes = cls.key_for_user(user_key).get()
+        if bucket_hashes is not None and bucket_hashes.hashes is not None:
+            return bucket_hashes
+        if (bucket_hashes is None or
+                not _is_building(bucket_hashes.build_started)):
+            cls._enqueue_build(user_key)
+        return None
+
+    @classmethod
+    @ndb.transactional
+    def _enqueue_build(cls, user_key):
+        """
+        Transactionally enqueue a task that builds the hashes of the user with
+        the supplied ``user_key``, unless they have been built, or a build is
+        in progress.
+        """
+        key = cls.key_for_user(user_key)
+        bucket_hashes = key.get() or cls(key=key)
+        if (bucket_hashes.hashes is None and
+                not _is_building(bucket_hashes.build_started)):
+            bucket_hashes.build_started = utcnow()
+            bucket_hashes.put()
+            enqueue(_build_bucket_hashes, user_key, _transactional=True)
+
+    @classmethod
+    def key_for_user(cls, user_key):
+        """
+        Return the key of the bucket hashes of the user with the supplied
+        ``user_key``.
+
+        :param user_key: Key of the :class:`google.appengine.api.users.User`.
+        :type user_key: :class:`google.appengine.ext.db.Key`
+        :rtype: :class:`google.appengine.ext.ndb.key.Key`
+        """
+        return Key(cls, 'buckets', parent=user_key)
+
+    def apply_changes(self, changes):
+        """
+        Update these hashes with the digests of merged notes.
+
+        :param changes: Changes of merged notes.
+        :type changes: :class:`NoteChanges`
+        """
+        hashes = self.get_hashes()
+        for bucket, digest_delta in changes.digest_deltas.iteritems():
+            hashes[bucket] ^= digest_delta
+        self.hashes = pack_hashes(hashes)
+
+    def get_hashes(self):
+        """Return a list of the hash of each bucket, by bucket index."""
+        return unpack_hashes(self.hashes)
+
+
+class UrlFilter(ndb.Model):
+    """
+    Bloom filter of the url keys of a user's active notes, which clients
+    download to check whether a page has notes without a request.
+
+    Each user has at most one instance, which is a child of the user's key.
+    Url keys are added as notes are merged, but cannot be removed, so the
+    filter is rebuilt from the notes by a background task when it holds more
+    url keys than its capacity, or when many of its url keys are stale.
+    ``version`` is the synchronization datetime of the latest merge that
+    changed the filter, and ``build_started`` is the datetime at which the
+    pending build was enqueued, if any.
+    """
+    bits = ndb.BlobProperty()
+    bit_count = ndb.IntegerProperty(indexed=False)
+    hash_count = ndb.IntegerProperty(indexed=False)
+    capacity = ndb.IntegerProperty(indexed=False, default=0)
+    item_count = ndb.IntegerProperty(indexed=False, default=0)
+    stale_count = ndb.IntegerProperty(indexed=False, default=0)
+    version = ndb.DateTimeProperty(indexed=False)
+    build_started = ndb.DateTimeProperty(indexed=False)
+
+    _use_memcache = True
+
+    @classmethod
+    def get_or_build(cls, user_key):
+        """
+        Return the filter of the user with the supplied ``user_key``, or if it
+        has not been built, then enqueue a task that builds it, unless a build
+        is in progress, and return ``None``.
+
+        The filter is read without a transaction, which is only used to
+        enqueue a build.
+
+        :param user_key: Key of the :class:`google.appengine.api.users.User`
+            whose filter to return.
+        :type user_key: :class:`google.appengine.ext.db.Key`
+        :rtype: :class:`spidernotes.models.UrlFilter` or ``None``
+        """
+        url_filter = cls.key_for_user(user_key).get()
+        if url_filter is not None and url_filter.bits is not None:
+            return url_filter
+        if url_filter is None or not _is_building(url_filter.build_started):
+            cls._enqueue_build(user_key)
+        return None
+
+    @classmethod
+    @ndb.transactional
+    def _enqueue_build(cls, user_key):
+        """
+        Transactionally enqueue a task that builds the filter of the user with
+        the supplied ``user_key``, unless it has been built, or a build is in
+        progress.
+        """
+        key = cls.key_for_user(user_key)
+        url_filter = key.get() or cls(key=key)
+        if (url_filter.bits is None and
+                not _is_building(url_filter.build_started)):
+            url_filter.build_started = utcnow()
+            url_filter.put()
+            enqueue(_build_url_filter, user_key, _transactional=True)
+
+    @classmethod
+    def key_for_user(cls, user_key):
+        """
+        Return the key of the filter of the user with the supplied
+        ``user_key``.
+
+        :param user_key: Key of the :class:`google.appengine.api.users.User`.
+        :type user_key: :class:`google.appengine.ext.db.Key`
+        :rtype: :class:`google.appengine.ext.ndb.key.Key`
+        """
+        return Key(cls, 'urls', parent=user_key)
+
+    def apply_changes(self, changes, version):
+        """
+        Add the url keys of merged notes to this filter, and enqueue a
+        rebuild of this filter if it has become too full or stale.
+
+        :param changes: Changes of merged notes.
+        :param datetime.datetime version: Synchronization datetime of the
+            merge.
+        :type changes: :class:`NoteChanges`
+        :return: ``True`` if this filter was changed, and so must be put, or
+            ``False`` if the merge did not change any url key, in which case
+            ``version`` is not advanced, so clients keep their copy.
+        :rtype: ``bool``
+        """
+        if not (changes.added_url_keys or changes.stale_url_key_count):
+            return False
+        if changes.added_url_keys:
+            bloom_filter = self.get_bloom_filter()
+            for url_key in changes.added_url_keys:
+                bloom_filter.add(url_key)
+            self.bits = bloom_filter.to_bytes()
+            self.item_count += len(changes.added_url_keys)
+        self.stale_count += changes.stale_url_key_count
+        if self.version is None or self.version < version:
+            self.version = version
+
+        if self.needs_rebuild() and not _is_building(self.build_started):
+            self.build_started = utcnow()
+            enqueue(_build_url_filter, self.key.parent(), _transactional=True)
+        return True
+
+    def get_bloom_filter(self):
+        """Return a :class:`spidernotes.bloom.BloomFilter` of this filter."""
+        return BloomFilter(self.bit_count, self.hash_count, self.bits)
+
+    def needs_rebuild(self):
+        """
+        Return ``True`` if this filter holds more url keys than its capacity,
+        or if more than half of its url keys are stale.
+        """
+        return (self.item_count > self.capacity or
+                self.stale_count > self.item_count // 2)
+
+
+class NoteChanges(object):
+    """
+    Collects the changes of notes as they are merged, and applies them to
+    the user's :class:`UrlFilter` and :class:`BucketHashes`.
+
+    Usage::
+
+        changes = NoteChanges()
+        state = changes.get_state(note, is_created)
+        # Merge into the note.
+        changes.record(state, note)
+        changes.apply_async(user_key, synchronized)
+    """
+
+    def __init__(self):
+        self.added_url_keys = []
+        self.stale_url_key_count = 0
+        # Bucket index to the XOR of the old and new digests of its notes.
+        self.digest_deltas = defaultdict(int)
+
+    def __nonzero__(self):
+        return bool(self.added_url_keys or self.stale_url_key_count or
+                    self.digest_deltas)
+
+    @ndb.transactional_tasklet
+    def apply_async(self, user_key, version):
+        """
+        Transactionally apply these changes to the url filter and bucket
+        hashes of the user with the supplied ``user_key``, which are each
+        updated only if they have been built.
+
+        :param user_key: Key of the :class:`google.appengine.api.users.User`
+            whose notes were merged.
+        :param datetime.datetime version: Synchronization datetime of the
+            merge.
+        :type user_key: :class:`google.appengine.ext.db.Key`
+        :rtype: :class:`google.appengine.ext.ndb.tasklets.Future`
+        """
+        url_filter, bucket_hashes = yield ndb.get_multi_async([
+            UrlFilter.key_for_user(user_key),
+            BucketHashes.key_for_user(user_key)])
+        # Filters and hashes that are being built for the first time will
+        # include the notes when they are saved.
+        to_persist = []
+        if (url_filter and url_filter.bits is not None and
+                url_filter.apply_changes(self, version)):
+            to_persist.append(url_filter)
+        if bucket_hashes and bucket_hashes.hashes is not None:
+            bucket_hashes.apply_changes(self)
+            to_persist.append(bucket_hashes)
+        if to_persist:
+            yield ndb.put_multi_async(to_persist)
+
+    @staticmethod
+    def get_state(note, is_created):
+        """
+        Return the state of ``note`` before it is merged, to pass to
+        :meth:`record`.
+
+        :param note: Note before it is merged.
+        :param bool is_created: Whether ``note`` was newly created.
+        :type note: :class:`spidernotes.models.Note`
+        """
+        if is_created:
+            return None, None
+        return note.url_key, get_digest(note.key.id(), note)
+
+    def record_purge(self, note):
+        """
+        Record that the deleted ``note`` is purged.
+
+        :param note: Note to purge.
+        :type note: :class:`spidernotes.models.Note`
+        """
+        note_id = note.key.id()
+        self.digest_deltas[get_bucket(note_id)] ^= get_digest(note_id, note)
+
+    def record(self, state, note):
+        """
+        Record the change of ``note`` from ``state``.
+
+        :param tuple state: State that :meth:`get_state` returned.
+        :param note: Merged note.
+        :type note: :class:`spidernotes.models.Note`
+        """
+        old_url_key, old_digest = state
+        if note.url_key != old_url_key:
+            if note.url_key:
+                self.added_url_keys.append(note.url_key)
+            if old_url_key:
+                self.stale_url_key_count += 1
+
+        note_id = note.key.id()
+        digest_delta = get_digest(note_id, note) ^ (old_digest or 0)
+        if digest_delta:
+            self.digest_deltas[get_bucket(note_id)] ^= digest_delta
+
+
+def _delete_notes(user_key, cursor=None):
+    """
+    Delete a batch of the notes that are associated with ``user_key``, and
+    enqueue a task that deletes the next batch, if there is one.
+
+    :param user_key: Key of the :class:`google.appengine.api.users.User`
+        for which to delete the notes.
+    :param unicode cursor: Url-safe cursor of the batch to delete, or
+        ``None`` to delete the first batch.
+    :type user_key: :class:`google.appengine.ext.db.Key`
+    """
+    start_cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+    keys, next_cursor, has_more = Note.query(ancestor=user_key).fetch_page(
+        _DELETE_BATCH_SIZE, keys_only=True, start_cursor=start_cursor)
+    ndb.delete_multi(keys)
+    if has_more:
+        enqueue(_delete_notes, user_key, next_cursor.urlsafe())
+
+
+def _get_url_key(note):
+    """
+    Return the url key of ``note``, which is computed from its url if it has
+    not been indexed yet, or ``None`` if it is deleted or has no url key.
+    """
+    if note.is_deleted:
+        return None
+    if note.url_key is None and note.url:
+        return Note.compute_url_keys(note.url)[0]
+    return note.url_key
+
+
+def _index_notes(cursor=None):
+    """
+    Set the url keys, bucket and timestamps of a batch of notes that do not
+    have them, and enqueue a task that does the same for the next batch, if
+    there is one.
+
+    The notes of each user are updated in a transaction, so that a
+    concurrent synchronization is not overwritten, and their
+    ``synchronized`` datetimes are not changed, so that they are not
+    returned to clients again.
+
+    :param unicode cursor: Url-safe cursor of the batch, or ``None`` for the
+        first batch.
+    """
+    start_cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+    notes, next_cursor, has_more = Note.query().fetch_page(
+        _INDEX_BATCH_SIZE, start_cursor=start_cursor)
+    keys_by_user = defaultdict(list)
+    for note in notes:
+        if _is_unindexed(note):
+            keys_by_user[note.key.parent()].append(note.key)
+    for keys in keys_by_user.itervalues():
+        ndb.transaction(lambda: _index_notes_of(keys))
+    if has_more:
+        enqueue(_index_notes, next_cursor.urlsafe())
+
+
+def _index_notes_of(keys):
+    """
+    Set the url keys, bucket and timestamps of the notes with the supplied
+    ``keys``.
+    """
+    notes = [o for o in ndb.get_multi(keys) if o and _is_unindexed(o)]
+    for note in notes:
+        # The bucket and timestamps are set when the note is put.
+        note.index_url()
+    ndb.put_multi(notes)
+
+
+def _is_building(build_started):
+    """
+    Return ``True`` if a build that was enqueued at ``build_started`` may
+    still be in progress, or ``False`` if there is none, or it has taken
+    longer than :data:`_BUILD_TIMEOUT`, and so has failed or been dropped.
+
+    :param build_started: Datetime at which the build was enqueued.
+    :type build_started: :class:`datetime.datetime` or ``None``
+    :rtype: ``bool``
+    """
+    return (build_started is not None and
+            utcnow() - build_started < _BUILD_TIMEOUT)
+
+
+def _is_unindexed(note):
+    """Return ``True`` if ``note`` needs, but does not have, index keys."""
+    return (note.bucket is None or note.modified_ms is None or
+            (note.url_key is None and bool(note.url) and not note.is_deleted))
+
+
+def _purge_deleted_notes(horizon, cursor=None):
+    """
+    Purge a batch of the deleted notes that were synchronized before
+    ``horizon``, and enqueue a task that does the same for the next batch,
+    if there is one.
+
+    :param datetime.datetime horizon: Datetime before which deleted notes
+        are purged.
+    :param unicode cursor: Url-safe cursor of the batch, or ``None`` for the
+        first batch.
+    """
+    start_cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+    keys, next_cursor, has_more = Note.query(
+        Note.is_deleted == True, Note.synchronized < horizon).fetch_page(
+            _PURGE_BATCH_SIZE, keys_only=True, start_cursor=start_cursor)
+    keys_by_user = defaultdict(list)
+    for key in keys:
+        keys_by_user[key.parent()].append(key)
+    for user_key, user_keys in keys_by_user.iteritems():
+        ndb.transaction(
+            lambda: _purge_deleted_notes_of(user_key, user_keys, horizon))
+    if has_more:
+        enqueue(_purge_deleted_notes, horizon, next_cursor.urlsafe())
+
+
+def _purge_deleted_notes_of(user_key, keys, horizon):
+    """
+    Purge the notes with the supplied ``keys`` that are still deleted and
+    were synchronized before ``horizon``, remove their digests from the
+    user's bucket hashes, and advance the user's ``purged`` datetime.
+
+    The notes of a user whose bucket hashes are being built are not purged,
+    because the build may already have read them. They are purged by the
+    next run. Deleted notes are not in the user's url filter, so it is not
+    changed.
+    """
+    bucket_hashes = BucketHashes.key_for_user(user_key).get()
+    if bucket_hashes is not None and bucket_hashes.hashes is None:
+        return
+    notes = [o for o in ndb.get_multi(keys)
+             if o and o.is_deleted and o.synchronized < horizon]
+    if not notes:
+        return
+
+    state = SyncState.get_for_user(user_key)
+    purged = max(o.synchronized for o in notes)
+    if state.purged is None or state.purged < purged:
+        state.purged = purged
+    to_persist = [state]
+    if bucket_hashes is not None:
+        changes = NoteChanges()
+        for note in notes:
+            changes.record_purge(note)
+        bucket_hashes.apply_changes(changes)
+        to_persist.append(bucket_hashes)
+    ndb.put_multi(to_persist)
+    ndb.delete_multi([o.key for o in notes])
+
+
+def _build_url_filter(user_key):
+    """
+    Build the url filter of the user with the supplied ``user_key`` from the
+    url keys of the user's active notes, which are read in batches.
+
+    The notes that are merged while the filter is built are added to it when
+    it is saved, so that none is missed.
+
+    :param user_key: Key of the :class:`google.appengine.api.users.User`
+        whose filter to build.
+    :type user_key: :class:`google.appengine.ext.db.Key`
+    """
+    started = SyncState.get_for_user(user_key).synchronized
+    url_keys = set()
+    for note in Note.get_active(user_key).iter(batch_size=_INDEX_BATCH_SIZE):
+        url_key = _get_url_key(note)
+        if url_key:
+            url_keys.add(url_key)
+    ndb.transaction(lambda: _save_url_filter(user_key, url_keys, started))
+
+
+def _save_url_filter(user_key, url_keys, started):
+    """
+    Save a url filter that is sized for, and holds, ``url_keys`` and the url
+    keys of the notes that were synchronized after ``started``.
+    """
+    versions = [started] if started else []
+    for note in Note.get_synchronized_after(user_key, started):
+        url_key = _get_url_key(note)
+        if url_key:
+            url_keys.add(url_key)
+        versions.append(note.synchronized)
+
+    capacity = max(_MIN_URL_FILTER_CAPACITY, 2 * len(url_keys))
+    bloom_filter = BloomFilter.for_capacity(capacity)
+    for url_key in url_keys:
+        bloom_filter.add(url_key)
+
+    key = UrlFilter.key_for_user(user_key)
+    previous = key.get()
+    if previous and previous.version:
+        versions.append(previous.version)
+    UrlFilter(key=key,
+              bits=bloom_filter.to_bytes(),
+              bit_count=bloom_filter.bit_count,
+              hash_count=bloom_filter.hash_count,
+              capacity=capacity,
+              item_count=len(url_keys),
+              version=max(versions) if versions else None).put()
+
+
+def _build_bucket_hashes(user_key):
+    """
+    Build the bucket hashes of the user with the supplied ``user_key`` from
+    the digests of all of the user's notes, which are read in batches.
+
+    The notes that are merged while the hashes are built are included when
+    they are saved, so that none is missed. Notes that do not have a bucket
+    yet are indexed first, because once the hashes are saved, the notes of
+    differing buckets are queried by bucket.
+
+    :param user_key: Key of the :class:`google.appengine.api.users.User`
+        whose hashes to build.
+    :type user_key: :class:`google.appengine.ext.db.Key`
+    """
+    started = SyncState.get_for_user(user_key).synchronized
+    digests = {}
+    unindexed_keys = []
+    for note in Note.query(ancestor=user_key).iter(
+            batch_size=_INDEX_BATCH_SIZE):
+        digests[note.key.id()] = get_digest(note.key.id(), note)
+        if note.bucket is None:
+            unindexed_keys.append(note.key)
+    for keys in iter_batches(unindexed_keys, _INDEX_BATCH_SIZE):
+        ndb.transaction(lambda: _index_notes_of(keys))
+    ndb.transaction(lambda: _save_bucket_hashes(user_key, digests, started))
+
+
+def _save_bucket_hashes(user_key, digests, started):
+    """
+    Save the bucket hashes of ``digests``, a ``dict`` of note ids to
+    digests, updated with the notes that were synchronized after
+    ``started``.
+    """
+    for note in Note.get_synchronized_after(user_key, started):
+        digests[note.key.id()] = get_digest(note.key.id(), note)
+
+    hashes = [0] * BUCKET_COUNT
+    for note_id, digest in digests.iteritems():
+        hashes[get_bucket(note_id)] ^= digest
+    BucketHashes(key=BucketHashes.key_for_user(user_key),
+                 hashes=pack_hashes(hashes)).put()
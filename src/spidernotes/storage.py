@@ -0,0 +1,624 @@
+"""
+Provides the storages of notes that the synchronization engine merges notes
+into and reads notes from.
+
+The engine uses the storage that is returned by :func:`get_storage`, which
+is an :class:`NdbStorage` unless another is set with :func:`set_storage`:
+
+* :class:`NdbStorage` stores notes in the App Engine datastore, and
+  maintains the bucket hashes and url filters of users as it merges notes.
+* :class:`MemoryStorage` stores notes in memory, which is useful for tests
+  and benchmarks.
+* :class:`SqliteStorage` stores notes in a SQLite database, so that the
+  merge engine can be run, profiled and self-hosted outside App Engine.
+
+Notes are :class:`spidernotes.models.Note` instances in every storage. The
+storages other than :class:`NdbStorage` use them as plain objects, which
+requires the App Engine SDK to be importable, but not its services. Those
+storages store only notes and the ``synchronized`` datetime of each user,
+so reconciliation, url lookups and purging require :class:`NdbStorage`;
+they never purge deleted notes, so clients never need to resynchronize.
+
+Storages return cursors of pages of notes, which callers convert to and
+from tokens with ``format_cursor`` and ``parse_cursor``.
+"""
+
+from __future__ import unicode_literals
+import sqlite3
+import threading
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
+
+from google.appengine.datastore import datastore_pb
+from google.appengine.ext import ndb
+from google.appengine.ext.db import BadValueError
+from google.appengine.ext.ndb.key import Key
+from google.net.proto.ProtocolBuffer import ProtocolBufferDecodeError
+
+from spidernotes import instrumentation
+from spidernotes.models import Note, SyncState
+from spidernotes.timestamps import (
+    from_microseconds, get_next, to_microseconds)
+from spidernotes.utils import iter_batches
+
+
+# Number of notes that are merged per call of ``merge_multi``, and so per
+# transaction, by callers that merge many notes.
+MERGE_BATCH_SIZE = 100
+
+# Number of notes that are fetched per batch when iterating over notes.
+_QUERY_BATCH_SIZE = 500
+
+# Maximum number of note ids per SQLite query, which is below SQLite's limit
+# of 999 parameters.
+_SQLITE_BATCH_SIZE = 500
+
+# Memcache keys of the running totals of notes that were written, and of
+# notes whose writes were avoided, by merges.
+_WRITTEN_COUNT_KEY = 'sync_merge_written_count'
+_UNCHANGED_COUNT_KEY = 'sync_merge_unchanged_count'
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS note (
+    user TEXT NOT NULL,
+    id TEXT NOT NULL,
+    body TEXT,
+    url TEXT,
+    url_key TEXT,
+    host_key TEXT,
+    is_deleted INTEGER NOT NULL,
+    created INTEGER NOT NULL,
+    modified INTEGER NOT NULL,
+    synchronized INTEGER NOT NULL,
+    fingerprint TEXT,
+    PRIMARY KEY (user, id)
+);
+CREATE INDEX IF NOT EXISTS note_synchronized
+    ON note (user, synchronized, id);
+CREATE TABLE IF NOT EXISTS sync_state (
+    user TEXT PRIMARY KEY,
+    synchronized INTEGER NOT NULL
+);
+"""
+
+_SQLITE_COLUMNS = ('id, body, url, url_key, host_key, is_deleted, created, '
+                   'modified, synchronized, fingerprint')
+
+# Stored properties of a note, other than its key, as they are stored by
+# the storages other than :class:`NdbStorage`.
+_Row = namedtuple('Row', ['id', 'body', 'url', 'url_key', 'host_key',
+                          'is_deleted', 'created', 'modified', 'synchronized',
+                          'fingerprint'])
+
+
+class NdbStorage(object):
+    """Stores notes in the App Engine datastore."""
+
+    def add_merge_counts(self, written_count, unchanged_count):
+        """
+        Add the number of notes that were written by merges and the number
+        whose writes were avoided because they were unchanged to the running
+        totals in memcache.
+
+        :param int written_count: Number of notes that were written.
+        :param int unchanged_count: Number of notes that were unchanged.
+        """
+        ctx = ndb.get_context()
+        ctx.memcache_incr(_WRITTEN_COUNT_KEY, written_count, initial_value=0)
+        ctx.memcache_incr(_UNCHANGED_COUNT_KEY, unchanged_count,
+                          initial_value=0)
+
+    def delete_all(self, user_key):
+        """
+        Delete all of the notes that are associated with ``user_key``, in
+        the background.
+
+        :param user_key: Key of the :class:`google.appengine.api.users.User`
+            whose notes to delete.
+        :type user_key: :class:`google.appengine.ext.db.Key`
+        """
+        Note.delete_all(user_key)
+
+    def fetch_all(self, user_key, page_size, cursor=None):
+        """
+        Return a page of all of the notes, including deleted notes, that are
+        associated with ``user_key``, in key order, which does not change as
+        notes are merged, so that no note is skipped or repeated by the
+        pages, unlike the pages of :meth:`fetch_synchronized_after`.
+
+        :param user_key: Key of the :class:`google.appengine.api.users.User`
+            with which the notes are associated.
+        :param int page_size: Maximum number of notes to return.
+        :param cursor: Position of the page, or ``None`` for the first page.
+        :type user_key: :class:`google.appengine.ext.db.Key`
+        :return: Tuple of a list of notes, the cursor of the next page, and
+            whether there are more pages.
+        :rtype: ``tuple``
+        """
+        return Note.query(ancestor=user_key).fetch_page(page_size,
+                                                        start_cursor=cursor)
+
+    def fetch_synchronized_after(self, user_key, last_synchronized, until,
+                                 page_size, cursor=None):
+        """
+        Return a page of the notes that are associated with ``user_key``,
+        and were synchronized after ``last_synchronized`` and, if ``until``
+        is not ``None``, at or before ``until``, most recently synchronized
+        first.
+
+        :param user_key: Key of the :class:`google.appengine.api.users.User`
+            with which the notes are associated.
+        :param datetime.datetime last_synchronized: Datetime after which the
+            notes were synchronized.
+        :param until: Datetime at or before which the notes were
+            synchronized, or ``None``.
+        :param int page_size: Maximum number of notes to return.
+        :param cursor: Position of the page, or ``None`` for the first page.
+        :type user_key: :class:`google.appengine.ext.db.Key`
+        :type until: :class:`datetime.datetime` or ``None``
+        :return: Tuple of a list of notes, the cursor of the next page, and
+            whether there are more pages.
+        :rtype: ``tuple``
+        """
+        return Note.get_synchronized_after(
+            user_key, last_synchronized, until=until).fetch_page(
+                page_size, start_cursor=cursor)
+
+    def format_cursor(self, cursor):
+        """
+        Return the url-safe token of ``cursor``.
+
+        :param cursor: Cursor that was returned by :meth:`fetch_all` or
+            :meth:`fetch_synchronized_after`.
+        :type cursor: :class:`google.appengine.ext.ndb.Cursor`
+        :rtype: ``unicode``
+        """
+        return cursor.urlsafe().decode('ascii')
+
+    def get_multi(self, user_key, note_ids):
+        """
+        Return the notes that are associated with ``user_key`` and have the
+        supplied ``note_ids``, with a single batched get.
+
+        :param user_key: Key of the :class:`google.appengine.api.users.User`
+            with which the notes are associated.
+        :param list note_ids: Unique note identifiers.
+        :type user_key: :class:`google.appengine.ext.db.Key`
+        :return: List of notes, or of ``None`` for notes that do not exist,
+            in the same order as ``note_ids``.
+        :rtype: ``list``
+        """
+        return ndb.get_multi([Key(Note, o, parent=user_key)
+                              for o in note_ids])
+
+    def get_synchronized(self, user_key):
+        """
+        Return the latest datetime with which the notes that are associated
+        with ``user_key`` have been stamped. Every note that was stamped at
+        or before it has been committed.
+
+        :param user_key: Key of the :class:`google.appengine.api.users.User`
+            with which the notes are associated.
+        :type user_key: :class:`google.appengine.ext.db.Key`
+        :return: Datetime, or ``None`` if no note has been synchronized.
+        :rtype: :class:`datetime.datetime` or ``None``
+        """
+        return SyncState.get_for_user(user_key).synchronized
+
+    def has_purged_after(self, user_key, last_synchronized):
+        """
+        Return whether deleted notes that are associated with ``user_key``
+        and were synchronized after ``last_synchronized`` may have been
+        purged, as described by
+        :meth:`spidernotes.models.SyncState.has_purged_after`.
+
+        :param user_key: Key of the :class:`google.appengine.api.users.User`
+            with which the notes are associated.
+        :param datetime.datetime last_synchronized: Datetime at which a
+            client last synchronized.
+        :type user_key: :class:`google.appengine.ext.db.Key`
+        :rtype: ``bool``
+        """
+        return SyncState.get_for_user(user_key).has_purged_after(
+            last_synchronized)
+
+    def iter_synchronized_after(self, user_key, last_synchronized):
+        """
+        Return an iterable of all of the notes that are associated with
+        ``user_key`` and were synchronized after ``last_synchronized``, most
+        recently synchronized first, which are fetched in batches as it is
+        consumed.
+
+        :param user_key: Key of the :class:`google.appengine.api.users.User`
+            with which the notes are associated.
+        :param datetime.datetime last_synchronized: Datetime after which the
+            notes were synchronized.
+        :type user_key: :class:`google.appengine.ext.db.Key`
+        """
+        return Note.get_synchronized_after(
+            user_key, last_synchronized).iter(batch_size=_QUERY_BATCH_SIZE)
+
+    def merge_multi(self, user_key, note_ids, from_notes):
+        """
+        Atomically merge ``from_notes`` into the notes that are associated
+        with ``user_key``, creating those that do not exist, with the rule of
+        :meth:`spidernotes.models.Note.merge_from_note`, and stamp the updated
+        notes with the user's next synchronization datetime.
+
+        :param user_key: Key of the :class:`google.appengine.api.users.User`
+            into whose notes to merge.
+        :param list note_ids: Unique identifiers of ``from_notes``.
+        :param list from_notes: Note-like objects to merge.
+        :type user_key: :class:`google.appengine.ext.db.Key`
+        :return: Tuple of the keys of the notes that ``from_notes``
+            supersede, the number of notes that were written and the number
+            of superseded notes that were unchanged.
+        :rtype: ``tuple``
+        """
+        return Note.merge_multi(user_key, note_ids, from_notes)
+
+    def parse_cursor(self, token):
+        """
+        Return the cursor that :meth:`format_cursor` formatted as ``token``.
+
+        :param unicode token: Url-safe cursor token.
+        :raises ValueError: If ``token`` is not a valid cursor.
+        :rtype: :class:`google.appengine.ext.ndb.Cursor`
+        """
+        try:
+            cursor = ndb.Cursor(urlsafe=token)
+            # The bytes are parsed as the query would parse them, so that a
+            # corrupt token is rejected here rather than by the query.
+            datastore_pb.CompiledCursor(cursor.to_bytes())
+        except (BadValueError, ProtocolBufferDecodeError) as e:
+            raise ValueError('Invalid cursor: {}'.format(e))
+        return cursor
+
+
+class _LocalStorage(object):
+    """
+    Base class of the storages that store notes outside the datastore, in
+    which merges are serialized by a lock.
+
+    Subclasses implement :meth:`_get_rows`, :meth:`_put_rows`,
+    :meth:`_fetch_rows`, :meth:`_fetch_rows_by_id`,
+    :meth:`_set_synchronized` and the methods of :class:`NdbStorage` that
+    are not implemented here.
+
+    Cursors are tuples of the ``synchronized`` datetime, which is ``None``
+    in key order, and the id of the last note of a page.
+    """
+
+    def __init__(self):
+        self.written_count = 0
+        self.unchanged_count = 0
+        self._lock = threading.RLock()
+
+    def add_merge_counts(self, written_count, unchanged_count):
+        """Add to the running totals of :meth:`NdbStorage.add_merge_counts`."""
+        with self._lock:
+            self.written_count += written_count
+            self.unchanged_count += unchanged_count
+
+    def fetch_all(self, user_key, page_size, cursor=None):
+        """See :meth:`NdbStorage.fetch_all`."""
+        rows = self._fetch_rows_by_id(user_key, page_size + 1,
+                                      cursor[1] if cursor else None)
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        if rows:
+            cursor = (None, rows[-1].id)
+        return [_from_row(user_key, o) for o in rows], cursor, has_more
+
+    def fetch_synchronized_after(self, user_key, last_synchronized, until,
+                                 page_size, cursor=None):
+        """See :meth:`NdbStorage.fetch_synchronized_after`."""
+        rows = self._fetch_rows(user_key, last_synchronized, until,
+                                page_size + 1, cursor)
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        if rows:
+            cursor = (rows[-1].synchronized, rows[-1].id)
+        return [_from_row(user_key, o) for o in rows], cursor, has_more
+
+    def format_cursor(self, cursor):
+        """See :meth:`NdbStorage.format_cursor`."""
+        synchronized, note_id = cursor
+        return '{}:{}'.format(
+            '' if synchronized is None else to_microseconds(synchronized),
+            note_id)
+
+    def get_multi(self, user_key, note_ids):
+        """See :meth:`NdbStorage.get_multi`."""
+        rows = self._get_rows(user_key, note_ids)
+        return [_from_row(user_key, rows[o]) if o in rows else None
+                for o in note_ids]
+
+    def has_purged_after(self, user_key, last_synchronized):
+        """
+        Return ``False``, because deleted notes are not purged from this
+        storage.
+        """
+        return False
+
+    def iter_synchronized_after(self, user_key, last_synchronized):
+        """See :meth:`NdbStorage.iter_synchronized_after`."""
+        cursor = None
+        has_more = True
+        while has_more:
+            notes, cursor, has_more = self.fetch_synchronized_after(
+                user_key, last_synchronized, None, _QUERY_BATCH_SIZE, cursor)
+            for note in notes:
+                yield note
+
+    def merge_multi(self, user_key, note_ids, from_notes):
+        """See :meth:`NdbStorage.merge_multi`."""
+        with self._transaction():
+            synchronized = get_next(self.get_synchronized(user_key))
+            with instrumentation.phase('get_notes'):
+                stored = self.get_multi(user_key, note_ids)
+            notes = [(o, False) if o else (Note(parent=user_key, id=i), True)
+                     for i, o in zip(note_ids, stored)]
+            superseded_keys, to_persist, unchanged_count = Note.merge_all(
+                notes, from_notes, synchronized)
+            if to_persist:
+                self._put_notes(to_persist)
+                self._set_synchronized(user_key, synchronized)
+        return superseded_keys, len(to_persist), unchanged_count
+
+    def parse_cursor(self, token):
+        """See :meth:`NdbStorage.parse_cursor`."""
+        microseconds, separator, note_id = token.partition(':')
+        if not separator:
+            raise ValueError('Invalid cursor: {}'.format(token))
+        if not microseconds:
+            return None, note_id
+        return from_microseconds(int(microseconds)), note_id
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            yield
+
+    def _put_notes(self, notes):
+        rows = defaultdict(list)
+        for note in notes:
+            rows[note.key.parent()].append(_to_row(note))
+        with self._transaction():
+            for user_key, user_rows in rows.iteritems():
+                self._put_rows(user_key, user_rows)
+
+
+class MemoryStorage(_LocalStorage):
+    """Stores notes in memory."""
+
+    def __init__(self):
+        super(MemoryStorage, self).__init__()
+        # User key to note id to row.
+        self._rows = defaultdict(dict)
+        self._synchronized = {}
+
+    def delete_all(self, user_key):
+        """See :meth:`NdbStorage.delete_all`."""
+        with self._lock:
+            self._rows.pop(user_key, None)
+            self._synchronized.pop(user_key, None)
+
+    def get_synchronized(self, user_key):
+        """See :meth:`NdbStorage.get_synchronized`."""
+        return self._synchronized.get(user_key)
+
+    def _fetch_rows(self, user_key, last_synchronized, until, limit, cursor):
+        with self._lock:
+            rows = [o for o in self._rows[user_key].itervalues()
+                    if o.synchronized > last_synchronized and
+                    (until is None or o.synchronized <= until) and
+                    (cursor is None or (o.synchronized, o.id) < cursor)]
+        rows.sort(key=lambda o: (o.synchronized, o.id), reverse=True)
+        return rows[:limit]
+
+    def _fetch_rows_by_id(self, user_key, limit, after_id):
+        with self._lock:
+            rows = [o for o in self._rows[user_key].itervalues()
+                    if after_id is None or o.id > after_id]
+        rows.sort(key=lambda o: o.id)
+        return rows[:limit]
+
+    def _get_rows(self, user_key, note_ids):
+        with self._lock:
+            rows = self._rows[user_key]
+            return {o: rows[o] for o in note_ids if o in rows}
+
+    def _put_rows(self, user_key, rows):
+        user_rows = self._rows[user_key]
+        for row in rows:
+            user_rows[row.id] = row
+
+    def _set_synchronized(self, user_key, synchronized):
+        self._synchronized[user_key] = synchronized
+
+
+class SqliteStorage(_LocalStorage):
+    """
+    Stores notes in a SQLite database, which is created if it does not
+    exist.
+
+    Notes are indexed by user and ``synchronized`` datetime, so that the
+    notes that were synchronized after a datetime are queried with an index
+    range scan. Merges are serialized by a lock within a process, and by
+    ``BEGIN IMMEDIATE`` transactions between processes.
+    """
+
+    def __init__(self, path):
+        """
+        :param unicode path: Path of the database file, or ``:memory:``.
+        """
+        super(SqliteStorage, self).__init__()
+        self._connection = sqlite3.connect(path, isolation_level=None,
+                                           check_same_thread=False)
+        self._connection.executescript(_SQLITE_SCHEMA)
+        self._depth = 0
+
+    def delete_all(self, user_key):
+        """See :meth:`NdbStorage.delete_all`."""
+        user = user_key.urlsafe()
+        with self._transaction():
+            self._connection.execute('DELETE FROM note WHERE user = ?',
+                                     (user,))
+            self._connection.execute('DELETE FROM sync_state WHERE user = ?',
+                                     (user,))
+
+    def get_synchronized(self, user_key):
+        """See :meth:`NdbStorage.get_synchronized`."""
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT synchronized FROM sync_state WHERE user = ?',
+                (user_key.urlsafe(),)).fetchone()
+        return from_microseconds(row[0]) if row else None
+
+    def _fetch_rows(self, user_key, last_synchronized, until, limit, cursor):
+        sql = ['SELECT', _SQLITE_COLUMNS, 'FROM note',
+               'WHERE user = ? AND synchronized > ?']
+        params = [user_key.urlsafe(), to_microseconds(last_synchronized)]
+        if until is not None:
+            sql.append('AND synchronized <= ?')
+            params.append(to_microseconds(until))
+        if cursor is not None:
+            synchronized = to_microseconds(cursor[0])
+            sql.append('AND (synchronized < ? OR '
+                       '(synchronized = ? AND id < ?))')
+            params.extend([synchronized, synchronized, cursor[1]])
+        sql.append('ORDER BY synchronized DESC, id DESC LIMIT ?')
+        params.append(limit)
+        with self._lock:
+            rows = self._connection.execute(' '.join(sql), params).fetchall()
+        return [_from_sqlite_row(o) for o in rows]
+
+    def _fetch_rows_by_id(self, user_key, limit, after_id):
+        sql = ['SELECT', _SQLITE_COLUMNS, 'FROM note WHERE user = ?']
+        params = [user_key.urlsafe()]
+        if after_id is not None:
+            sql.append('AND id > ?')
+            params.append(after_id)
+        sql.append('ORDER BY id LIMIT ?')
+        params.append(limit)
+        with self._lock:
+            rows = self._connection.execute(' '.join(sql), params).fetchall()
+        return [_from_sqlite_row(o) for o in rows]
+
+    def _get_rows(self, user_key, note_ids):
+        user = user_key.urlsafe()
+        rows = {}
+        with self._lock:
+            for batch in iter_batches(note_ids, _SQLITE_BATCH_SIZE):
+                sql = ('SELECT {} FROM note WHERE user = ? AND id IN ({})'
+                       .format(_SQLITE_COLUMNS, ', '.join('?' * len(batch))))
+                for row in self._connection.execute(sql, [user] + batch):
+                    row = _from_sqlite_row(row)
+                    rows[row.id] = row
+        return rows
+
+    def _put_rows(self, user_key, rows):
+        user = user_key.urlsafe()
+        self._connection.executemany(
+            'INSERT OR REPLACE INTO note (user, {}) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'.format(_SQLITE_COLUMNS),
+            [(user,) + _to_sqlite_row(o) for o in rows])
+
+    def _set_synchronized(self, user_key, synchronized):
+        self._connection.execute(
+            'INSERT OR REPLACE INTO sync_state (user, synchronized) '
+            'VALUES (?, ?)',
+            (user_key.urlsafe(), to_microseconds(synchronized)))
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            if self._depth:
+                self._depth += 1
+                try:
+                    yield
+                finally:
+                    self._depth -= 1
+                return
+
+            self._connection.execute('BEGIN IMMEDIATE')
+            self._depth = 1
+            try:
+                yield
+            except:
+                self._connection.execute('ROLLBACK')
+                raise
+            else:
+                self._connection.execute('COMMIT')
+            finally:
+                self._depth = 0
+
+
+_storage = NdbStorage()
+
+
+def get_storage():
+    """
+    Return the storage of notes.
+
+    :rtype: :class:`NdbStorage`, :class:`MemoryStorage` or
+        :class:`SqliteStorage`
+    """
+    return _storage
+
+
+def set_storage(storage):
+    """
+    Set the storage of notes, such as a :class:`MemoryStorage` in tests.
+
+    :param storage: Storage of notes.
+    """
+    global _storage
+    _storage = storage
+
+
+def _from_row(user_key, row):
+    """Return a new :class:`spidernotes.models.Note` from ``row``."""
+    return Note(parent=user_key,
+                id=row.id,
+                body=row.body,
+                url=row.url,
+                url_key=row.url_key,
+                host_key=row.host_key,
+                is_deleted=row.is_deleted,
+                created=row.created,
+                modified=row.modified,
+                synchronized=row.synchronized,
+                fingerprint=row.fingerprint)
+
+
+def _to_row(note):
+    """Return the row of ``note``."""
+    return _Row(id=note.key.id(),
+                body=note.body,
+                url=note.url,
+                url_key=note.url_key,
+                host_key=note.host_key,
+                is_deleted=note.is_deleted,
+                created=note.created,
+                modified=note.modified,
+                synchronized=note.synchronized,
+                fingerprint=note.fingerprint)
+
+
+def _from_sqlite_row(values):
+    """Return the row of the values of :data:`_SQLITE_COLUMNS`."""
+    row = _Row(*values)
+    return row._replace(is_deleted=bool(row.is_deleted),
+                        created=from_microseconds(row.created),
+                        modified=from_microseconds(row.modified),
+                        synchronized=from_microseconds(row.synchronized))
+
+
+def _to_sqlite_row(row):
+    """Return the values of :data:`_SQLITE_COLUMNS` of ``row``."""
+    return row._replace(is_deleted=int(row.is_deleted),
+                        created=to_microseconds(row.created),
+                        modified=to_microseconds(row.modified),
+                        synchronized=to_microseconds(row.synchronized))
@@ -0,0 +1,119 @@
+"""
+Provides execution of background tasks.
+
+Tasks are module-level functions that are enqueued with :func:`enqueue`, and
+which may enqueue further tasks to continue their work. By default, tasks are
+executed by the App Engine task queue, but an :class:`InProcessExecutor` can
+be installed with :func:`set_executor` to run them without App Engine.
+"""
+
+from __future__ import unicode_literals
+import threading
+from collections import deque
+
+from google.appengine.ext import deferred
+
+
+class DeferredExecutor(object):
+    """Executes tasks with the App Engine task queue."""
+
+    def enqueue(self, func, *args, **kwargs):
+        """
+        Enqueue a call of ``func`` with the supplied arguments.
+
+        Keyword arguments that start with an underscore, such as ``_queue``
+        and ``_countdown``, are passed to :func:`deferred.defer`.
+
+        :param func: Module-level function to call.
+        """
+        deferred.defer(func, *args, **kwargs)
+
+    def run(self):
+        """
+        Do nothing, because the task queue executes the enqueued tasks.
+
+        :return: ``0``
+        :rtype: ``int``
+        """
+        return 0
+
+
+class InProcessExecutor(object):
+    """
+    Executes tasks in the current process when :meth:`run` is called, which
+    is useful for tests and benchmarks.
+
+    Tasks may be enqueued, and :meth:`run` may be called, from several
+    threads, but only one thread executes tasks at a time.
+    """
+
+    def __init__(self):
+        self._tasks = deque()
+        self._lock = threading.Lock()
+
+    def enqueue(self, func, *args, **kwargs):
+        """
+        Enqueue a call of ``func`` with the supplied arguments.
+
+        Keyword arguments that start with an underscore are task queue options,
+        and are ignored.
+
+        :param func: Function to call.
+        """
+        kwargs = {k: v for k, v in kwargs.iteritems() if not k.startswith('_')}
+        self._tasks.append((func, args, kwargs))
+
+    def run(self):
+        """
+        Execute the enqueued tasks in order, including any tasks that they
+        enqueue, until none remain.
+
+        If another thread is executing tasks, then wait until it is done,
+        and then execute any tasks that remain.
+
+        :return: Number of tasks that were executed.
+        :rtype: ``int``
+        """
+        count = 0
+        with self._lock:
+            while self._tasks:
+                func, args, kwargs = self._tasks.popleft()
+                func(*args, **kwargs)
+                count += 1
+        return count
+
+
+_executor = DeferredExecutor()
+
+
+def enqueue(func, *args, **kwargs):
+    """
+    Enqueue a call of ``func`` with the current executor.
+
+    :param func: Module-level function to call.
+    """
+    _executor.enqueue(func, *args, **kwargs)
+
+
+def run_pending():
+    """
+    Execute the tasks that were enqueued with the current executor, if it
+    is an :class:`InProcessExecutor`. This may be called from several
+    threads.
+
+    :return: Number of tasks that were executed.
+    :rtype: ``int``
+    """
+    return _executor.run()
+
+
+def set_executor(executor):
+    """
+    Set the executor of subsequently enqueued tasks, and return the previous
+    executor.
+
+    :param executor: :class:`DeferredExecutor` or :class:`InProcessExecutor`.
+    """
+    global _executor
+    previous, _executor = _executor, executor
+    return previous
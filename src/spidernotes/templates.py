@@ -0,0 +1,40 @@
+"""
+Provides a process-level cache of the static templates in ``src/templates``.
+"""
+
+from __future__ import unicode_literals
+import hashlib
+import mimetypes
+import os
+from collections import namedtuple
+
+from spidernotes.utils import read_utf8_file
+
+
+_TEMPLATES_DIR = 'templates'
+
+StaticTemplate = namedtuple('StaticTemplate', ['body', 'content_type', 'etag'])
+
+_cache = {}
+
+
+def get_static_template(name):
+    """
+    Return the template with the supplied ``name``, which is read from disk
+    and encoded only the first time that it is requested by this process.
+
+    :param unicode name: File name of the template, relative to the templates
+        directory.
+    :return: Template with a UTF-8 encoded body, a content type and an ETag.
+    :rtype: :class:`StaticTemplate`
+    """
+    template = _cache.get(name)
+    if template is None:
+        path = os.path.join(_TEMPLATES_DIR, name)
+        body = read_utf8_file(path).encode('UTF8')
+        content_type = mimetypes.guess_type(name)[0] or 'text/plain'
+        template = _cache.setdefault(name, StaticTemplate(
+            body=body,
+            content_type='{}; charset=utf-8'.format(content_type),
+            etag=hashlib.sha1(body).hexdigest()))
+    return template
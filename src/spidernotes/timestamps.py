@@ -0,0 +1,163 @@
+"""
+Provides conversions between Python datetimes and JavaScript timestamps,
+which are numbers of milliseconds since the epoch.
+
+Datetimes are naive and in UTC. Conversions use integer arithmetic on the
+difference from the epoch, rather than ``time.mktime``, which interprets a
+datetime in the local timezone, or ``datetime.utcfromtimestamp``, which
+goes through a float number of seconds.
+
+Datetimes that the server stamps on notes are obtained from :func:`utcnow`,
+which truncates them to whole milliseconds, so that they are exactly
+represented by integer timestamps.
+"""
+
+from __future__ import unicode_literals
+from datetime import datetime, timedelta
+
+
+EPOCH = datetime(1970, 1, 1)
+
+# Types of timestamps that are converted without parsing, which exclude
+# ``bool``, since it is a subclass of ``int``.
+_INTEGER_TYPES = (int, long)
+
+
+def from_milliseconds(timestamp):
+    """
+    Convert from a JavaScript timestamp to a Python datetime.
+
+    :param timestamp: Timestamp to convert, which may have a fractional
+        part, and may be a string.
+    :type timestamp: ``int``, ``float`` or ``unicode``
+    :return: Datetime, rounded to the nearest microsecond.
+    :rtype: :class:`datetime.datetime`
+    :raises TypeError: If ``timestamp`` is not a number or a string.
+    :raises ValueError: If ``timestamp`` is not a valid number, or is out of
+        range.
+    """
+    if type(timestamp) not in _INTEGER_TYPES:
+        timestamp = _parse(timestamp)
+        if type(timestamp) is float:
+            return _from_fractional_milliseconds(timestamp)
+    try:
+        # ``timedelta`` is exact for integer milliseconds.
+        return EPOCH + timedelta(milliseconds=timestamp)
+    except OverflowError:
+        raise ValueError('Timestamp out of range: {}'.format(timestamp))
+
+
+def from_microseconds(microseconds):
+    """
+    Convert from an integer number of microseconds since the epoch, as
+    datetimes are stored in cursors and outside the datastore, to a Python
+    datetime.
+
+    :param int microseconds: Microseconds since the epoch.
+    :rtype: :class:`datetime.datetime`
+    """
+    return EPOCH + timedelta(microseconds=microseconds)
+
+
+def get_next(dt):
+    """
+    Return the current UTC datetime, unless it is not later than ``dt``, as
+    it may not be if clocks differ, in which case return ``dt`` plus one
+    millisecond.
+
+    :param dt: Datetime to follow, or ``None``.
+    :type dt: :class:`datetime.datetime` or ``None``
+    :rtype: :class:`datetime.datetime`
+    """
+    now = utcnow()
+    if dt is None or now > dt:
+        return now
+    return dt + timedelta(milliseconds=1)
+
+
+def to_microseconds(dt):
+    """
+    Convert from a Python datetime to an integer number of microseconds since
+    the epoch, which is exact.
+
+    :param datetime.datetime dt: Datetime to convert.
+    :rtype: ``int``
+    """
+    delta = dt - EPOCH
+    return ((delta.days * 86400 + delta.seconds) * 1000000 +
+            delta.microseconds)
+
+
+def to_milliseconds(dt):
+    """
+    Convert from a Python datetime to an integer JavaScript timestamp.
+
+    :param datetime.datetime dt: Datetime to convert.
+    :return: Timestamp, rounded to the nearest millisecond.
+    :rtype: ``int``
+    """
+    delta = dt - EPOCH
+    return ((delta.days * 86400 + delta.seconds) * 1000 +
+            (delta.microseconds + 500) // 1000)
+
+
+def to_timestamp(dt):
+    """
+    Convert from a Python datetime to a JavaScript timestamp, which is exact.
+
+    :param datetime.datetime dt: Datetime to convert.
+    :return: Timestamp, which is an ``int`` if ``dt`` is a whole number of
+        milliseconds, or else a ``float``.
+    :rtype: ``int`` or ``float``
+    """
+    delta = dt - EPOCH
+    ms = (delta.days * 86400 + delta.seconds) * 1000
+    if delta.microseconds % 1000:
+        return ms + delta.microseconds / 1000.0
+    return ms + delta.microseconds // 1000
+
+
+def utcnow():
+    """
+    Return the current UTC datetime, truncated to whole milliseconds.
+
+    :rtype: :class:`datetime.datetime`
+    """
+    now = datetime.utcnow()
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+
+def _from_fractional_milliseconds(timestamp):
+    """
+    Convert from a JavaScript timestamp that has a fractional part to a
+    Python datetime.
+
+    :param float timestamp: Timestamp to convert.
+    :rtype: :class:`datetime.datetime`
+    """
+    try:
+        # Subtracting the integer part is exact, so only the fractional part
+        # is rounded.
+        ms = int(timestamp)
+        microseconds = int(round((timestamp - ms) * 1000))
+        return EPOCH + timedelta(milliseconds=ms, microseconds=microseconds)
+    except OverflowError:
+        raise ValueError('Timestamp out of range: {}'.format(timestamp))
+
+
+def _parse(value):
+    """
+    Return the ``int`` or, if it has a fractional part, the ``float`` value
+    of a timestamp that is not an ``int``.
+
+    :raises TypeError: If ``value`` is not a number or a string.
+    :raises ValueError: If ``value`` is not a valid number.
+    """
+    if isinstance(value, basestring):
+        try:
+            return int(value)
+        except ValueError:
+            value = float(value)
+    elif type(value) is not float:
+        raise TypeError('Invalid timestamp: {!r}'.format(value))
+    return int(value) if value.is_integer() else value
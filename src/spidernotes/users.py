@@ -3,25 +3,36 @@ Provides functions for managing users.
 """
 
 from __future__ import unicode_literals
+import base64
+import hashlib
+import hmac
 from itertools import imap
 
 from google.appengine.ext import ndb
 from webapp2_extras.appengine.auth.models import Unique
+from webapp2_extras.security import compare_hashes
 
-from spidernotes.models import Note
+from spidernotes import secrets
+from spidernotes.models import BucketHashes, SyncState, UrlFilter
+from spidernotes.storage import MERGE_BATCH_SIZE, get_storage
+from spidernotes.tasks import enqueue
 from spidernotes.utils import create_random_id
 
 
 _UNAUTHENTICATED_PREFIX = 'spidernotes:'
 
+_TOKEN_PREFIX = 'v1.'
+
 
 def connect_user(user, data):
     """
     Connect ``user`` to the Social Login account indicated by ``auth_data``.
 
-    If a user that is associated with ``auth_data`` already exists, then copy
-    the notes from the supplied ``user`` to the other user and return the other
-    user. Otherwise, add the auth data to ``user`` and return ``user``.
+    If a user that is associated with ``auth_data`` already exists, then
+    enqueue a background task that merges the notes from the supplied ``user``
+    into the other user, and then deletes them, delete the supplied ``user``
+    with :func:`delete_user`, and return the other user. Otherwise, add the
+    auth data to ``user`` and return ``user``.
 
     The caller is responsible for persisting the ``user``.
 
@@ -41,8 +52,8 @@ def connect_user(user, data):
     if auth_user:
         old_user = user
         user = auth_user
-        _copy_notes_between_users(old_user.key, user.key)
-        old_user.key.delete()
+        enqueue(_merge_notes_between_users, old_user.key, user.key)
+        delete_user(old_user.key)
     else:
         user.add_auth_id(auth_id)
 
@@ -62,6 +73,28 @@ def create_auth_id():
     return '{}{}'.format(_UNAUTHENTICATED_PREFIX, create_random_id())
 
 
+def create_token(user):
+    """
+    Create and return a signed API token for ``user``, or ``None`` if the
+    user does not have an unauthenticated auth_id.
+
+    The token embeds the user's id and unauthenticated auth_id, and an HMAC
+    signature of both, so that it can be validated without accessing the
+    datastore, and the user can be loaded by key rather than by a query.
+
+    :param user: User for which to create the token.
+    :type user: :class:`webapp2_extras.appengine.auth.models.User`
+    :rtype: ``unicode`` or ``None``
+    """
+    auth_id = get_unauthenticated_auth_id(user)
+    if not auth_id:
+        return None
+    payload = '{}{}.{}'.format(_TOKEN_PREFIX,
+                               user.key.id(),
+                               auth_id[len(_UNAUTHENTICATED_PREFIX):])
+    return '{}.{}'.format(payload, _sign(payload))
+
+
 def create_user(user_class):
     """
     Return a new :class:`webapp2_extras.appengine.auth.models.User` or ``None``
@@ -76,6 +109,21 @@ def create_user(user_class):
     return user
 
 
+def delete_user(user_key):
+    """
+    Delete the :class:`google.appengine.api.users.User` with the supplied
+    ``user_key``, and the entities that are kept per user, other than its
+    notes, which the caller is responsible for deleting.
+
+    :param user_key: Key of the user to delete.
+    :type user_key: :class:`google.appengine.ext.db.Key`
+    """
+    ndb.delete_multi([SyncState.key_for_user(user_key),
+                      UrlFilter.key_for_user(user_key),
+                      BucketHashes.key_for_user(user_key),
+                      user_key])
+
+
 def disconnect_user(user):
     """
     Delete all auth_ids that are associated with the supplied ``user``.
@@ -97,6 +145,26 @@ def disconnect_user(user):
     user.provider = None
 
 
+def get_by_token(user_class, token):
+    """
+    Return the user that is identified by ``token``, or ``None`` if the token
+    is invalid or has been revoked by disconnecting the user.
+
+    :param class user_class: User class.
+    :param unicode token: Token that was created by :func:`create_token`.
+    :rtype: :class:`webapp2_extras.appengine.auth.models.User` or ``None``
+    """
+    payload, _, signature = token.rpartition('.')
+    if not compare_hashes(_sign(payload), signature):
+        return None
+
+    user_id, _, suffix = payload[len(_TOKEN_PREFIX):].partition('.')
+    user = user_class.get_by_id(user_id)
+    if user and '{}{}'.format(_UNAUTHENTICATED_PREFIX,
+                              suffix) in user.auth_ids:
+        return user
+
+
 def get_unauthenticated_auth_id(user):
     """
     Return an auth_id that is not associated with a Social Login provider, or
@@ -111,6 +179,17 @@ def get_unauthenticated_auth_id(user):
             return auth_id
 
 
+def is_token(auth_id):
+    """
+    Return ``True`` if ``auth_id`` is a token that was created by
+    :func:`create_token`, rather than a legacy auth_id.
+
+    :param unicode auth_id: Token or auth_id to check.
+    :rtype: ``bool``
+    """
+    return auth_id.startswith(_TOKEN_PREFIX)
+
+
 def is_connected(user):
     """
     Return ``True`` if the user has an associated Social Login identity.
@@ -123,19 +202,51 @@ def is_connected(user):
     return any(imap(is_unauthenticated_id, user.auth_ids))
 
 
-def _copy_notes_between_users(from_user_key, to_user_key):
+def _merge_notes_between_users(from_user_key, to_user_key, cursor=None):
     """
-    Copy notes from one :class:`google.appengine.api.users.User` to
-    another.
+    Merge a batch of notes, including deleted notes, from one
+    :class:`google.appengine.api.users.User` into another, and enqueue a task
+    that merges the next batch. After the last batch, enqueue deletion of the
+    notes of the ``from_user_key`` user.
+
+    Conflicting notes are resolved with the same last-writer-wins rule that is
+    used to merge notes from clients, in a transaction that is ordered with
+    concurrent synchronizations. Merged notes are stamped as synchronized
+    now, so that they are sent to all of the other user's
+    devices. Each batch is idempotent, so a failed task can be safely retried.
 
     :param from_user_key: Key of the :class:`google.appengine.api.users.User`
-        from which to copy the notes.
+        from which to merge the notes.
     :param to_user_key: Key of the :class:`google.appengine.api.users.User`
-        to which to copy the notes.
+        into which to merge the notes.
+    :param unicode cursor: Url-safe cursor of the batch to merge, or ``None``
+        to merge the first batch.
     :type from_user_key: :class:`google.appengine.ext.db.Key`
     :type to_user_key: :class:`google.appengine.ext.db.Key`
     """
-    notes = [src.copy_to_user(to_user_key)
-             for src in Note.get_active(from_user_key)]
-    if notes:
-        ndb.put_multi_async(notes)
\ No newline at end of file
+    storage = get_storage()
+    start_cursor = storage.parse_cursor(cursor) if cursor else None
+    from_notes, next_cursor, has_more = storage.fetch_all(
+        from_user_key, MERGE_BATCH_SIZE, start_cursor)
+    if from_notes:
+        storage.merge_multi(to_user_key, [o.key.id() for o in from_notes],
+                            from_notes)
+
+    if has_more:
+        enqueue(_merge_notes_between_users, from_user_key, to_user_key,
+                storage.format_cursor(next_cursor))
+    else:
+        storage.delete_all(from_user_key)
+
+
+def _sign(payload):
+    """
+    Return a url-safe HMAC signature of ``payload``.
+
+    :param unicode payload: Data to sign.
+    :rtype: ``unicode``
+    """
+    digest = hmac.new(str(secrets.SESSION_KEY),
+                      payload.encode('UTF8'),
+                      hashlib.sha256).digest()
+    return unicode(base64.urlsafe_b64encode(digest).rstrip(b'='))
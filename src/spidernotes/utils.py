@@ -1,9 +1,25 @@
 from __future__ import unicode_literals
 import codecs
-import datetime
+import json
 import random
+import re
 import string
-import time
+import urllib
+import urlparse
+from itertools import islice
+
+
+# Ports that are omitted from normalized URLs.
+_DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+# Characters, besides letters, digits and "_.-", that are not percent-encoded
+# in normalized URLs.
+_URL_SAFE_CHARS = "!$&'()*+,/:;=?@[]~%"
+
+# Characters that are decoded if they are percent-encoded, as per RFC 3986.
+_UNRESERVED_CHARS = frozenset(string.ascii_letters + string.digits + '-._~')
+
+_ESCAPE_RE = re.compile(r'%([0-9A-Fa-f]{2})')
 
 
 def create_random_id():
@@ -17,18 +33,6 @@ def create_random_id():
                     for _ in xrange(64)])
 
 
-def from_timestamp(timestamp):
-    """
-    Convert from a JavaScript timestamp to a Python datetime.
-
-    :param unicode timestamp: Timestamp to convert.
-    :return: Datetime.
-    :rtype: :class:`datetime.datetime`
-    """
-    timestamp = float(timestamp) / 1000.0
-    return datetime.datetime.utcfromtimestamp(timestamp)
-
-
 def get_param(ctx, key):
     """
     Return an item from the supplied ``ctx`` using the supplied ``key``.
@@ -45,6 +49,86 @@ def get_param(ctx, key):
     return param
 
 
+def iter_batches(iterable, size):
+    """
+    Yield successive lists of at most ``size`` items from ``iterable``.
+
+    :param iterable: Iterable to split into batches.
+    :param int size: Maximum number of items in a batch.
+    :return: Generator of lists.
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def iter_json(obj):
+    """
+    Serialize ``obj`` to json and yield the result in chunks.
+
+    ``dict`` values and the items of any other non-string iterable (including
+    generators) are serialized one at a time, so that a large collection is
+    never held in memory as a single json string.
+
+    :param obj: Object to serialize.
+    :return: Generator of json string chunks.
+    :rtype: generator of ``unicode``
+    """
+    if isinstance(obj, dict):
+        yield '{'
+        for i, (key, value) in enumerate(obj.iteritems()):
+            yield '{}{}:'.format(',' if i else '', _dumps(key))
+            for chunk in iter_json(value):
+                yield chunk
+        yield '}'
+    elif hasattr(obj, '__iter__'):
+        yield '['
+        for i, item in enumerate(obj):
+            if i:
+                yield ','
+            yield _dumps(item)
+        yield ']'
+    else:
+        yield _dumps(obj)
+
+
+def normalize_url(url):
+    """
+    Return a tuple of the normalized form of ``url`` and its host name, or of
+    ``None`` and ``None`` if ``url`` does not have a scheme and a host.
+
+    The scheme and host are lowercased, a default port, user information,
+    fragment and trailing slashes of the path are removed, and
+    percent-encoding is normalized, so that URLs which refer to the same page
+    in different ways have the same normalized form.
+
+    :param unicode url: URL to normalize.
+    :rtype: ``tuple``
+    """
+    if not url:
+        return None, None
+    try:
+        parts = urlparse.urlsplit(url.strip())
+        port = parts.port
+    except ValueError:
+        return None, None
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').rstrip('.')
+    if not scheme or not host:
+        return None, None
+
+    # IPv6 addresses are enclosed in brackets.
+    netloc = '[{}]'.format(host) if ':' in host else host
+    if port is not None and port != _DEFAULT_PORTS.get(scheme):
+        netloc = '{}:{}'.format(netloc, port)
+    path = _normalize_escapes(parts.path).rstrip('/') or '/'
+    query = _normalize_escapes(parts.query)
+    return urlparse.urlunsplit((scheme, netloc, path, query, '')), host
+
+
 def read_utf8_file(path):
     """
     Read a file and return its contents.
@@ -57,14 +141,21 @@ def read_utf8_file(path):
         return file_.read()
 
 
-def to_timestamp(dt):
-    """
-    Convert from a Python datetime to a JavaScript timestamp.
+def _normalize_escape(match):
+    char = chr(int(match.group(1), 16))
+    return char if char in _UNRESERVED_CHARS else '%' + match.group(1).upper()
+
 
-    :param datetime.datetime dt: Datetime to convert.
-    :return: Timestamp that is suitable for being consumed by JavaScript.
-    :rtype: ``float``
+def _normalize_escapes(text):
     """
-    ms = time.mktime(dt.timetuple()) * 1000
-    mc = dt.microsecond / 1000.0
-    return ms + mc
+    Percent-encode the characters of ``text`` that must be encoded, and
+    normalize its existing percent-encoding.
+    """
+    text = urllib.quote(text.encode('UTF8'), safe=str(_URL_SAFE_CHARS))
+    return _ESCAPE_RE.sub(_normalize_escape, text).decode('ascii')
+
+
+def _dumps(obj):
+    # ``json.dumps()`` may or may not return ``unicode`` (see the
+    # documentation of the ``ensure_ascii`` parameter).
+    return unicode(json.dumps(obj, ensure_ascii=False))
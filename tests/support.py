@@ -0,0 +1,134 @@
+"""
+Provides an in-process App Engine environment for tests.
+
+The App Engine SDK is located with the ``APPENGINE_SDK`` environment variable,
+or else it must already be importable. ``src/spidernotes/secrets.py`` must
+exist; copy it from ``secrets.py.example`` if necessary.
+"""
+
+from __future__ import unicode_literals
+import json
+import os
+import sys
+import unittest
+from collections import OrderedDict
+
+
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..',
+                                       'src'))
+
+
+def setup_paths():
+    """
+    Add the App Engine SDK, its bundled libraries and the application source
+    to ``sys.path``, and change to the source directory, as App Engine does.
+    """
+    if SRC_DIR in sys.path:
+        return
+    sdk = os.environ.get('APPENGINE_SDK')
+    if sdk:
+        sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, SRC_DIR)
+    os.chdir(SRC_DIR)
+
+
+class TestCase(unittest.TestCase):
+    """
+    Activates a :class:`google.appengine.ext.testbed.Testbed` with strongly
+    consistent datastore, memcache and task queue stubs for each test.
+
+    Tasks are executed in-process, when :func:`spidernotes.tasks.run_pending`
+    is called, rather than by the task queue stub.
+    """
+
+    def setUp(self):
+        from google.appengine.datastore import datastore_stub_util
+        from google.appengine.ext import ndb, testbed
+        from spidernotes import tasks
+        from spidernotes.storage import NdbStorage, set_storage
+
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=SRC_DIR)
+        self.testbed.init_urlfetch_stub()
+        ndb.get_context().clear_cache()
+        self.addCleanup(tasks.set_executor,
+                        tasks.set_executor(tasks.InProcessExecutor()))
+        self.addCleanup(set_storage, set_storage(NdbStorage()))
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def patch(self, obj, name, value):
+        """Set the attribute ``name`` of ``obj`` to ``value`` for this test."""
+        self.addCleanup(setattr, obj, name, getattr(obj, name))
+        setattr(obj, name, value)
+
+
+class AppTestCase(TestCase):
+    """
+    Sends requests to ``spidernotes.app`` in-process as a user whose token
+    is in :attr:`headers`.
+    """
+
+    def setUp(self):
+        super(AppTestCase, self).setUp()
+        import webtest
+        import spidernotes
+
+        self.app = webtest.TestApp(spidernotes.app)
+        token = json.loads(self.app.get('/api/user').body)['token']
+        self.headers = {'X-Messaging-Token': str(token)}
+
+    def post(self, path, body, status=200, headers=None):
+        """
+        Post ``body`` to ``path`` as json, with its ``notes`` last, as
+        clients send them, and return the response, whose status must be
+        ``status``.
+
+        :param unicode path: Path of the request.
+        :param body: Request body.
+        :param int status: Expected status of the response.
+        :param dict headers: Headers other than the user's token.
+        """
+        headers = dict(self.headers, **{str(k): str(v) for k, v
+                                        in (headers or {}).iteritems()})
+        if isinstance(body, dict):
+            body = OrderedDict(sorted(body.iteritems(),
+                                      key=lambda o: o[0] == 'notes'))
+        return self.app.post(str(path), json.dumps(body), headers=headers,
+                             status=status)
+
+    def sync(self, body, status=200, headers=None):
+        """
+        Post ``body`` to ``/api/sync``, and return the decoded response,
+        whose status must be ``status``.
+
+        :param dict body: Request body.
+        :param int status: Expected status of the response.
+        :param dict headers: Headers other than the user's token.
+        """
+        return json.loads(self.post('/api/sync', body, status=status,
+                                    headers=headers).body)
+
+
+def make_note(note_id, modified, body='body', url='', is_deleted=False):
+    """
+    Return the ``dict`` representation of a note, as it is sent by clients.
+
+    :param unicode note_id: Unique identifier of the note.
+    :param int modified: Milliseconds since the epoch at which the note was
+        created and modified.
+    """
+    return {'id': note_id,
+            'body': body,
+            'url': url,
+            'isDeleted': is_deleted,
+            'created': modified,
+            'modified': modified}
@@ -0,0 +1,83 @@
+from __future__ import unicode_literals
+import json
+import unittest
+from io import BytesIO
+
+import support
+support.setup_paths()
+
+from spidernotes.jsonstream import (
+    RequestTooLargeError, iter_object, iter_values)
+
+
+class IterValuesTest(unittest.TestCase):
+
+    def test_values(self):
+        body = b'{"a": 1}\n[2, 3]\n"four"\n'
+        self.assertEqual(list(iter_values(BytesIO(body))),
+                         [{'a': 1}, [2, 3], 'four'])
+
+    def test_value_at_item_limit(self):
+        value = json.dumps('x' * 98)
+        self.assertEqual(list(iter_values(BytesIO(value), max_item_size=100)),
+                         ['x' * 98])
+
+    def test_value_over_item_limit(self):
+        value = json.dumps('x' * 99)
+        with self.assertRaises(RequestTooLargeError):
+            list(iter_values(BytesIO(value), max_item_size=100))
+
+    def test_item_limit_applies_to_each_value(self):
+        # The values that follow a value must not count towards its size,
+        # even when they are buffered with it.
+        body = b'\n'.join(json.dumps('x' * 250 * 1024) for _ in xrange(4))
+        values = list(iter_values(BytesIO(body), max_item_size=256 * 1024))
+        self.assertEqual(len(values), 4)
+
+    def test_large_value_over_item_limit(self):
+        body = json.dumps('x' * 1024 * 1024) + b'\n"small"'
+        with self.assertRaises(RequestTooLargeError):
+            list(iter_values(BytesIO(body), max_item_size=256 * 1024))
+
+    def test_body_over_limit(self):
+        body = b'\n'.join(b'"value"' for _ in xrange(100))
+        with self.assertRaises(RequestTooLargeError):
+            list(iter_values(BytesIO(body), max_size=len(body) - 1))
+
+    def test_malformed(self):
+        with self.assertRaises(ValueError):
+            list(iter_values(BytesIO(b'{"a": ')))
+
+
+class IterObjectTest(unittest.TestCase):
+
+    def test_streamed_items(self):
+        body = b'{"lastSynchronized": 5, "notes": [1, 2, 3], "pageSize": 2}'
+        members = []
+        for key, value in iter_object(BytesIO(body), stream_keys=('notes',)):
+            members.append((key, value if key != 'notes' else list(value)))
+        self.assertEqual(members, [('lastSynchronized', 5),
+                                   ('notes', [1, 2, 3]),
+                                   ('pageSize', 2)])
+
+    def test_unconsumed_items_are_skipped(self):
+        body = b'{"notes": [1, 2, 3], "cursor": "c"}'
+        members = dict(iter_object(BytesIO(body), stream_keys=('notes',)))
+        self.assertEqual(members['cursor'], 'c')
+
+    def test_streamed_item_over_limit(self):
+        body = b'{"notes": ["small", ' + json.dumps('x' * 200) + b']}'
+        members = iter_object(BytesIO(body), stream_keys=('notes',),
+                              max_item_size=100)
+        _, items = next(members)
+        self.assertEqual(next(items), 'small')
+        with self.assertRaises(RequestTooLargeError):
+            next(items)
+
+    def test_invalid_key(self):
+        with self.assertRaises(ValueError):
+            list(iter_object(BytesIO(b'{1: 2}')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+from __future__ import unicode_literals
+import unittest
+from datetime import datetime, timedelta
+
+import support
+support.setup_paths()
+
+from google.appengine.ext.ndb.key import Key
+
+from spidernotes import models, tasks
+from spidernotes.handlers.synchronization import _NoteTuple
+from spidernotes.models import Note, NoteChanges, UrlFilter
+from spidernotes.storage import get_storage
+
+
+_MODIFIED = datetime(2014, 5, 13, 16, 26, 40)
+
+_EARLIER = _MODIFIED - timedelta(milliseconds=1)
+
+_LATER = _MODIFIED + timedelta(milliseconds=1)
+
+_SYNCHRONIZED = datetime(2014, 6, 1)
+
+
+def _make_tuple(note_id='n', modified=_MODIFIED, body='body',
+                is_deleted=False):
+    return _NoteTuple(id=note_id, body=body, url='http://example.com/',
+                      is_deleted=is_deleted, created=_MODIFIED,
+                      modified=modified)
+
+
+class MergeFromNoteTest(support.TestCase):
+
+    def setUp(self):
+        super(MergeFromNoteTest, self).setUp()
+        self.note = Note(parent=Key('User', 1), id='n')
+        self.note.update_from_note(_make_tuple(), _SYNCHRONIZED)
+
+    def test_created(self):
+        note = Note(parent=Key('User', 1), id='n')
+        self.assertEqual(note.merge_from_note(_make_tuple(), True,
+                                              _SYNCHRONIZED),
+                         (True, True))
+        self.assertEqual(note.body, 'body')
+        self.assertEqual(note.synchronized, _SYNCHRONIZED)
+
+    def test_newer_supersedes(self):
+        later = _SYNCHRONIZED + timedelta(seconds=1)
+        from_note = _make_tuple(modified=_LATER, body='newer')
+        self.assertEqual(self.note.merge_from_note(from_note, False, later),
+                         (True, True))
+        self.assertEqual(self.note.body, 'newer')
+        self.assertEqual(self.note.synchronized, later)
+
+    def test_older_is_ignored(self):
+        from_note = _make_tuple(modified=_EARLIER, body='older')
+        self.assertEqual(self.note.merge_from_note(from_note, False,
+                                                   datetime(2014, 7, 1)),
+                         (False, False))
+        self.assertEqual(self.note.body, 'body')
+        self.assertEqual(self.note.synchronized, _SYNCHRONIZED)
+
+    def test_same_time_supersedes(self):
+        from_note = _make_tuple(body='concurrent')
+        self.assertEqual(self.note.merge_from_note(from_note, False,
+                                                   datetime(2014, 7, 1)),
+                         (True, True))
+        self.assertEqual(self.note.body, 'concurrent')
+
+    def test_unchanged_is_not_written(self):
+        self.assertEqual(self.note.merge_from_note(_make_tuple(), False,
+                                                   datetime(2014, 7, 1)),
+                         (True, False))
+        self.assertEqual(self.note.synchronized, _SYNCHRONIZED)
+
+    def test_deletion_clears_url_keys(self):
+        self.note.index_url()
+        self.assertIsNotNone(self.note.url_key)
+        from_note = _make_tuple(modified=_LATER, is_deleted=True)
+        self.note.merge_from_note(from_note, False, datetime(2014, 7, 1))
+        self.assertTrue(self.note.is_deleted)
+        self.assertIsNone(self.note.url_key)
+        self.assertIsNone(self.note.host_key)
+
+
+class DeleteAllTest(support.TestCase):
+
+    def merge(self, user_key, note_ids):
+        get_storage().merge_multi(user_key, note_ids,
+                                  [_make_tuple(o) for o in note_ids])
+
+    def test_batches(self):
+        self.patch(models, '_DELETE_BATCH_SIZE', 2)
+        user_key = Key('User', 1)
+        other_key = Key('User', 2)
+        self.merge(user_key, ['n{}'.format(i) for i in xrange(5)])
+        self.merge(other_key, ['other'])
+
+        Note.delete_all(user_key)
+        self.assertEqual(Note.query(ancestor=user_key).count(), 5)
+        self.assertEqual(tasks.run_pending(), 3)
+        self.assertEqual(Note.query(ancestor=user_key).count(), 0)
+        self.assertEqual(Note.query(ancestor=other_key).count(), 1)
+
+    def test_no_notes(self):
+        Note.delete_all(Key('User', 1))
+        self.assertEqual(tasks.run_pending(), 1)
+
+
+class UrlFilterTest(support.TestCase):
+
+    def setUp(self):
+        super(UrlFilterTest, self).setUp()
+        self.user_key = Key('User', 1)
+
+    def build(self):
+        self.assertIsNone(UrlFilter.get_or_build(self.user_key))
+        self.assertEqual(tasks.run_pending(), 1)
+        return UrlFilter.get_or_build(self.user_key)
+
+    def test_build_includes_unindexed_notes(self):
+        url = 'http://example.com/legacy'
+        note = Note(parent=self.user_key, id='legacy')
+        note.update_from_note(_make_tuple(), _SYNCHRONIZED)
+        note.url = url
+        note.url_key = note.host_key = None
+        note.put()
+
+        url_filter = self.build()
+        self.assertIn(Note.compute_url_keys(url)[0],
+                      url_filter.get_bloom_filter())
+
+    def test_built_filter_is_read_without_build(self):
+        self.build()
+        self.assertIsNotNone(UrlFilter.get_or_build(self.user_key))
+        self.assertEqual(tasks.run_pending(), 0)
+
+    def test_version_advances_only_when_url_keys_change(self):
+        url_filter = self.build()
+        version = url_filter.version
+        self.assertFalse(url_filter.apply_changes(NoteChanges(),
+                                                  _SYNCHRONIZED))
+        self.assertEqual(url_filter.version, version)
+
+        url_key = Note.compute_url_keys('http://example.com/')[0]
+        changes = NoteChanges()
+        changes.added_url_keys.append(url_key)
+        self.assertTrue(url_filter.apply_changes(changes, _SYNCHRONIZED))
+        self.assertEqual(url_filter.version, _SYNCHRONIZED)
+        self.assertIn(url_key, url_filter.get_bloom_filter())
+
+
+if __name__ == '__main__':
+    unittest.main()
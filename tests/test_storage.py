@@ -0,0 +1,179 @@
+from __future__ import unicode_literals
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+import support
+support.setup_paths()
+
+from google.appengine.ext.ndb.key import Key
+
+from spidernotes import tasks
+from spidernotes.handlers.synchronization import _NoteTuple
+from spidernotes.storage import (
+    MemoryStorage, NdbStorage, SqliteStorage, set_storage)
+from spidernotes.timestamps import EPOCH
+
+
+_MODIFIED = datetime(2014, 5, 13, 16, 26, 40)
+
+
+def _make_tuple(note_id, body='body', delta_ms=0):
+    modified = _MODIFIED + timedelta(milliseconds=delta_ms)
+    return _NoteTuple(id=note_id, body=body, url='', is_deleted=False,
+                      created=_MODIFIED, modified=modified)
+
+
+class _StorageTests(object):
+    """Tests that every storage of notes must pass."""
+
+    def setUp(self):
+        super(_StorageTests, self).setUp()
+        self.storage = self.create_storage()
+        set_storage(self.storage)
+        self.user_key = Key('User', 1)
+
+    def create_storage(self):
+        raise NotImplementedError
+
+    def merge(self, *notes):
+        return self.storage.merge_multi(self.user_key,
+                                        [o.id for o in notes], notes)
+
+    def test_merge(self):
+        keys, written, unchanged = self.merge(_make_tuple('a'),
+                                              _make_tuple('b'))
+        self.assertEqual(sorted(o.id() for o in keys), ['a', 'b'])
+        self.assertEqual((written, unchanged), (2, 0))
+
+        keys, written, unchanged = self.merge(
+            _make_tuple('a', 'older', -1), _make_tuple('b'),
+            _make_tuple('c'))
+        self.assertEqual(sorted(o.id() for o in keys), ['b', 'c'])
+        self.assertEqual((written, unchanged), (1, 1))
+
+        a, b, missing = self.storage.get_multi(self.user_key,
+                                               ['a', 'b', 'missing'])
+        self.assertEqual(a.body, 'body')
+        self.assertEqual(a.key.parent(), self.user_key)
+        self.assertEqual(b.key.id(), 'b')
+        self.assertIsNone(missing)
+
+    def test_merge_advances_synchronized(self):
+        self.assertIsNone(self.storage.get_synchronized(self.user_key))
+        self.merge(_make_tuple('a'))
+        first = self.storage.get_synchronized(self.user_key)
+        self.merge(_make_tuple('a'))
+        self.assertEqual(self.storage.get_synchronized(self.user_key), first)
+        self.merge(_make_tuple('a', 'newer', 1))
+        self.assertGreater(self.storage.get_synchronized(self.user_key),
+                           first)
+
+    def test_synchronized_after(self):
+        self.merge(_make_tuple('a'), _make_tuple('b'))
+        first = self.storage.get_synchronized(self.user_key)
+        self.merge(_make_tuple('b', 'newer', 1), _make_tuple('c'))
+        second = self.storage.get_synchronized(self.user_key)
+
+        notes = self.storage.iter_synchronized_after(self.user_key, first)
+        self.assertEqual(sorted(o.key.id() for o in notes), ['b', 'c'])
+        notes = self.storage.iter_synchronized_after(self.user_key, EPOCH)
+        self.assertEqual(sorted(o.key.id() for o in notes), ['a', 'b', 'c'])
+        notes, _, has_more = self.storage.fetch_synchronized_after(
+            self.user_key, EPOCH, first, 10)
+        self.assertEqual([o.key.id() for o in notes], ['a'])
+        self.assertFalse(has_more)
+        notes = self.storage.iter_synchronized_after(self.user_key, second)
+        self.assertEqual(list(notes), [])
+
+    def test_synchronized_after_pages(self):
+        self.merge(*[_make_tuple('n{}'.format(i)) for i in xrange(5)])
+        until = self.storage.get_synchronized(self.user_key)
+        self.assertEqual(sorted(self.fetch_pages(
+            lambda cursor: self.storage.fetch_synchronized_after(
+                self.user_key, EPOCH, until, 2, cursor))),
+            ['n{}'.format(i) for i in xrange(5)])
+
+    def test_all_pages(self):
+        self.merge(*[_make_tuple('n{}'.format(i)) for i in xrange(5)])
+        self.assertEqual(self.fetch_pages(
+            lambda cursor: self.storage.fetch_all(self.user_key, 2, cursor)),
+            ['n{}'.format(i) for i in xrange(5)])
+
+    def test_all_pages_include_merged_notes(self):
+        self.merge(*[_make_tuple('n{}'.format(i)) for i in xrange(5)])
+        notes, cursor, _ = self.storage.fetch_all(self.user_key, 2)
+        ids = [o.key.id() for o in notes]
+        # A note that is merged during the export is not skipped.
+        self.merge(_make_tuple('n4', 'newer', 1))
+        ids.extend(self.fetch_pages(
+            lambda cursor: self.storage.fetch_all(self.user_key, 2, cursor),
+            self.storage.format_cursor(cursor)))
+        self.assertEqual(ids, ['n{}'.format(i) for i in xrange(5)])
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(ValueError):
+            self.storage.parse_cursor('not a cursor')
+
+    def test_has_purged_after(self):
+        self.merge(_make_tuple('a'))
+        self.assertFalse(self.storage.has_purged_after(self.user_key,
+                                                       _MODIFIED))
+
+    def test_delete_all(self):
+        self.merge(_make_tuple('a'))
+        other_key = Key('User', 2)
+        self.storage.merge_multi(other_key, ['b'], [_make_tuple('b')])
+        self.storage.delete_all(self.user_key)
+        self.assertEqual(self.storage.get_multi(self.user_key, ['a']),
+                         [None])
+        self.assertIsNotNone(self.storage.get_multi(other_key, ['b'])[0])
+
+    def fetch_pages(self, fetch_page, token=None):
+        """
+        Return the ids of the notes of every page that ``fetch_page``
+        returns, whose cursors are formatted and parsed between pages.
+        """
+        ids = []
+        cursor = self.storage.parse_cursor(token) if token else None
+        while True:
+            notes, cursor, has_more = fetch_page(cursor)
+            ids.extend(o.key.id() for o in notes)
+            if not has_more:
+                return ids
+            cursor = self.storage.parse_cursor(
+                self.storage.format_cursor(cursor))
+
+
+class NdbStorageTest(_StorageTests, support.TestCase):
+
+    def create_storage(self):
+        return NdbStorage()
+
+    def test_delete_all(self):
+        # Notes are deleted by background tasks.
+        self.merge(_make_tuple('a'))
+        self.storage.delete_all(self.user_key)
+        tasks.run_pending()
+        self.assertEqual(self.storage.get_multi(self.user_key, ['a']),
+                         [None])
+
+
+class MemoryStorageTest(_StorageTests, support.TestCase):
+
+    def create_storage(self):
+        return MemoryStorage()
+
+
+class SqliteStorageTest(_StorageTests, support.TestCase):
+
+    def create_storage(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        return SqliteStorage(os.path.join(directory, 'notes.db'))
+
+
+if __name__ == '__main__':
+    unittest.main()
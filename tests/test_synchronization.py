@@ -0,0 +1,316 @@
+from __future__ import unicode_literals
+import json
+import unittest
+from datetime import datetime, timedelta
+from io import BytesIO
+
+import support
+support.setup_paths()
+
+from google.appengine.ext import ndb
+from google.appengine.ext.ndb.key import Key
+from webapp2_extras.appengine.auth.models import User
+
+from spidernotes import tasks
+from spidernotes.buckets import get_bucket
+from spidernotes.handlers import COLUMNS_CONTENT_TYPE, synchronization
+from spidernotes.handlers.synchronization import (
+    _NoteTuple, _decode_cursor, _encode_cursor, _get_notes_in_buckets,
+    _read_request, default_config)
+from spidernotes.models import NOTE_COLUMNS, Note
+from spidernotes.users import get_by_token
+from spidernotes.storage import get_storage
+from spidernotes.timestamps import EPOCH, utcnow
+
+
+_MODIFIED = 1400000000000
+
+
+class CursorTest(support.TestCase):
+
+    def test_round_trip(self):
+        user_key = Key('User', 1)
+        notes = [_NoteTuple('n{}'.format(i), 'body', '', False,
+                            datetime(2014, 5, 13), datetime(2014, 5, 13))
+                 for i in xrange(2)]
+        get_storage().merge_multi(user_key, ['n0', 'n1'], notes)
+        synchronized = get_storage().get_synchronized(user_key)
+        _, cursor, _ = get_storage().fetch_synchronized_after(
+            user_key, EPOCH, synchronized, 1)
+        self.assertEqual(_decode_cursor(_encode_cursor(synchronized, cursor)),
+                         (synchronized, cursor))
+
+    def test_first_page(self):
+        self.assertEqual(_decode_cursor(None), (None, None))
+        self.assertEqual(_decode_cursor(''), (None, None))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            _decode_cursor('abc:')
+
+
+class ReadRequestTest(unittest.TestCase):
+
+    def read(self, body):
+        return _read_request(BytesIO(body), default_config)
+
+    def test_notes_are_parsed_as_they_are_consumed(self):
+        note = json.dumps(support.make_note('a', _MODIFIED))
+        ctx, notes = self.read(b'{"lastSynchronized": 5, "notes": [' +
+                               note + b', "invalid"]}')
+        self.assertEqual(ctx, {'lastSynchronized': 5})
+        self.assertEqual(next(notes).id, 'a')
+        with self.assertRaises(ValueError):
+            next(notes)
+
+    def test_no_notes(self):
+        self.assertEqual(self.read(b'{"lastSynchronized": 5, "notes": []}'),
+                         ({'lastSynchronized': 5}, ()))
+        self.assertEqual(self.read(b'{"lastSynchronized": 5}'),
+                         ({'lastSynchronized': 5}, ()))
+
+    def test_notes_before_last_synchronized(self):
+        note = json.dumps(support.make_note('a', _MODIFIED))
+        ctx, notes = self.read(b'{"notes": [' + note +
+                               b'], "lastSynchronized": 5}')
+        self.assertEqual(ctx, {'lastSynchronized': 5})
+        self.assertEqual([o.id for o in notes], ['a'])
+
+
+class SyncTest(support.AppTestCase):
+
+    def test_merge(self):
+        notes = [support.make_note('n{}'.format(i), _MODIFIED + i)
+                 for i in xrange(3)]
+        first = self.sync({'lastSynchronized': 0, 'notes': notes})
+        self.assertEqual(first['notes'], [])
+
+        older = support.make_note('n0', _MODIFIED - 1, body='older')
+        newer = support.make_note('n1', _MODIFIED + 10, body='newer')
+        second = self.sync({'lastSynchronized': 0, 'notes': [older, newer]})
+        self.assertEqual(sorted(o['id'] for o in second['notes']),
+                         ['n0', 'n2'])
+        self.assertEqual([o['body'] for o in second['notes']
+                          if o['id'] == 'n0'], ['body'])
+
+    def test_unchanged_notes_are_not_written(self):
+        notes = [support.make_note('n', _MODIFIED)]
+        synchronized = self.sync({'lastSynchronized': 0,
+                                  'notes': notes})['lastSynchronized']
+        self.sync({'lastSynchronized': 0, 'notes': notes})
+        self.assertEqual(
+            self.sync({'lastSynchronized': synchronized,
+                       'notes': []})['lastSynchronized'],
+            synchronized)
+
+    def test_up_to_date(self):
+        notes = [support.make_note('n', _MODIFIED)]
+        synchronized = self.sync({'lastSynchronized': 0,
+                                  'notes': notes})['lastSynchronized']
+        response = self.sync({'lastSynchronized': synchronized,
+                              'notes': []})
+        self.assertEqual(response['notes'], [])
+        self.assertEqual(response['lastSynchronized'], synchronized)
+
+        # A change by another device is returned to an up to date client.
+        self.sync({'lastSynchronized': synchronized,
+                   'notes': [support.make_note('other', _MODIFIED)]})
+        response = self.sync({'lastSynchronized': synchronized,
+                              'notes': []})
+        self.assertEqual([o['id'] for o in response['notes']], ['other'])
+        self.assertGreater(response['lastSynchronized'], synchronized)
+
+    def test_pages(self):
+        notes = [support.make_note('n{}'.format(i), _MODIFIED + i)
+                 for i in xrange(5)]
+        self.sync({'lastSynchronized': 0, 'notes': notes})
+
+        ids = []
+        cursor = None
+        synchronized = set()
+        while True:
+            response = self.sync({'lastSynchronized': 0,
+                                  'cursor': cursor,
+                                  'pageSize': 2,
+                                  'notes': []})
+            ids.extend(o['id'] for o in response['notes'])
+            synchronized.add(response['lastSynchronized'])
+            if not response['hasMore']:
+                break
+            cursor = response['cursor']
+        self.assertEqual(sorted(ids), ['n{}'.format(i) for i in xrange(5)])
+        self.assertEqual(len(synchronized), 1)
+
+    def test_invalid_cursor(self):
+        for cursor in ('abc:def', '1:not-a-cursor', 5):
+            self.post('/api/sync', {'lastSynchronized': 0,
+                                    'cursor': cursor,
+                                    'notes': []}, status=400)
+
+    def test_invalid_notes(self):
+        self.patch(synchronization, 'MERGE_BATCH_SIZE', 1)
+        valid = support.make_note('a', _MODIFIED)
+        for invalid in ([1, 2], {'id': 'b'}, 'b'):
+            self.post('/api/sync', {'lastSynchronized': 0,
+                                    'notes': [valid, invalid]}, status=400)
+        # The batches before an invalid note remain merged.
+        self.assertEqual([o.key.id() for o in Note.query()], ['a'])
+
+    def test_note_too_large(self):
+        body = 'x' * (default_config['max_note_size'] + 1)
+        notes = [support.make_note('a', _MODIFIED, body=body)]
+        self.post('/api/sync', {'lastSynchronized': 0, 'notes': notes},
+                  status=413)
+
+    def test_invalid_page_size(self):
+        for page_size in (0, 'abc', [2]):
+            self.post('/api/sync', {'lastSynchronized': 0,
+                                    'cursor': None,
+                                    'pageSize': page_size,
+                                    'notes': []}, status=400)
+
+    def test_resync_after_purge(self):
+        notes = [support.make_note('a', _MODIFIED),
+                 support.make_note('b', _MODIFIED)]
+        before = self.sync({'lastSynchronized': 0,
+                            'notes': notes})['lastSynchronized']
+        deleted = support.make_note('a', _MODIFIED + 1, is_deleted=True)
+        after = self.sync({'lastSynchronized': before,
+                           'notes': [deleted]})['lastSynchronized']
+        Note.purge_deleted(utcnow() + timedelta(minutes=1))
+        tasks.run_pending()
+
+        # The client's notes are not merged.
+        response = self.sync({'lastSynchronized': before,
+                              'notes': [support.make_note('c', _MODIFIED)]},
+                             status=409)
+        self.assertEqual(response, {'status': 'resync'})
+        self.sync({'lastSynchronized': after, 'notes': []})
+        response = self.sync({'lastSynchronized': 0, 'notes': []})
+        self.assertEqual([o['id'] for o in response['notes']], ['b'])
+
+    def test_idempotent_replay(self):
+        headers = {'Idempotency-Key': 'abc'}
+        body = {'lastSynchronized': 0,
+                'notes': [support.make_note('n', _MODIFIED)]}
+        first = self.sync(body, headers=headers)
+
+        # Another device's change advances the user's synchronized datetime,
+        # which a merge would return, but a replay must not.
+        self.sync({'lastSynchronized': 0,
+                   'notes': [support.make_note('other', _MODIFIED)]})
+        replay = self.sync(body, headers=headers)
+        self.assertEqual(replay['lastSynchronized'],
+                         first['lastSynchronized'])
+        self.assertNotIn('n', [o['id'] for o in replay['notes']])
+
+        merged = self.sync(body, headers={'Idempotency-Key': 'def'})
+        self.assertGreater(merged['lastSynchronized'],
+                           first['lastSynchronized'])
+
+
+class ColumnsTest(support.AppTestCase):
+
+    columns_headers = {'Content-Type': COLUMNS_CONTENT_TYPE,
+                       'Accept': COLUMNS_CONTENT_TYPE}
+
+    def make_row(self, note_id, modified, body='body'):
+        note = support.make_note(note_id, modified, body=body)
+        return [note[o] for o in NOTE_COLUMNS]
+
+    def test_round_trip(self):
+        rows = [self.make_row('n{}'.format(i), _MODIFIED + i)
+                for i in xrange(3)]
+        response = self.post('/api/sync', {'lastSynchronized': 0,
+                                           'notes': rows},
+                             headers=self.columns_headers)
+        self.assertEqual(response.content_type, COLUMNS_CONTENT_TYPE)
+        self.assertEqual(json.loads(response.body)['notes'], [])
+
+        response = json.loads(self.post(
+            '/api/sync', {'lastSynchronized': 0, 'notes': []},
+            headers={'Accept': COLUMNS_CONTENT_TYPE}).body)
+        self.assertEqual(sorted(response['notes']), rows)
+        self.assertIsInstance(response['lastSynchronized'], int)
+
+    def test_json_is_the_default(self):
+        self.post('/api/sync', {'lastSynchronized': 0,
+                                'notes': [self.make_row('a', _MODIFIED)]},
+                  headers={'Content-Type': COLUMNS_CONTENT_TYPE})
+        response = self.post('/api/sync', {'lastSynchronized': 0,
+                                           'notes': []})
+        self.assertEqual(response.content_type, 'application/json')
+        self.assertEqual([o['id'] for o in json.loads(response.body)['notes']],
+                         ['a'])
+
+    def test_invalid_rows(self):
+        for invalid in (support.make_note('a', _MODIFIED), ['a', 'body'],
+                        'a'):
+            self.post('/api/sync', {'lastSynchronized': 0,
+                                    'notes': [invalid]},
+                      status=400, headers=self.columns_headers)
+
+
+class ReconcileTest(support.AppTestCase):
+
+    def setUp(self):
+        super(ReconcileTest, self).setUp()
+        self.user_key = get_by_token(
+            User, self.headers['X-Messaging-Token']).key
+        self.note_ids = ['n{}'.format(i) for i in xrange(3)]
+        self.sync({'lastSynchronized': 0,
+                   'notes': [support.make_note(o, _MODIFIED)
+                             for o in self.note_ids]})
+
+        # Notes that predate buckets do not store one.
+        notes = Note.query(ancestor=self.user_key).fetch()
+        for note in notes:
+            note.bucket = None
+        hook = Note._pre_put_hook
+        Note._pre_put_hook = lambda self: None
+        try:
+            ndb.put_multi(notes)
+        finally:
+            Note._pre_put_hook = hook
+
+    def reconcile(self, status=200):
+        return json.loads(self.post('/api/reconcile', {'buckets': {}},
+                                    status=status).body)
+
+    def test_notes_without_buckets(self):
+        self.assertEqual(self.reconcile(status=202), {'status': 'pending'})
+        self.assertEqual(tasks.run_pending(), 1)
+        response = self.reconcile()
+        self.assertEqual(sorted(o['id'] for o in response['notes']),
+                         self.note_ids)
+        self.assertEqual(Note.query(Note.bucket == None,
+                                    ancestor=self.user_key).count(), 0)
+
+    def test_scan_notes_without_buckets(self):
+        self.patch(synchronization, '_MAX_BUCKET_QUERIES', 0)
+        notes = _get_notes_in_buckets(self.user_key, {get_bucket('n0')})
+        self.assertEqual([o.key.id() for o in notes], ['n0'])
+
+
+class ImportTest(support.AppTestCase):
+
+    def import_notes(self, lines, status=200):
+        return self.app.post(b'/api/import', b'\n'.join(lines),
+                             headers=self.headers, status=status)
+
+    def test_import(self):
+        lines = [json.dumps(support.make_note('n{}'.format(i), _MODIFIED))
+                 for i in xrange(3)]
+        response = json.loads(self.import_notes(lines).body)
+        self.assertEqual((response['imported'], response['written']), (3, 3))
+        self.assertEqual(sorted(o.key.id() for o in Note.query()),
+                         ['n0', 'n1', 'n2'])
+
+    def test_invalid_notes(self):
+        valid = json.dumps(support.make_note('a', _MODIFIED))
+        for invalid in (b'[1, 2]', b'"b"', b'{"id": "b"}', b'{'):
+            self.import_notes([valid, invalid], status=400)
+
+
+if __name__ == '__main__':
+    unittest.main()
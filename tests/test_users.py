@@ -0,0 +1,112 @@
+from __future__ import unicode_literals
+import json
+import unittest
+
+import support
+support.setup_paths()
+
+from webapp2_extras.appengine.auth.models import User
+
+from spidernotes import models, tasks
+from spidernotes.models import Note
+from spidernotes.users import (
+    create_token, create_user, disconnect_user, get_by_token,
+    get_unauthenticated_auth_id, is_token)
+
+
+_MODIFIED = 1400000000000
+
+
+class TokenTest(support.TestCase):
+
+    def setUp(self):
+        super(TokenTest, self).setUp()
+        self.user = create_user(User)
+        self.token = create_token(self.user)
+
+    def test_round_trip(self):
+        self.assertTrue(is_token(self.token))
+        self.assertEqual(get_by_token(User, self.token).key, self.user.key)
+
+    def test_tampered_signature(self):
+        payload, _, signature = self.token.rpartition('.')
+        tampered = 'A' if signature[0] != 'A' else 'B'
+        self.assertIsNone(get_by_token(
+            User, '{}.{}{}'.format(payload, tampered, signature[1:])))
+        self.assertIsNone(get_by_token(User, payload + '.'))
+        self.assertIsNone(get_by_token(User, payload))
+
+    def test_tampered_payload(self):
+        other = create_user(User)
+        _, _, signature = self.token.rpartition('.')
+        other_payload, _, _ = create_token(other).rpartition('.')
+        self.assertIsNone(get_by_token(
+            User, '{}.{}'.format(other_payload, signature)))
+
+    def test_revoked(self):
+        disconnect_user(self.user)
+        self.user.put()
+        self.assertIsNone(get_by_token(User, self.token))
+
+    def test_not_legacy_auth_id(self):
+        self.assertFalse(is_token(get_unauthenticated_auth_id(self.user)))
+
+
+class UserHandlerTest(support.AppTestCase):
+
+    def assert_forbidden(self, auth_id):
+        self.app.post(b'/api/sync', json.dumps({'lastSynchronized': 0}),
+                      headers={'X-Messaging-Token': str(auth_id)},
+                      status=403)
+
+    def test_tampered_token(self):
+        token = self.headers['X-Messaging-Token']
+        payload, _, signature = token.rpartition('.')
+        user_id, _, suffix = payload[len('v1.'):].partition('.')
+        self.assert_forbidden('v1.{}.{}.{}'.format(user_id + '0', suffix,
+                                                   signature))
+        self.assert_forbidden('{}.{}'.format(payload, signature[::-1]))
+
+    def test_token_is_revoked_by_disconnect(self):
+        token = self.headers['X-Messaging-Token']
+        user = get_by_token(User, token)
+        user.add_auth_id('google:123')
+        user.put()
+
+        response = self.app.post(b'/api/disconnect', headers=self.headers)
+        new_token = json.loads(response.body)['token']
+        self.assertNotEqual(new_token, token)
+        self.assert_forbidden(token)
+        self.app.post(b'/api/sync', json.dumps({'lastSynchronized': 0}),
+                      headers={'X-Messaging-Token': str(new_token)})
+
+    def test_legacy_auth_id(self):
+        user = get_by_token(User, self.headers['X-Messaging-Token'])
+        auth_id = get_unauthenticated_auth_id(user)
+        response = self.app.get(b'/api/user',
+                                headers={'X-Messaging-Token': str(auth_id)})
+        token = json.loads(response.body)['token']
+        self.assertEqual(token, self.headers['X-Messaging-Token'])
+        self.app.post(b'/api/sync', json.dumps({'lastSynchronized': 0}),
+                      headers={'X-Messaging-Token': str(auth_id)})
+        self.assert_forbidden('spidernotes:unknown')
+
+    def test_delete(self):
+        self.patch(models, '_DELETE_BATCH_SIZE', 2)
+        self.sync({'lastSynchronized': 0,
+                   'notes': [support.make_note('n{}'.format(i), _MODIFIED)
+                             for i in xrange(5)]})
+
+        response = self.app.delete(b'/api/user', headers=self.headers,
+                                   status=202)
+        self.assertEqual(json.loads(response.body), {'status': 'pending'})
+        self.assertEqual(Note.query().count(), 5)
+        self.assertEqual(tasks.run_pending(), 3)
+        self.assertEqual(Note.query().count(), 0)
+
+        self.app.post(b'/api/sync', json.dumps({'lastSynchronized': 0}),
+                      headers=self.headers, status=403)
+
+
+if __name__ == '__main__':
+    unittest.main()